@@ -0,0 +1,114 @@
+#==========================================================#
+# Benchmark of the local co-registration
+#==========================================================#
+
+# Estimates known sub-pixel shifts between a synthetic Sentinel-2 scene averaged onto a 30 m
+# grid and a synthetic Landsat composite (translation and affine, other gain, noise, invalid
+# pixels) with NOC_coreg (phase correlation tile by tile and robust fit), and checks the
+# corrected geotransform. Then co-registers GeoTiffs of several sites in parallel with
+# NOC_coreg.coregister_sites and reads the offsets from the catalog. Runs offline.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_coregistration.py
+
+#%% 1. Shifts of synthetic composites
+
+# load modules
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from scipy import ndimage
+from coastsat import NOC_coreg, NOC_georef
+
+np.random.seed(0)
+
+# ground at 10 m and Sentinel-2 composite averaged on the 30 m grid of the Landsat composite
+ground = ndimage.gaussian_filter(np.random.rand(900, 900), 6)
+reference = ground.reshape(300, 3, 300, 3).mean(axis=(1, 3))
+georef = (151.0, 0.0003, 0, -33.0, 0, -0.0003)
+
+def landsat_composite(coefs):
+    # Landsat pixel (row, col) shows the ground at (row, col) - shift(row, col)
+    rows, cols = np.mgrid[0:300, 0:300] + 0.5
+    shift_rows = coefs[0][0] + coefs[0][1]*rows + coefs[0][2]*cols
+    shift_cols = coefs[1][0] + coefs[1][1]*rows + coefs[1][2]*cols
+    im = ndimage.map_coordinates(reference, [rows - 0.5 - shift_rows, cols - 0.5 - shift_cols],
+                                 order=3, mode='nearest')
+    im = 2*im + 0.1 + np.random.normal(0, 0.002, im.shape)
+    # no data in a corner
+    im[:80,:80] = 0
+    return im
+
+for model, coefs in [('translation', [[0.7, 0, 0], [-1.3, 0, 0]]),
+                     ('affine', [[0.5, 0.002, 0], [-0.8, 0, -0.003]])]:
+    im = landsat_composite(coefs)
+    t0 = time.time()
+    tiles = NOC_coreg.estimate_shifts(reference, im)
+    fit = NOC_coreg.fit_model(tiles, model)
+    # error of the corrected geotransform at the pixels of the tiles
+    new_georef = NOC_coreg.corrected_geotransform(georef, fit['coefs'])
+    errors = []
+    for row, col in tiles[:,:2]:
+        ground_rc = [row - (coefs[0][0] + coefs[0][1]*row + coefs[0][2]*col),
+                     col - (coefs[1][0] + coefs[1][1]*row + coefs[1][2]*col)]
+        xy_true = NOC_georef.Affine(georef).matrix.dot([ground_rc[1], ground_rc[0], 1])
+        xy_new = NOC_georef.Affine(new_georef).matrix.dot([col, row, 1])
+        errors.append(np.hypot(*(xy_new - xy_true)[:2])/georef[1])
+    print('%s: %d/%d tiles, rmse %.3f px, error of the geotransform %.3f px (max %.3f), %.2f s' %
+          (model, np.sum(fit['inliers']), len(tiles), fit['rmse'], np.mean(errors),
+           np.max(errors), time.time() - t0))
+
+#%% 2. Co-registration of the GeoTiffs of several sites
+
+from osgeo import gdal
+from coastsat import NOC_catalog
+
+def write_geotiff(fn, im, georef):
+    if not os.path.exists(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    ds = gdal.GetDriverByName('GTiff').Create(fn, im.shape[1], im.shape[0], im.shape[2],
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform(georef)
+    ds.SetProjection('EPSG:4326')
+    for k in range(im.shape[2]):
+        ds.GetRasterBand(k+1).WriteArray(im[:,:,k])
+    ds = None
+
+if __name__ == '__main__':
+    filepath = tempfile.mkdtemp()
+    catalog = NOC_catalog.get_catalog(filepath)
+    dates = {'start_date': '2019-01-01', 'end_date': '2019-12-31', 'epsg': 4326,
+             'median_no': 10}
+    shifts = dict([])
+    for k in range(4):
+        sitename = 'site%d' % k
+        shifts[sitename] = np.random.uniform(-1.5, 1.5, 2)
+        # Sentinel-2 composite at 10 m (4 bands, nir last)
+        fn = os.path.join(sitename, 'S2', '10m', 'S2_%s.tif' % sitename)
+        write_geotiff(os.path.join(filepath, fn), np.repeat(ground[:,:,None], 4, axis=2),
+                      (151.0, 0.0001, 0, -33.0, 0, -0.0001))
+        catalog.add(sitename, 'S2', dict(dates, filename='S2_%s.tif' % sitename), [fn])
+        # Landsat 8 composite (ms at 30 m with nir in the 4th band, pan at 15 m)
+        coefs = [[shifts[sitename][0], 0, 0], [shifts[sitename][1], 0, 0]]
+        fns = [os.path.join(sitename, 'L8', 'pan', 'L8_%s.tif' % sitename),
+               os.path.join(sitename, 'L8', 'ms', 'L8_%s.tif' % sitename)]
+        write_geotiff(os.path.join(filepath, fns[0]), np.zeros((600, 600, 1)),
+                      (151.0, 0.00015, 0, -33.0, 0, -0.00015))
+        write_geotiff(os.path.join(filepath, fns[1]),
+                      np.repeat(landsat_composite(coefs)[:,:,None], 6, axis=2), georef)
+        # the pan GeoTiff first (as in NOC_download.composite_paths)
+        catalog.add(sitename, 'L8', dict(dates, filename='L8_%s.tif' % sitename), fns)
+
+    t0 = time.time()
+    results = NOC_coreg.coregister_sites(filepath, n_workers=4)
+    print('%d composites co-registered in %.1f s' % (len(results), time.time() - t0))
+    for result in catalog.get_coregistration():
+        true = [-shifts[result['sitename']][1]*georef[1]*1000*NOC_georef.KM_PER_DEGREE*
+                np.cos(np.radians(-33.045)),
+                shifts[result['sitename']][0]*georef[1]*1000*NOC_georef.KM_PER_DEGREE]
+        print('    %s: dx = %.1f m (true %.1f m), dy = %.1f m (true %.1f m)' %
+              (result['sitename'], result['dx'], true[0], result['dy'], true[1]))
+    print('checksums after the update: %s' % (catalog.verify('site0') or 'ok'))
+    # the composites already co-registered are skipped
+    print('second run: %d composites co-registered' % len(NOC_coreg.coregister_sites(filepath)))
+    shutil.rmtree(filepath)
@@ -0,0 +1,161 @@
+#==========================================================#
+# Benchmark of the concurrent downloads of the band groups
+#==========================================================#
+
+# Downloads the band groups of a Sentinel-2 composite (10 m, 20 m and 60 m) from a local
+# HTTP stand-in for the Earth Engine download URLs (tests/fake_ee.py), one after the other and
+# with NOC_download.download_bands, and checks the downloaded GeoTiffs. Then counts the
+# requests to the Earth Engine server for each composite with a fake ee client, with and
+# without the cache of the query results, and the cloud scores in the graphs of the Landsat
+# composites, and the graphs built from the composite recipes. Runs offline.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_download.py
+
+#%% 1. Local stand-in for the Earth Engine downloads
+
+# load modules
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from osgeo import gdal
+from coastsat import NOC_download
+from tests import fake_ee
+
+np.random.seed(0)
+
+delay = 2           # time Earth Engine takes to prepare each download [s]
+band_groups = [(10, '10m', ['B2', 'B3', 'B4', 'B8']),
+               (20, '20m', ['B12']),
+               (60, '60m', ['QA60'])]
+fn = 'S2_site_median_S20200101_E20201231.tif'
+
+def geotiff_bytes(im):
+    # content of an uncompressed GeoTiff with the bands of im (like the Earth Engine downloads)
+    fn = '/vsimem/%d.tif' % np.random.randint(1e9)
+    ds = gdal.GetDriverByName('GTiff').Create(fn, im.shape[1], im.shape[0], im.shape[2],
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform([151.3, 0.0001, 0, -33.7, 0, -0.0001])
+    for k in range(im.shape[2]):
+        ds.GetRasterBand(k+1).WriteArray(im[:,:,k])
+    ds = None
+    f = gdal.VSIFOpenL(fn, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    content = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(fn)
+    return content
+
+# one zip file per scale, with a single data.tif or (10 m) one file per band
+content = dict([])
+files = dict([])
+for scale, folder, bands in band_groups:
+    size = 6000//scale
+    # smooth reflectances
+    content[scale] = np.cumsum(np.random.uniform(0, 0.001, (size, size, len(bands))),
+                               axis=1).astype(np.float32)
+    if scale == 10:
+        members = dict([('data.%s.tif' % band, geotiff_bytes(content[scale][:,:,[k]]))
+                        for k, band in enumerate(bands)])
+    else:
+        members = {'data.tif': geotiff_bytes(content[scale])}
+    files['/data_%d.zip' % scale] = fake_ee.make_zip(members)
+
+#%% 2. Serial and concurrent downloads
+
+with fake_ee.DownloadServer(files, delay) as server:
+    image = fake_ee.Image(server)
+    for n_workers in [1, 3]:
+        filepath = tempfile.mkdtemp()
+        for _, folder, _ in band_groups:
+            os.makedirs(os.path.join(filepath, folder))
+        groups = [(scale, os.path.join(filepath, folder), bands)
+                  for scale, folder, bands in band_groups]
+        t0 = time.time()
+        paths = NOC_download.download_bands(image, [], groups, fn, n_workers)
+        print('%d worker(s): %.1f s, %d downloads at the same time' %
+              (n_workers, time.time() - t0, server.max_in_flight))
+        # check the files (no temporary files left, same bands, compressed)
+        for (scale, folder, _), path in zip(band_groups, paths):
+            ds = gdal.Open(path)
+            im = np.stack([ds.GetRasterBand(k+1).ReadAsArray() for k in range(ds.RasterCount)], 2)
+            same = np.array_equal(im, content[scale])
+            compression = ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION')
+            ds = None
+            print('    %s: %s, %s, %.1f MB (%.1f MB uncompressed), files in folder: %s' %
+                  (folder, 'ok' if same else 'WRONG', compression, os.path.getsize(path)/1e6,
+                   content[scale].nbytes/1e6, os.listdir(os.path.dirname(path))))
+        shutil.rmtree(filepath)
+
+#%% 3. Earth Engine round-trips per composite
+
+# offline stand-in for the ee client, counting the getInfo requests
+NOC_download.ee = fake_ee.EarthEngine(n_images=12)
+settings = {'LCloudScore': 20, 'LCloudThreshold': 35, 'add_L7_to_L5': True,
+            'add_L5_to_L7': True, 'add_L7_to_L8': True, 'CLOUD_FILTER': 60,
+            'CLD_PRB_THRESH': 40, 'NIR_DRK_THRESH': 0.15, 'CLD_PRJ_DIST': 2, 'BUFFER': 100}
+polygon = [[[151.3, -33.7],[151.4, -33.7],[151.4, -33.8],[151.3, -33.8],[151.3, -33.7]]]
+collections = {'L5': 'LANDSAT/LT05/C01/T1_TOA', 'L7': 'LANDSAT/LE07/C01/T1_TOA',
+               'L8': 'LANDSAT/LC08/C01/T1_TOA', 'S2': 'COPERNICUS/S2'}
+for satname in ['L5', 'L7', 'L8', 'S2']:
+    NOC_download.ee.round_trips = 0
+    median_img, counts = NOC_download.obtain_image_median(collections[satname],
+                                                          ['2019-01-01', '2019-12-31'],
+                                                          NOC_download.ee.Geometry.Polygon(polygon),
+                                                          [satname], settings)
+    references = None
+    if not satname == 'S2':
+        displacement, references = NOC_download.Landsat_Coregistration({'polygon': polygon})
+    metadata = NOC_download.get_composite_info(median_img, counts, references)
+    print('%s: %d round-trip(s) to the server for the composite' %
+          (satname, NOC_download.ee.round_trips))
+
+#%% 4. Cache of the query results
+
+from coastsat import NOC_cache
+inputs = {'polygon': polygon, 'dates': ['2019-01-01', '2019-12-31'], 'sat_list': ['L8'],
+          'sitename': 'site', 'filepath': tempfile.mkdtemp()}
+settings['coregistration'] = True
+cache = NOC_cache.get_cache(inputs, settings)
+for run in ['first run', 'second run']:
+    NOC_download.ee.round_trips = 0
+    median_img, counts = NOC_download.obtain_image_median(collections['L8'], inputs['dates'],
+                                                          NOC_download.ee.Geometry.Polygon(polygon),
+                                                          ['L8'], settings)
+    metadata, displacement = NOC_download.get_composite_metadata(median_img, counts, inputs,
+                                                                 settings, cache, True)
+    print('%s: %d round-trip(s) to the server' % (run, NOC_download.ee.round_trips))
+shutil.rmtree(inputs['filepath'])
+
+#%% 5. Cloud scores in the graphs of the Landsat composites
+
+# number of calls of simpleCloudScore in the graph sent to the server (one per collection
+# means that each image is scored once)
+for satname in ['L5', 'L7', 'L8']:
+    median_img, counts = NOC_download.obtain_image_median(collections[satname], inputs['dates'],
+                                                          NOC_download.ee.Geometry.Polygon(polygon),
+                                                          [satname], settings)
+    print('%s: %d collection(s), %d simpleCloudScore call(s), %d nodes in the graph' %
+          (satname, len(counts), fake_ee.count_calls(median_img, 'simpleCloudScore'),
+           len(fake_ee.serialize(median_img))))
+
+#%% 6. Composite recipes
+
+# (the graphs of the recipes are checked against the graphs of the previous
+# obtain_image_median in tests/test_composite_recipes.py)
+# the same composite is built once (memoized graphs, even with a new ee.Geometry)
+images = [NOC_download.obtain_image_median(collections['L8'], inputs['dates'],
+                                           NOC_download.ee.Geometry.Polygon(polygon), ['L8'],
+                                           settings)[0] for _ in range(2)]
+area = NOC_download.ee.Geometry.Polygon(polygon)
+print('same graph object for the same composite: %s' % (images[0] is images[1]))
+# other reducers and rolling windows (12-month composites every 6 months)
+for reducer in ['mean', {'type': 'percentile', 'percentile': 20},
+                {'type': 'quality_mosaic', 'band': 'nir'}]:
+    image, counts = NOC_download.obtain_image_median(collections['L7'], inputs['dates'], area,
+                                                     ['L7'], dict(settings, reducer=reducer))
+    print('%s: %d nodes in the graph' % (reducer, len(fake_ee.serialize(image))))
+windows = NOC_download.composite_windows('S2', '2018-01-01', '2019-12-31', 12, 6, area, settings)
+print('rolling windows: %s' % [time_range for time_range, _, _ in windows])
@@ -0,0 +1,82 @@
+#==========================================================#
+# Benchmark of the conversion of the shorelines to a GeoDataFrame
+#==========================================================#
+
+# Compares SDS_tools.output_to_gdf (geometries and attributes created at once) with the
+# original loop appending one-row GeoDataFrames, on 100,000 synthetic shorelines.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_gdf.py
+
+#%% 1. Synthetic shorelines
+
+# load modules
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from datetime import datetime, timedelta
+from shapely import geometry
+from coastsat import SDS_tools
+
+np.random.seed(0)
+
+n_shorelines = 100000
+n_points = 50
+
+output = {'shorelines': [np.cumsum(np.random.normal(0, 10, (n_points, 2)), axis=0)
+                         for _ in range(n_shorelines)],
+          'dates': [datetime(1984,1,1) + timedelta(days=i) for i in range(n_shorelines)],
+          'satname': np.random.choice(['L5','L7','L8','S2'], n_shorelines).tolist(),
+          'geoaccuracy': np.random.uniform(3, 10, n_shorelines).tolist(),
+          'cloud_cover': np.random.uniform(0, 0.5, n_shorelines).tolist()}
+print('%d shorelines of %d points' % (n_shorelines, n_points))
+
+#%% 2. Original loop (on a subset of the shorelines, extrapolated)
+
+def output_to_gdf_loop(output, n):
+    # same as the original SDS_tools.output_to_gdf, with pd.concat instead of the
+    # removed GeoDataFrame.append
+    for i in range(n):
+        geom = geometry.LineString(output['shorelines'][i])
+        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
+        gdf.index = [i]
+        gdf.loc[i,'date'] = output['dates'][i].strftime('%Y-%m-%d %H:%M:%S')
+        gdf.loc[i,'satname'] = output['satname'][i]
+        gdf.loc[i,'geoaccuracy'] = output['geoaccuracy'][i]
+        gdf.loc[i,'cloud_cover'] = output['cloud_cover'][i]
+        if i == 0:
+            gdf_all = gdf
+        else:
+            gdf_all = pd.concat([gdf_all, gdf])
+    return gdf_all
+
+# the loop is quadratic, time two subsets and extrapolate with a quadratic fit
+n_subsets = [500, 1000]
+t_subsets = []
+for n in n_subsets:
+    t0 = time.time()
+    gdf_loop = output_to_gdf_loop(output, n)
+    t_subsets.append(time.time() - t0)
+coefs = np.polyfit(n_subsets + [0], t_subsets + [0], 2)
+t_loop = np.polyval(coefs, n_shorelines)
+print('original loop: %.0f s (extrapolated from %d shorelines)' % (t_loop, n_subsets[-1]))
+
+#%% 3. Bulk conversion
+
+for geomtype in ['lines', 'points']:
+    t0 = time.time()
+    gdf = SDS_tools.output_to_gdf(output, geomtype)
+    t_bulk = time.time() - t0
+    print('bulk conversion (%s): %.2f s' % (geomtype, t_bulk))
+
+# check that the GeoDataFrames are the same
+gdf = SDS_tools.output_to_gdf(output, 'lines')
+n = n_subsets[-1]
+print('same geometries: %s' % all(gdf.geometry.iloc[i].equals(gdf_loop.geometry.iloc[i]) for i in range(n)))
+print('same attributes: %s' % np.all(gdf['date'].values[:n] == gdf_loop['date'].values))
+
+#%% 4. Transects
+
+transects = dict([(str(i+1), output['shorelines'][i][[0,-1],:]) for i in range(n_shorelines)])
+t0 = time.time()
+gdf_transects = SDS_tools.transects_to_gdf(transects)
+print('transects_to_gdf: %.2f s for %d transects' % (time.time() - t0, len(gdf_transects)))
@@ -0,0 +1,95 @@
+#==========================================================#
+# Benchmark of the shoreline/transect intersections
+#==========================================================#
+
+# Compares NOC_transects.intersect_points (grid index, vectorized) with the loop over
+# the transects of the original SDS_transects.compute_intersection, on a synthetic
+# 500 km coastline with 10,000 transects every 50 m.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_intersection.py
+
+#%% 1. Synthetic shorelines and transects
+
+# load modules
+import time
+import numpy as np
+from coastsat import NOC_transects
+
+np.random.seed(0)
+
+n_transects = 10000
+spacing = 50            # alongshore spacing of the transects [m]
+point_spacing = 10      # spacing of the shoreline points [m]
+n_shorelines = 5
+along_dist = 25
+
+# wavy coastline along the X axis, origins 200 m landward of the mean shoreline
+x_transects = np.arange(n_transects)*spacing
+def coast(x):
+    return 300*np.sin(x/5000) + 50*np.sin(x/700)
+slope = np.gradient(coast(x_transects), x_transects)
+normals = np.array([-slope, np.ones(len(slope))]).T
+normals = normals/np.linalg.norm(normals, axis=1)[:,None]
+origins = np.array([x_transects, coast(x_transects) - 200]).T
+ends = origins + 500*normals
+
+x_sl = np.arange(0, x_transects[-1], point_spacing, dtype=float)
+shorelines = [np.array([x_sl, coast(x_sl) + np.random.normal(0, 10) +
+                        np.random.normal(0, 3, len(x_sl))]).T for _ in range(n_shorelines)]
+print('%d transects, %d shorelines of %d points' % (n_transects, n_shorelines, len(x_sl)))
+
+#%% 2. Original loop (on a subset of the transects, extrapolated)
+
+def intersect_loop(sl, origins, ends, along_dist):
+    # same computations as the original SDS_transects.compute_intersection
+    intersections = np.zeros(len(origins))
+    for j in range(len(origins)):
+        X0, Y0 = origins[j]
+        temp = ends[j] - origins[j]
+        phi = np.arctan2(temp[1], temp[0])
+        Mrot = np.array([[np.cos(phi), np.sin(phi)],[-np.sin(phi), np.cos(phi)]])
+        p1 = origins[j]
+        p2 = ends[j]
+        d_line = np.abs(np.cross(p2-p1,sl-p1)/np.linalg.norm(p2-p1))
+        d_origin = np.array([np.linalg.norm(sl[k,:] - p1) for k in range(len(sl))])
+        idx_dist = np.logical_and(d_line <= along_dist, d_origin <= 1000)
+        temp_sl = sl - p1
+        phi_sl = np.array([np.arctan2(temp_sl[k,1], temp_sl[k,0]) for k in range(len(temp_sl))])
+        idx_angle = np.abs(phi - phi_sl) < np.pi/2
+        idx_close = np.where(np.logical_and(idx_dist,idx_angle))[0]
+        if len(idx_close) == 0:
+            intersections[j] = np.nan
+        else:
+            xy_close = np.array([sl[idx_close,0],sl[idx_close,1]]) - np.tile(np.array([[X0],
+                               [Y0]]), (1,len(sl[idx_close])))
+            xy_rot = np.matmul(Mrot, xy_close)
+            intersections[j] = np.nanmedian(xy_rot[0,:])
+    return intersections
+
+n_subset = 20
+t0 = time.time()
+loop_subset = intersect_loop(shorelines[0], origins[:n_subset], ends[:n_subset], along_dist)
+t_loop = (time.time() - t0)/n_subset*n_transects*n_shorelines
+print('original loop: %.0f s (extrapolated from %d transects)' % (t_loop, n_subset))
+
+#%% 3. Grid index
+
+t0 = time.time()
+intersections = np.array([NOC_transects.intersect_points(sl, origins, ends, along_dist)
+                          for sl in shorelines])
+t_grid = time.time() - t0
+print('grid index: %.2f s (%.0fx faster)' % (t_grid, t_loop/t_grid))
+
+# check that the intersections are the same
+diff = np.abs(intersections[0,:n_subset] - loop_subset)
+print('max difference with the loop: %.2e m' % np.nanmax(diff))
+
+#%% 4. Exact segment intersections (intersection_mode = 'segments')
+
+t0 = time.time()
+intersections_seg = np.array([NOC_transects.intersect_segments(sl, origins, ends, 'seaward')
+                              for sl in shorelines])
+t_seg = time.time() - t0
+print('segment intersections: %.2f s' % t_seg)
+# the median of the noisy points and the exact crossing of the polyline are close
+print('median difference with the grid index: %.2f m' %
+      np.nanmedian(np.abs(intersections_seg - intersections)))
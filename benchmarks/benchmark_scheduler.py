@@ -0,0 +1,71 @@
+#==========================================================#
+# Benchmark of the download scheduler
+#==========================================================#
+
+# Downloads the composites of a matrix of 5 sites x 4 periods x 2 satellite missions from a
+# local fake Earth Engine server (tests/fake_ee.py) that answers each request in 0.5 s and
+# rejects the requests beyond 4 at the same time (HTTP 429), like the quotas of Earth
+# Engine. Compares the sequential downloads, a naive pool of 16 threads and NOC_scheduler
+# (token bucket, bounded in-flight requests, exponential backoff with jitter). Runs offline.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_scheduler.py
+
+#%% 1. Fake Earth Engine server
+
+# load modules
+import time
+import functools
+import numpy as np
+from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from coastsat import NOC_scheduler
+from tests import fake_ee
+
+np.random.seed(0)
+
+sites = ['site%d' % i for i in range(5)]
+periods = ['%d' % year for year in range(2016, 2020)]
+satnames = ['L8', 'S2']
+files = dict([('/%s_%s_%s.zip' % (site, period, satname), np.random.bytes(100000))
+              for site in sites for period in periods for satname in satnames])
+print('%d composites to download' % len(files))
+
+def download(server, path):
+    # one composite (raises urllib.error.HTTPError 429 when the quota is exceeded)
+    with urlopen(server.url(path), timeout=60) as response:
+        return len(response.read())
+
+#%% 2. Sequential, naive pool and scheduler
+
+def run(name, func):
+    with fake_ee.DownloadServer(files, delay=0.5, max_concurrent=4) as server:
+        t0 = time.time()
+        results = func(server)
+        n_ok = sum([1 for _ in results if isinstance(_, int)])
+        print('%s: %.1f s, %d/%d downloaded, %d requests rejected by the server' %
+              (name, time.time() - t0, n_ok, len(files), server.n_rejected))
+
+def sequential(server):
+    return [download(server, path) for path in files.keys()]
+
+def naive_pool(server):
+    def try_download(path):
+        try:
+            return download(server, path)
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(try_download, files.keys()))
+
+def scheduler(server, max_in_flight):
+    tasks = [functools.partial(download, server, path) for path in files.keys()]
+    metrics = NOC_scheduler.Metrics()
+    results = NOC_scheduler.run_tasks(tasks, max_in_flight=max_in_flight, rate=8, base_delay=0.5,
+                                      metrics=metrics, verbose=False)
+    print('    %s' % dict([(key, round(value, 2)) for key, value in metrics.summary().items()]))
+    return results
+
+run('sequential', sequential)
+run('naive pool of 16 threads', naive_pool)
+run('scheduler (4 in flight)', functools.partial(scheduler, max_in_flight=4))
+# more requests in flight than the quota: the rejected requests are retried with backoff
+run('scheduler (8 in flight)', functools.partial(scheduler, max_in_flight=8))
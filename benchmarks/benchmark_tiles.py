@@ -0,0 +1,89 @@
+#==========================================================#
+# Benchmark of the tiled downloads of large regions
+#==========================================================#
+
+# Downloads the 30 m bands of a Landsat composite over a region of ~300 km2 (larger than the
+# ~100 km2 limit of the Earth Engine downloads) in tiles from a local HTTP stand-in for the
+# Earth Engine download URLs (tests/fake_ee.py), one tile after the other and with several
+# tiles at the same time, and checks that the mosaic has the pixels and the
+# georeferencing of the whole composite. Runs offline.
+# Run from the root of the repository: PYTHONPATH=. python benchmarks/benchmark_tiles.py
+
+#%% 1. Tiles of the composite
+
+# load modules
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from osgeo import gdal
+from coastsat import NOC_download
+from tests import fake_ee
+
+np.random.seed(0)
+
+delay = 2           # time Earth Engine takes to prepare each download [s]
+scale = 30
+bands = ['blue', 'green', 'red', 'nir', 'swir1', 'BQA']
+polygon = [[[151.3, -33.7],[151.5, -33.7],[151.5, -33.85],[151.3, -33.85],[151.3, -33.7]]]
+fn = 'L8_site_median_S20190101_E20191231.tif'
+
+def geotiff_bytes(im, georef):
+    # content of an uncompressed GeoTiff with the bands of im (like the Earth Engine downloads)
+    fn = '/vsimem/%d.tif' % np.random.randint(1e9)
+    ds = gdal.GetDriverByName('GTiff').Create(fn, im.shape[1], im.shape[0], im.shape[2],
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform(georef)
+    for k in range(im.shape[2]):
+        ds.GetRasterBand(k+1).WriteArray(im[:,:,k])
+    ds = None
+    f = gdal.VSIFOpenL(fn, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    content = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(fn)
+    return content
+
+print('Region of %.0f km2' % NOC_download.bbox_area(polygon))
+tiles = NOC_download.tile_grid(polygon, scale, tile_area=100)
+nx = sum([tile['dimensions'][0] for tile in tiles if tile['row'] == 0])
+ny = sum([tile['dimensions'][1] for tile in tiles if tile['col'] == 0])
+# whole composite, on the pixel grid of the tiles (crs_transform of the first tile)
+composite = np.cumsum(np.random.uniform(0, 0.001, (ny, nx, len(bands))), axis=1).astype(np.float32)
+georef = tiles[0]['crs_transform']
+georef = [georef[2], georef[0], 0, georef[5], 0, georef[4]]
+files = dict([])
+for tile in tiles:
+    # position of the tile in the composite
+    i = sum([_['dimensions'][1] for _ in tiles if _['col'] == 0 and _['row'] < tile['row']])
+    j = sum([_['dimensions'][0] for _ in tiles if _['row'] == 0 and _['col'] < tile['col']])
+    im = composite[i:i+tile['dimensions'][1], j:j+tile['dimensions'][0]]
+    t = tile['crs_transform']
+    name = '/data_%dm_r%d_c%d.zip' % (scale, tile['row'], tile['col'])
+    files[name] = fake_ee.make_zip({'data.tif': geotiff_bytes(im, [t[2], t[0], 0, t[5], 0, t[4]])})
+print('%d tiles of %d x %d pixels at most' % (len(tiles), tiles[0]['dimensions'][0],
+                                               tiles[0]['dimensions'][1]))
+
+#%% 2. Tiles downloaded one after the other and at the same time
+
+with fake_ee.DownloadServer(files, delay) as server:
+    image = fake_ee.Image(server)
+    for n_workers in [1, 6]:
+        filepath = tempfile.mkdtemp()
+        t0 = time.time()
+        path = NOC_download.download_bands(image, polygon, [(scale, filepath, bands)], fn,
+                                           n_workers, tile_area=100)[0]
+        print('%d worker(s): %.1f s, %d downloads at the same time' %
+              (n_workers, time.time() - t0, server.max_in_flight))
+        # check the mosaic (same pixels and georeferencing, no temporary files left)
+        ds = gdal.Open(path)
+        im = np.stack([ds.GetRasterBand(k+1).ReadAsArray() for k in range(ds.RasterCount)], 2)
+        same = np.array_equal(im, composite)
+        same_georef = np.allclose(ds.GetGeoTransform(), georef, rtol=0, atol=1e-12)
+        ds = None
+        print('    mosaic: pixels %s, georeferencing %s, files in folder: %s' %
+              ('ok' if same else 'WRONG', 'ok' if same_georef else 'WRONG', os.listdir(filepath)))
+        shutil.rmtree(filepath)
@@ -0,0 +1,155 @@
+"""
+This module contains the planner of the download footprints of overlapping sites: the
+polygons of the sites (e.g. the boxes of coordinate_list along the coast) are indexed in
+an STRtree and the overlapping or adjacent sites are merged into a set of footprints, so
+that the shared pixels are downloaded once per period and satellite mission and the
+composite of each site is cropped locally from the composite of its footprint (see
+NOC_download.retrieve_footprints).
+
+Two groups of sites are merged only if the bounding box of the merged group is not larger
+than the bounding boxes of the two groups together, so that merging never downloads more
+pixels than downloading the groups separately.
+"""
+
+# load modules
+import hashlib
+import numpy as np
+
+# other modules
+from shapely import geometry
+from shapely.strtree import STRtree
+
+# CoastSat modules
+from coastsat import NOC_georef
+
+###################################################################################################
+# BOUNDING BOXES
+###################################################################################################
+
+def polygon_bounds(polygon):
+    "bounding box (xmin, ymin, xmax, ymax) of a lon/lat polygon of the inputs"
+    coords = np.array(polygon, dtype=float).reshape(-1, 2)
+    return (float(coords[:,0].min()), float(coords[:,1].min()), float(coords[:,0].max()),
+            float(coords[:,1].max()))
+
+def bounds_to_polygon(bounds):
+    "closed lon/lat polygon of a bounding box, in the format of inputs['polygon']"
+    xmin, ymin, xmax, ymax = [float(_) for _ in bounds]
+    return [[[xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin], [xmin, ymax]]]
+
+def _merge_bounds(b1, b2):
+    return (min(b1[0], b2[0]), min(b1[1], b2[1]), max(b1[2], b2[2]), max(b1[3], b2[3]))
+
+def _area(bounds):
+    return (bounds[2] - bounds[0])*(bounds[3] - bounds[1])
+
+def area_km2(bounds):
+    "approximate area of a lon/lat bounding box in km2"
+    lat = np.radians((bounds[1] + bounds[3])/2)
+    return _area(bounds)*NOC_georef.KM_PER_DEGREE**2*np.cos(lat)
+
+def _query(tree, boxes, geom):
+    "indices of the boxes of the STRtree that intersect geom (shapely 1.x and 2.x)"
+    result = tree.query(geom)
+    if len(result) > 0 and not isinstance(result[0], geometry.base.BaseGeometry):
+        # shapely 2 returns the indices
+        return [int(_) for _ in result]
+    ids = dict([(id(box), k) for k, box in enumerate(boxes)])
+    return [ids[id(_)] for _ in result]
+
+###################################################################################################
+# FOOTPRINTS
+###################################################################################################
+
+def plan_footprints(sites, gap=0, max_area=None):
+    """
+    Merges the overlapping or adjacent sites into download footprints. The bounding boxes
+    of the sites are indexed in an STRtree, the candidate pairs are the boxes that
+    intersect (or are closer than gap degrees), and two groups are merged if the bounding
+    box of the merged group is not larger than the sum of the bounding boxes of the two
+    groups and not larger than max_area km2 (repeated until no group can be merged).
+
+    Arguments:
+    -----------
+    sites: list of dict
+        inputs of each site with the keys 'sitename' and 'polygon'
+    gap: float
+        distance in degrees below which two sites are considered adjacent
+    max_area: float
+        maximum area of a footprint in km2 (no maximum if None), large footprints are
+        downloaded in tiles (see NOC_download.download_bands)
+
+    Returns:
+    -----------
+    footprints: list of dict
+        'name': name of the footprint (from the names of its sites, always the same for
+        the same sites)
+        'bounds': bounding box of the footprint (xmin, ymin, xmax, ymax)
+        'polygon': polygon of the bounding box, in the format of inputs['polygon']
+        'sites': indices of the sites of the footprint in sites
+        'area_saved': fraction of the area of the sites that is not downloaded twice
+
+    """
+
+    bounds = [polygon_bounds(site['polygon']) for site in sites]
+    boxes = [geometry.box(*b).buffer(gap/2, join_style=2) if gap > 0 else geometry.box(*b)
+             for b in bounds]
+    tree = STRtree(boxes)
+    # candidate pairs of neighbouring sites
+    neighbours = [set([j for j in _query(tree, boxes, box) if not j == i])
+                  for i, box in enumerate(boxes)]
+
+    # groups of sites (union-find on the index of the first site of each group)
+    group = list(range(len(sites)))
+    group_bounds = dict([(i, bounds[i]) for i in range(len(sites))])
+    group_neighbours = dict([(i, set(neighbours[i])) for i in range(len(sites))])
+
+    def find(i):
+        while not group[i] == i:
+            group[i] = group[group[i]]
+            i = group[i]
+        return i
+
+    merged = True
+    while merged:
+        merged = False
+        for i in sorted(group_bounds.keys()):
+            if not i in group_bounds:
+                continue
+            for j in sorted(set([find(_) for _ in group_neighbours[i]]) - set([i])):
+                b = _merge_bounds(group_bounds[i], group_bounds[j])
+                if max_area is not None and area_km2(b) > max_area:
+                    continue
+                if _area(b) <= _area(group_bounds[i]) + _area(group_bounds[j]) + 1e-12:
+                    # merge j into i
+                    group[j] = i
+                    group_bounds[i] = b
+                    group_neighbours[i] |= group_neighbours.pop(j)
+                    del group_bounds[j]
+                    merged = True
+
+    footprints = []
+    for i in sorted(group_bounds.keys()):
+        members = [k for k in range(len(sites)) if find(k) == i]
+        names = ','.join(sorted([sites[k]['sitename'] for k in members]))
+        area_sites = sum([_area(bounds[k]) for k in members])
+        footprints.append({'name': 'FP_' + hashlib.sha1(names.encode('utf-8')).hexdigest()[:10],
+                           'bounds': group_bounds[i],
+                           'polygon': bounds_to_polygon(group_bounds[i]),
+                           'sites': members,
+                           'area_saved': 1 - _area(group_bounds[i])/area_sites
+                                         if area_sites > 0 else 0})
+
+    return footprints
+
+def print_footprints(footprints, sites):
+    "prints the sites of each footprint and the area that is not downloaded twice"
+    area_sites = sum([_area(polygon_bounds(site['polygon'])) for site in sites])
+    area_footprints = sum([_area(_['bounds']) for _ in footprints])
+    print('%d sites merged into %d download footprints, %.0f%% less area to download' %
+          (len(sites), len(footprints), 100*(1 - area_footprints/area_sites)
+           if area_sites > 0 else 0))
+    for footprint in footprints:
+        if len(footprint['sites']) > 1:
+            print('  %s: %s' % (footprint['name'], ', '.join([sites[k]['sitename']
+                                                              for k in footprint['sites']])))
@@ -0,0 +1,170 @@
+"""
+This module contains a persistent cache (SQLite) for the results of the Earth Engine queries
+(number of images, CRS, co-registration reference images), so that re-running
+NOC_download.retrieve_images for the same site, period and settings does not repeat the
+queries, and the metadata can be rebuilt offline.
+
+The results are stored as JSON, keyed by a hash of the polygon, dates, satellite mission and
+of the settings that change the result of the queries.
+"""
+
+# load modules
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from contextlib import closing
+
+# settings that change the results of the queries
+QUERY_SETTINGS = ['LCloudScore', 'LCloudThreshold', 'add_L7_to_L5', 'add_L5_to_L7',
+                  'add_L7_to_L8', 'coregistration', 'CLOUD_FILTER', 'CLD_PRB_THRESH',
+                  'NIR_DRK_THRESH', 'CLD_PRJ_DIST', 'BUFFER']
+
+###################################################################################################
+# KEYS
+###################################################################################################
+
+def query_key(kind, inputs, settings, satname):
+    """
+    Canonical hash of a query: the same polygon (to 1e-6 degrees), dates, satellite
+    mission(s) and query settings always give the same key, whatever the order of the keys
+    of the dicts or the type of the numbers.
+
+    Arguments:
+    -----------
+    kind: str
+        type of query (e.g. 'composite' or 'available')
+    inputs: dict
+        input parameters (polygon, dates)
+    settings: dict
+        settings of the composites, only the keys in QUERY_SETTINGS are used
+    satname: str or list of str
+        satellite mission(s)
+
+    Returns:
+    -----------
+    key: str
+        SHA-256 of the query
+
+    """
+
+    params = {'kind': kind,
+              'polygon': np.round(np.array(inputs['polygon'], dtype=float), 6).tolist(),
+              'dates': [str(_) for _ in inputs['dates']],
+              'satname': satname if isinstance(satname, str) else list(satname),
+              'settings': dict([(key, settings[key]) for key in QUERY_SETTINGS
+                                if key in settings.keys()])}
+    params = json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+###################################################################################################
+# CACHE
+###################################################################################################
+
+class QueryCache(object):
+    """
+    Persistent cache of query results in a SQLite file. The entries older than ttl days
+    are ignored (and replaced by the next query).
+
+    Arguments:
+    -----------
+    fn: str
+        path of the SQLite file (created if it does not exist)
+    ttl: float
+        time-to-live of the entries in days, if None the entries never expire
+
+    """
+
+    def __init__(self, fn, ttl=None):
+        self.fn = fn
+        self.ttl = ttl
+        if os.path.dirname(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute('CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, '
+                        'value TEXT, description TEXT, created REAL)')
+
+    def _connect(self):
+        # one connection per call, so that the cache can be used from several threads
+        return sqlite3.connect(self.fn, timeout=60)
+
+    def get(self, key):
+        """
+        Returns the result of a query, or None if it is not in the cache or has expired.
+        """
+        with closing(self._connect()) as con:
+            row = con.execute('SELECT value, created FROM queries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl*86400:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, description=''):
+        """
+        Stores the result of a query (any value that can be converted to JSON).
+        """
+        with closing(self._connect()) as con, con:
+            con.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                        (key, json.dumps(value), description, time.time()))
+
+    def invalidate(self, key=None, older_than=None):
+        """
+        Deletes entries of the cache: one entry (key), the entries older than older_than
+        days, or all the entries if both are None.
+
+        Returns:
+        -----------
+        n: int
+            number of deleted entries
+
+        """
+        with closing(self._connect()) as con, con:
+            if key is not None:
+                cursor = con.execute('DELETE FROM queries WHERE key = ?', (key,))
+            elif older_than is not None:
+                cursor = con.execute('DELETE FROM queries WHERE created < ?',
+                                     (time.time() - older_than*86400,))
+            else:
+                cursor = con.execute('DELETE FROM queries')
+        return cursor.rowcount
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with closing(self._connect()) as con:
+            return con.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+
+def get_cache(inputs, settings):
+    """
+    Opens the cache of the Earth Engine queries, by default in the data folder
+    (ee_cache.sqlite), shared by all the sites.
+
+    Arguments:
+    -----------
+    inputs: dict
+        input parameters (filepath)
+    settings: dict with the following keys
+        'cache': bool or str (optional)
+            False to disable the cache, or path of the SQLite file (default True)
+        'cache_ttl': float (optional)
+            time-to-live of the entries in days (default None, never expire)
+
+    Returns:
+    -----------
+    cache: QueryCache
+        the cache, or None if it is disabled
+
+    """
+
+    fn = settings.get('cache', True)
+    if fn is False or fn is None:
+        return None
+    if fn is True:
+        fn = os.path.join(inputs['filepath'], 'ee_cache.sqlite')
+
+    return QueryCache(fn, settings.get('cache_ttl', None))
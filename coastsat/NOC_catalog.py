@@ -0,0 +1,345 @@
+"""
+This module contains the catalog of the downloaded composites: a SQLite file in the data
+folder (catalog.sqlite) with one row per composite (site, satellite mission, dates, epsg,
+number of images, paths and checksums of the GeoTiffs, settings of the download), written
+by NOC_download when a composite is downloaded.
+
+The metadata dict of a site (as returned by NOC_download.get_metadata) is read with a
+single query instead of parsing the .txt files of the meta folders, and the composites of
+all the sites can be queried at once (e.g. all the S2 composites of 2018). The offsets of
+the local co-registration of the Landsat composites (see NOC_coreg) are stored in a second
+table for quality control.
+"""
+
+# load modules
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from contextlib import closing
+
+# satellite missions, in the order of the metadata dict
+SATNAMES = ['L5', 'L7', 'L8', 'S2']
+# columns of the composites table
+COLUMNS = ['sitename', 'satname', 'filename', 'start_date', 'end_date', 'epsg', 'median_no',
+           'paths', 'checksums', 'settings', 'created']
+# columns of the coregistration table (offsets of the local co-registration, see NOC_coreg)
+COREG_COLUMNS = ['sitename', 'satname', 'filename', 'reference', 'model', 'dx', 'dy', 'coefs',
+                 'n_tiles', 'n_inliers', 'rmse', 'updated', 'created']
+
+###################################################################################################
+# CHECKSUMS
+###################################################################################################
+
+def file_checksum(fn, chunk_size=2**20):
+    "SHA-256 of a file, read by chunks"
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+###################################################################################################
+# CATALOG
+###################################################################################################
+
+class Catalog(object):
+    """
+    Catalog of the composites of all the sites of a data folder, in a SQLite file.
+
+    Arguments:
+    -----------
+    fn: str
+        path of the SQLite file (created if it does not exist)
+
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        if os.path.dirname(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute('CREATE TABLE IF NOT EXISTS composites (sitename TEXT, satname TEXT, '
+                        'filename TEXT, start_date TEXT, end_date TEXT, epsg INTEGER, '
+                        'median_no INTEGER, paths TEXT, checksums TEXT, settings TEXT, '
+                        'created REAL, PRIMARY KEY (sitename, satname, filename))')
+            con.execute('CREATE INDEX IF NOT EXISTS composites_dates ON composites '
+                        '(satname, start_date, end_date)')
+            con.execute('CREATE TABLE IF NOT EXISTS coregistration (sitename TEXT, '
+                        'satname TEXT, filename TEXT, reference TEXT, model TEXT, dx REAL, '
+                        'dy REAL, coefs TEXT, n_tiles INTEGER, n_inliers INTEGER, rmse REAL, '
+                        'updated INTEGER, created REAL, '
+                        'PRIMARY KEY (sitename, satname, filename))')
+
+    def _connect(self):
+        # one connection per call, so that the catalog can be used from several threads
+        return sqlite3.connect(self.fn, timeout=60)
+
+    def add(self, sitename, satname, metadict, paths=None, settings=None, checksums=True):
+        """
+        Records a composite (replaces the previous record of the same file and removes
+        its co-registration offsets).
+
+        Arguments:
+        -----------
+        sitename: str
+            name of the site
+        satname: str
+            satellite mission
+        metadict: dict
+            metadata of the composite, with the keys 'filename', 'epsg', 'start_date',
+            'end_date' and 'median_no' (as in the .txt file)
+        paths: list of str
+            paths of the GeoTiffs of the composite (relative to the data folder)
+        settings: dict
+            settings of the download (any value that can be converted to JSON)
+        checksums: bool
+            if True, the SHA-256 of the GeoTiffs is stored
+
+        """
+
+        paths = [] if paths is None else list(paths)
+        folder = os.path.dirname(self.fn)
+        values = [file_checksum(os.path.join(folder, _)) if checksums and
+                  os.path.exists(os.path.join(folder, _)) else None for _ in paths]
+        with closing(self._connect()) as con, con:
+            con.execute('INSERT OR REPLACE INTO composites VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                        (sitename, satname, metadict['filename'], str(metadict['start_date']),
+                         str(metadict['end_date']), int(metadict['epsg']),
+                         int(metadict['median_no']), json.dumps(paths), json.dumps(values),
+                         json.dumps(settings, default=str), time.time()))
+            # a new composite is not co-registered
+            con.execute('DELETE FROM coregistration WHERE sitename = ? AND satname = ? AND '
+                        'filename = ?', (sitename, satname, metadict['filename']))
+
+    def remove(self, sitename, satname=None, filename=None):
+        """
+        Deletes the records of a site (of a satellite mission or of a single file).
+
+        Returns:
+        -----------
+        n: int
+            number of deleted records
+
+        """
+        query = 'DELETE FROM composites WHERE sitename = ?'
+        params = [sitename]
+        if satname is not None:
+            query += ' AND satname = ?'
+            params.append(satname)
+        if filename is not None:
+            query += ' AND filename = ?'
+            params.append(filename)
+        with closing(self._connect()) as con, con:
+            cursor = con.execute(query, params)
+            con.execute(query.replace('composites', 'coregistration'), params)
+        return cursor.rowcount
+
+    def filenames(self, sitename, satname):
+        "names of the composites of a site and satellite mission in the catalog"
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT filename FROM composites WHERE sitename = ? AND '
+                               'satname = ?', (sitename, satname)).fetchall()
+        return set([_[0] for _ in rows])
+
+    def get_metadata(self, sitename, satnames=None):
+        """
+        Metadata of the composites of a site, in the format of NOC_download.get_metadata,
+        with a single query.
+
+        Arguments:
+        -----------
+        sitename: str
+            name of the site
+        satnames: list of str
+            satellite missions (all by default)
+
+        Returns:
+        -----------
+        metadata: dict
+            for each satellite mission, lists of 'filenames', 'epsg', 'start_date',
+            'end_date' and 'median_no' sorted by filename (chronologically)
+
+        """
+
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT satname, filename, epsg, start_date, end_date, median_no '
+                               'FROM composites WHERE sitename = ? ORDER BY satname, filename',
+                               (sitename,)).fetchall()
+        metadata = dict([])
+        for satname in SATNAMES:
+            sat_rows = [_ for _ in rows if _[0] == satname]
+            if len(sat_rows) == 0 or (satnames is not None and not satname in satnames):
+                continue
+            metadata[satname] = {'filenames': [_[1] for _ in sat_rows],
+                                 'epsg': [_[2] for _ in sat_rows],
+                                 'start_date': [_[3] for _ in sat_rows],
+                                 'end_date': [_[4] for _ in sat_rows],
+                                 'median_no': [_[5] for _ in sat_rows]}
+
+        return metadata
+
+    def query(self, sitenames=None, satnames=None, dates=None):
+        """
+        Composites of all the sites, filtered by site, satellite mission and dates.
+
+        Arguments:
+        -----------
+        sitenames: list of str
+            names of the sites (all by default)
+        satnames: list of str
+            satellite missions (all by default)
+        dates: list of str
+            start and end dates 'yyyy-mm-dd', only the composites that overlap this period
+            are returned (e.g. ['2018-01-01', '2018-12-31'])
+
+        Returns:
+        -----------
+        composites: list of dict
+            one dict per composite with the keys of COLUMNS (paths, checksums and settings
+            decoded), sorted by site, satellite mission and filename
+
+        """
+
+        query = 'SELECT %s FROM composites WHERE 1' % ', '.join(COLUMNS)
+        params = []
+        if sitenames is not None:
+            query += ' AND sitename IN (%s)' % ','.join(['?']*len(sitenames))
+            params += list(sitenames)
+        if satnames is not None:
+            query += ' AND satname IN (%s)' % ','.join(['?']*len(satnames))
+            params += list(satnames)
+        if dates is not None:
+            query += ' AND start_date <= ? AND end_date >= ?'
+            params += [str(dates[1]), str(dates[0])]
+        query += ' ORDER BY sitename, satname, filename'
+        with closing(self._connect()) as con:
+            rows = con.execute(query, params).fetchall()
+        composites = []
+        for row in rows:
+            composite = dict(zip(COLUMNS, row))
+            for key in ['paths', 'checksums', 'settings']:
+                composite[key] = json.loads(composite[key])
+            composites.append(composite)
+
+        return composites
+
+    def verify(self, sitename):
+        """
+        Checks the GeoTiffs of the composites of a site against their checksums.
+
+        Returns:
+        -----------
+        problems: list of str
+            paths of the GeoTiffs that are missing or have changed
+
+        """
+        folder = os.path.dirname(self.fn)
+        problems = []
+        for composite in self.query(sitenames=[sitename]):
+            for path, checksum in zip(composite['paths'], composite['checksums']):
+                fn = os.path.join(folder, path)
+                if not os.path.exists(fn):
+                    problems.append('%s: missing' % path)
+                elif checksum is not None and not file_checksum(fn) == checksum:
+                    problems.append('%s: checksum differs' % path)
+        return problems
+
+    def update_checksums(self, sitename, satname, filename):
+        "records again the checksums of the GeoTiffs of a composite (e.g. after an update)"
+        folder = os.path.dirname(self.fn)
+        composite = self.query(sitenames=[sitename], satnames=[satname])
+        composite = [_ for _ in composite if _['filename'] == filename]
+        if len(composite) == 0:
+            return
+        values = [file_checksum(os.path.join(folder, _)) if
+                  os.path.exists(os.path.join(folder, _)) else None for _ in composite[0]['paths']]
+        with closing(self._connect()) as con, con:
+            con.execute('UPDATE composites SET checksums = ? WHERE sitename = ? AND satname = ? '
+                        'AND filename = ?', (json.dumps(values), sitename, satname, filename))
+
+    def add_coregistration(self, result):
+        """
+        Records the offsets of the local co-registration of a composite (replaces the
+        previous record of the same composite).
+
+        Arguments:
+        -----------
+        result: dict
+            result of NOC_coreg.coregister_composite, with the keys of COREG_COLUMNS
+            (except 'created')
+
+        """
+
+        values = [result[key] for key in COREG_COLUMNS[:-1]]
+        values[COREG_COLUMNS.index('coefs')] = json.dumps(result['coefs'])
+        values[COREG_COLUMNS.index('updated')] = int(result['updated'])
+        with closing(self._connect()) as con, con:
+            con.execute('INSERT OR REPLACE INTO coregistration VALUES (%s)' %
+                        ','.join(['?']*len(COREG_COLUMNS)), values + [time.time()])
+
+    def get_coregistration(self, sitenames=None):
+        """
+        Offsets of the local co-registration of the composites (see add_coregistration).
+
+        Arguments:
+        -----------
+        sitenames: list of str
+            names of the sites (all by default)
+
+        Returns:
+        -----------
+        results: list of dict
+            one dict per composite with the keys of COREG_COLUMNS, sorted by site,
+            satellite mission and filename
+
+        """
+
+        query = 'SELECT %s FROM coregistration' % ', '.join(COREG_COLUMNS)
+        params = []
+        if sitenames is not None:
+            query += ' WHERE sitename IN (%s)' % ','.join(['?']*len(sitenames))
+            params += list(sitenames)
+        query += ' ORDER BY sitename, satname, filename'
+        with closing(self._connect()) as con:
+            rows = con.execute(query, params).fetchall()
+        results = []
+        for row in rows:
+            result = dict(zip(COREG_COLUMNS, row))
+            result['coefs'] = json.loads(result['coefs'])
+            result['updated'] = bool(result['updated'])
+            results.append(result)
+
+        return results
+
+    def sitenames(self):
+        "names of the sites in the catalog"
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT DISTINCT sitename FROM composites ORDER BY sitename')
+            return [_[0] for _ in rows.fetchall()]
+
+    def __len__(self):
+        with closing(self._connect()) as con:
+            return con.execute('SELECT COUNT(*) FROM composites').fetchone()[0]
+
+def get_catalog(filepath):
+    """
+    Opens the catalog of the composites of a data folder (catalog.sqlite), shared by all
+    the sites.
+
+    Arguments:
+    -----------
+    filepath: str
+        data folder (inputs['filepath'])
+
+    Returns:
+    -----------
+    catalog: Catalog
+
+    """
+
+    return Catalog(os.path.join(filepath, 'catalog.sqlite'))
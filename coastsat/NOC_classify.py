@@ -1,5 +1,5 @@
 from coastsat.SDS_classify import *
-from coastsat import NOC_shoreline
+from coastsat import NOC_shoreline, NOC_indices
 
 
 def label_images_4classes(metadata, settings):
@@ -63,8 +63,9 @@ def label_images_4classes(metadata, settings):
                 continue
             # get individual RGB image
             im_RGB = SDS_preprocess.rescale_image_intensity(im_ms[:, :, [2, 1, 0]], cloud_mask, 99.9)
-            im_NDVI = SDS_tools.nd_index(im_ms[:, :, 3], im_ms[:, :, 2], cloud_mask)
-            im_NDWI = SDS_tools.nd_index(im_ms[:, :, 3], im_ms[:, :, 1], cloud_mask)
+            # spectral indices, also reused for the features of the labelled pixels
+            indices = NOC_indices.SpectralIndices(im_ms, cloud_mask)
+            im_NDVI, im_NDWI = indices.compute(['NIR-R', 'NIR-G'])
             # initialise labels
             im_viz = im_RGB.copy()
             im_labels = np.zeros([im_RGB.shape[0], im_RGB.shape[1]])
@@ -313,7 +314,7 @@ def label_images_4classes(metadata, settings):
                 features = dict([])
                 for key in settings['labels'].keys():
                     im_bool = im_labels == settings['labels'][key]
-                    features[key] = SDS_shoreline.calculate_features(im_ms, cloud_mask, im_bool)
+                    features[key] = SDS_shoreline.calculate_features(im_ms, cloud_mask, im_bool, indices)
                 training_data = {'labels': im_labels, 'features': features, 'label_ids': settings['labels']}
                 with open(os.path.join(fp, filename + '.pkl'), 'wb') as f:
                     pickle.dump(training_data, f)
@@ -499,8 +500,9 @@ def label_images_5classes(metadata, settings):
                 continue
             # get individual RGB image
             im_RGB = SDS_preprocess.rescale_image_intensity(im_ms[:, :, [2, 1, 0]], cloud_mask, 99.9)
-            im_NDVI = SDS_tools.nd_index(im_ms[:, :, 3], im_ms[:, :, 2], cloud_mask)
-            im_NDWI = SDS_tools.nd_index(im_ms[:, :, 3], im_ms[:, :, 1], cloud_mask)
+            # spectral indices, also reused for the features of the labelled pixels
+            indices = NOC_indices.SpectralIndices(im_ms, cloud_mask)
+            im_NDVI, im_NDWI = indices.compute(['NIR-R', 'NIR-G'])
             # initialise labels
             im_viz = im_RGB.copy()
             im_labels = np.zeros([im_RGB.shape[0], im_RGB.shape[1]])
@@ -749,7 +751,7 @@ def label_images_5classes(metadata, settings):
                 features = dict([])
                 for key in settings['labels'].keys():
                     im_bool = im_labels == settings['labels'][key]
-                    features[key] = SDS_shoreline.calculate_features(im_ms, cloud_mask, im_bool)
+                    features[key] = SDS_shoreline.calculate_features(im_ms, cloud_mask, im_bool, indices)
                 training_data = {'labels': im_labels, 'features': features, 'label_ids': settings['labels']}
                 with open(os.path.join(fp, filename + '.pkl'), 'wb') as f:
                     pickle.dump(training_data, f)
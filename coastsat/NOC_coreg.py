@@ -0,0 +1,500 @@
+"""
+This module contains the local co-registration of the Landsat composites with the
+Sentinel-2 composites of the same site, once both are downloaded: the Sentinel-2 composite
+is averaged onto the pixel grid of the Landsat composite, the shifts between the two are
+estimated tile by tile with FFT phase correlation on a common band (nir), a translation
+or an affine transformation is fitted to the shifts of the tiles with a robust fit, and
+the geotransform of the GeoTiffs of the Landsat composite is updated (the pixels are not
+resampled). The sites are processed in parallel and the offsets are stored in the catalog
+of the composites (see NOC_catalog) for quality control.
+"""
+
+# load modules
+import os
+import functools
+import numpy as np
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+
+# other modules (osgeo is imported in the functions that read and write the GeoTiffs, so
+# that the estimation of the shifts does not need GDAL)
+
+# CoastSat modules
+from coastsat import NOC_io, NOC_catalog, NOC_georef
+
+# index of the GeoTiff with the common band in the paths of each composite (the 30 m or ms
+# GeoTiff for Landsat, the 10 m GeoTiff for Sentinel-2, see NOC_download.composite_paths)
+COREG_FILE = {'L5': 0, 'L7': 1, 'L8': 1, 'S2': 0}
+# index of the common band in that GeoTiff (nir)
+COREG_BAND = {'L5': 3, 'L7': 3, 'L8': 3, 'S2': 3}
+# parameters of the estimation of the shifts (see estimate_shifts and fit_model)
+COREG_PARAMS = {'tile_size': 64,       # size of the tiles in Landsat pixels
+                'step': 32,            # distance between the tiles in pixels
+                'min_valid': 0.9,      # minimum fraction of valid pixels in a tile
+                'min_peak': 0.5,       # minimum height of the phase correlation peak
+                'max_shift': 3,        # maximum shift in pixels
+                'lowpass': 0.25,       # frequencies kept in the phase correlation
+                'upsample': 20,        # precision of the shifts (1/upsample pixel)
+                'eps': 0.01,           # regularisation of the cross-power spectrum
+                'max_iter': 10,        # maximum number of iterations per tile
+                'min_tiles': 3}        # minimum number of tiles to fit a model
+
+###################################################################################################
+# PHASE CORRELATION
+###################################################################################################
+
+def _upsampled_correlation(R, upsample, size, offset):
+    "inverse DFT of the cross-power spectrum on a size x size grid at 1/upsample pixel"
+    n, m = R.shape
+    ky = np.fft.ifftshift(np.arange(n) - n//2)
+    kx = np.fft.ifftshift(np.arange(m) - m//2)
+    y = (np.arange(size) - size//2)/upsample + offset[0]
+    x = (np.arange(size) - size//2)/upsample + offset[1]
+    ey = np.exp(2j*np.pi*np.outer(y, ky)/n)
+    ex = np.exp(2j*np.pi*np.outer(kx, x)/m)
+    return np.real(ey.dot(R).dot(ex))
+
+def phase_correlation(ref, im, upsample=20, lowpass=0.25, eps=0.01):
+    """
+    Shift between two images of the same size with FFT phase correlation: the peak of the
+    normalised cross-power spectrum is found on the pixel grid and refined to 1/upsample
+    pixel with a local upsampled DFT (Guizar-Sicairos et al., 2008). The images are
+    windowed (Hann) and only the frequencies below lowpass cycles per pixel are kept,
+    which reduces the effect of the noise and of the different sensors. The spectrum is
+    normalised by |R| + eps*max|R| so that the weak frequencies of smooth scenes do not
+    dominate. The window biases the shift towards 0 when it is not small compared to the
+    tiles, see estimate_shifts for the iterative correction.
+
+    Arguments:
+    -----------
+    ref: np.array
+        2D reference image
+    im: np.array
+        2D image, im(p) = ref(p - shift)
+    upsample: int
+        precision of the shift (1/upsample pixel)
+    lowpass: float
+        maximum frequency in cycles per pixel (0.5 keeps all the frequencies)
+    eps: float
+        regularisation of the normalisation relative to the strongest frequency (0 for
+        the classic phase correlation)
+
+    Returns:
+    -----------
+    shift: tuple
+        (rows, columns) shift of im relative to ref in pixels
+    peak: float
+        height of the correlation peak (1 for identical images, about 0 if unrelated)
+
+    """
+
+    window = np.outer(np.hanning(ref.shape[0]), np.hanning(ref.shape[1]))
+    F_ref = np.fft.fft2((ref - np.mean(ref))*window)
+    F_im = np.fft.fft2((im - np.mean(im))*window)
+    R = F_im*np.conj(F_ref)
+    R = R/np.maximum(np.abs(R) + eps*np.max(np.abs(R)), 1e-12)
+    freq = np.hypot(np.fft.fftfreq(R.shape[0])[:,None], np.fft.fftfreq(R.shape[1])[None,:])
+    R[freq > lowpass] = 0
+    # normalised so that the peak of identical images is 1
+    corr = np.real(np.fft.ifft2(R))/max(np.mean(np.abs(R)), 1e-12)
+    i, j = np.unravel_index(np.argmax(corr), corr.shape)
+    peak = corr[i, j]
+    n, m = corr.shape
+    shift = [i - n if i > n//2 else i, j - m if j > m//2 else j]
+    # refine around the peak
+    size = 3*upsample
+    corr_up = _upsampled_correlation(R, upsample, size, shift)
+    k, l = np.unravel_index(np.argmax(corr_up), corr_up.shape)
+
+    return (shift[0] + (k - size//2)/upsample, shift[1] + (l - size//2)/upsample), peak
+
+def estimate_shifts(ref, im, tile_size=64, step=32, min_valid=0.9, min_peak=0.5, max_shift=3,
+                    lowpass=0.25, upsample=20, eps=0.01, max_iter=10):
+    """
+    Shifts between two images on the same pixel grid, tile by tile (see
+    phase_correlation). The shift of each tile is refined iteratively: the tile of im is
+    resampled (cubic spline) by minus the shift found so far and the residual shift is
+    estimated again, until it is smaller than 1/upsample pixel, which removes the bias of
+    the window. The tiles with too many invalid pixels (nan or 0), without texture, with a
+    low correlation peak or a shift larger than max_shift are discarded.
+
+    Arguments:
+    -----------
+    ref, im: np.array
+        2D images on the same grid
+    tile_size, step: int
+        size of the tiles and distance between their origins in pixels
+    min_valid: float
+        minimum fraction of valid pixels in a tile (the others are filled with the mean)
+    min_peak: float
+        minimum height of the correlation peak
+    max_shift: float
+        maximum shift in pixels
+    lowpass, upsample, eps: float
+        parameters of phase_correlation
+    max_iter: int
+        maximum number of iterations per tile
+
+    Returns:
+    -----------
+    tiles: np.array
+        (n, 5) array with the row and column of the centre of each tile (in the pixel
+        coordinates of the geotransform, the top-left corner of the image at 0), the row
+        and column shift of im relative to ref and the height of the peak
+
+    """
+
+    tiles = []
+    valid = np.isfinite(ref) & np.isfinite(im) & (ref != 0) & (im != 0)
+    # im with a margin, to resample the tiles without reading outside of them
+    margin = int(np.ceil(max_shift)) + 3
+    im_pad = np.pad(np.where(valid, im, 0), margin, 'edge')
+    valid_pad = np.pad(valid, margin, 'edge')
+    n_rows = max(ref.shape[0] - tile_size, 0)//step + 1
+    n_cols = max(ref.shape[1] - tile_size, 0)//step + 1
+    for row in range(n_rows):
+        for col in range(n_cols):
+            win = (slice(row*step, row*step + tile_size), slice(col*step, col*step + tile_size))
+            mask = valid[win]
+            if mask.size < tile_size**2 or np.mean(mask) < min_valid:
+                continue
+            ref_tile = np.where(mask, ref[win], np.mean(ref[win][mask]))
+            im_tile = np.where(mask, im[win], np.mean(im[win][mask]))
+            if np.std(ref_tile) == 0 or np.std(im_tile) == 0:
+                continue
+            shift, peak = phase_correlation(ref_tile, im_tile, upsample, lowpass, eps)
+            # iterative refinement on the tile with its margin
+            win_pad = (slice(row*step, row*step + tile_size + 2*margin),
+                       slice(col*step, col*step + tile_size + 2*margin))
+            im_big = np.where(valid_pad[win_pad], im_pad[win_pad], np.mean(im[win][mask]))
+            shift = np.array(shift)
+            for k in range(max_iter - 1):
+                if np.hypot(*shift) > max_shift:
+                    break
+                im_tile = ndimage.shift(im_big, -shift, order=3, mode='nearest')
+                im_tile = im_tile[margin:-margin,margin:-margin]
+                residual, peak = phase_correlation(ref_tile, im_tile, upsample, lowpass, eps)
+                shift = shift + residual
+                if np.hypot(*residual) < 1/upsample:
+                    break
+            if peak < min_peak or np.hypot(*shift) > max_shift:
+                continue
+            tiles.append([row*step + tile_size/2, col*step + tile_size/2,
+                          shift[0], shift[1], peak])
+
+    return np.array(tiles).reshape(-1, 5)
+
+###################################################################################################
+# ROBUST FIT
+###################################################################################################
+
+def fit_model(tiles, model='translation', n_iter=5, n_sigma=3, min_tiles=3):
+    """
+    Robust fit of the shifts of the tiles (see estimate_shifts): the tiles whose residual
+    is larger than n_sigma times the robust standard deviation (1.4826 MAD) are removed
+    and the model is fitted again (weighted by the height of the peaks).
+
+    Arguments:
+    -----------
+    tiles: np.array
+        (n, 5) array of estimate_shifts
+    model: str
+        'translation' (same shift everywhere) or 'affine' (shift linear in the row and
+        column, at least 6 tiles, otherwise a translation is fitted)
+    n_iter: int
+        number of iterations
+    n_sigma: float
+        threshold of the outliers
+    min_tiles: int
+        minimum number of tiles
+
+    Returns:
+    -----------
+    fit: dict or None
+        'model': model fitted
+        'coefs': (2, 3) array, shift = coefs.dot([1, row, column]) for the rows and columns
+        'inliers': boolean array of the tiles kept
+        'rmse': root mean square residual of the inliers in pixels
+        None if there are not enough tiles
+
+    """
+
+    if len(tiles) < min_tiles:
+        return None
+    if model == 'affine' and len(tiles) < 6:
+        model = 'translation'
+    if model == 'translation':
+        X = np.ones((len(tiles), 1))
+    elif model == 'affine':
+        X = np.column_stack([np.ones(len(tiles)), tiles[:,0], tiles[:,1]])
+    else:
+        raise Exception('Unknown co-registration model %s' % model)
+    Y = tiles[:,2:4]
+    weights = tiles[:,4]
+    inliers = np.ones(len(tiles), dtype=bool)
+    # start from the median shift (robust to the outliers)
+    residuals = Y - np.median(Y, axis=0)
+    for k in range(n_iter):
+        dist = np.hypot(residuals[:,0], residuals[:,1])
+        sigma = max(1.4826*np.median(dist[inliers]), 0.05)
+        inliers = dist <= n_sigma*sigma
+        if np.sum(inliers) < max(min_tiles, X.shape[1]):
+            return None
+        w = np.sqrt(weights[inliers])[:,None]
+        beta = np.linalg.lstsq(X[inliers]*w, Y[inliers]*w, rcond=None)[0]
+        residuals = Y - X.dot(beta)
+    coefs = np.zeros((2, 3))
+    coefs[:, :X.shape[1]] = beta.T
+    rmse = np.sqrt(np.mean(np.sum(residuals[inliers]**2, axis=1)))
+
+    return {'model': model, 'coefs': coefs, 'inliers': inliers, 'rmse': float(rmse)}
+
+def corrected_geotransform(georef, coefs, georef_fit=None):
+    """
+    Geotransform of a GeoTiff corrected with the shifts of a fit (see fit_model): the
+    pixel (row, column) of the fitted grid shows the ground at (row, column) - shift, so
+    the corrected pixel-to-world transformation is the previous one after this
+    correction. The correction is applied in world coordinates, so that the other
+    GeoTiffs of the composite (e.g. the 15 m panchromatic band) are corrected with the
+    same fit.
+
+    Arguments:
+    -----------
+    georef: tuple
+        geotransform of the GeoTiff to correct
+    coefs: np.array
+        (2, 3) coefficients of the fit
+    georef_fit: tuple
+        geotransform of the grid of the fit (default georef)
+
+    Returns:
+    -----------
+    georef: list
+        corrected geotransform
+
+    """
+
+    georef_fit = georef if georef_fit is None else georef_fit
+    G = NOC_georef.Affine(georef_fit).matrix
+    # pixel correction in (column, row) homogeneous coordinates
+    M = np.array([[1 - coefs[1,2], -coefs[1,1], -coefs[1,0]],
+                  [-coefs[0,2], 1 - coefs[0,1], -coefs[0,0]],
+                  [0, 0, 1]])
+    T = G.dot(M).dot(np.linalg.inv(G))
+    A = T.dot(NOC_georef.Affine(georef).matrix)
+
+    return [A[0,2], A[0,0], A[0,1], A[1,2], A[1,0], A[1,1]]
+
+###################################################################################################
+# COMPOSITES
+###################################################################################################
+
+def _read_band(ds, k):
+    "band k (from 0) of a dataset as float, with the scale factor applied"
+    return NOC_io.read_bands(ds)[k].astype(float)
+
+def reference_on_grid(fn_ref, ds):
+    """
+    Band of the Sentinel-2 composite averaged onto the pixel grid of a Landsat composite
+    (in memory, the files are not modified).
+    """
+    from osgeo import gdal
+    src = gdal.Open(fn_ref)
+    if src is None:
+        raise Exception('Could not read %s' % fn_ref)
+    mem = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize, 1,
+                                             gdal.GDT_Float32)
+    mem.SetGeoTransform(ds.GetGeoTransform())
+    mem.SetProjection(ds.GetProjection())
+    k = COREG_BAND['S2']
+    band = src.GetRasterBand(k + 1)
+    # one band of the reference, with its scale factor
+    vrt = gdal.Translate('', src, format='VRT', bandList=[k + 1], outputType=gdal.GDT_Float32,
+                         unscale=band.GetScale() is not None and not band.GetScale() == 1)
+    gdal.ReprojectImage(vrt, mem, None, None, gdal.GRA_Average)
+    im = mem.GetRasterBand(1).ReadAsArray().astype(float)
+    src = None; vrt = None; mem = None
+    return im
+
+def coregister_composite(filepath, composite, reference, model='translation', params=None,
+                         update=True):
+    """
+    Co-registers the GeoTiffs of a Landsat composite with a Sentinel-2 composite of the
+    same site (see estimate_shifts and fit_model) and updates their geotransform.
+
+    Arguments:
+    -----------
+    filepath: str
+        data folder (with the catalog)
+    composite: dict
+        Landsat composite (row of NOC_catalog.Catalog.query)
+    reference: dict
+        Sentinel-2 composite
+    model: str
+        'translation' or 'affine' (the affine geotransforms have rotation terms, which
+        are not supported by the pansharpening of SDS_preprocess)
+    params: dict
+        parameters of the estimation (default COREG_PARAMS)
+    update: bool
+        if False, the offsets are estimated but the GeoTiffs are not modified
+
+    Returns:
+    -----------
+    result: dict
+        'sitename', 'satname', 'filename', 'reference': composites
+        'model', 'coefs': fit (None if not enough tiles)
+        'dx', 'dy': correction at the centre of the composite in metres (east, north)
+        'n_tiles', 'n_inliers', 'rmse': tiles used and residual in pixels
+        'updated': True if the geotransforms were updated
+
+    """
+
+    from osgeo import gdal
+
+    params = dict(COREG_PARAMS, **(params or dict([])))
+    fns = [os.path.join(filepath, _) for _ in composite['paths']]
+    # the shifts are estimated on the grid of the GeoTiff with the common band
+    fn_grid = fns[COREG_FILE[composite['satname']]]
+    ds = gdal.Open(fn_grid)
+    if ds is None:
+        raise Exception('Could not read %s' % fn_grid)
+    georef = ds.GetGeoTransform()
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    im = _read_band(ds, COREG_BAND[composite['satname']])
+    ref = reference_on_grid(os.path.join(filepath, reference['paths'][COREG_FILE['S2']]), ds)
+    ds = None
+
+    tiles = estimate_shifts(ref, im, **dict([(key, params[key]) for key in
+                                             ['tile_size', 'step', 'min_valid', 'min_peak',
+                                              'max_shift', 'lowpass', 'upsample', 'eps',
+                                              'max_iter']]))
+    fit = fit_model(tiles, model, min_tiles=params['min_tiles'])
+    result = {'sitename': composite['sitename'], 'satname': composite['satname'],
+              'filename': composite['filename'], 'reference': reference['filename'],
+              'model': None, 'coefs': None, 'dx': None, 'dy': None, 'n_tiles': len(tiles),
+              'n_inliers': 0, 'rmse': None, 'updated': False}
+    if fit is None:
+        return result
+
+    # correction at the centre of the composite in metres
+    centre = [shape[1]/2, shape[0]/2]
+    new_georef = corrected_geotransform(georef, fit['coefs'])
+    before = NOC_georef.Affine(georef).matrix.dot(centre + [1])
+    after = NOC_georef.Affine(new_georef).matrix.dot(centre + [1])
+    m_per_degree = 1000*NOC_georef.KM_PER_DEGREE
+    result.update({'model': fit['model'], 'coefs': fit['coefs'].tolist(),
+                   'dx': (after[0] - before[0])*m_per_degree*np.cos(np.radians(before[1])),
+                   'dy': (after[1] - before[1])*m_per_degree,
+                   'n_inliers': int(np.sum(fit['inliers'])), 'rmse': fit['rmse']})
+
+    if update:
+        for fn in fns:
+            ds = gdal.Open(fn, gdal.GA_Update)
+            if ds is None:
+                raise Exception('Could not update %s' % fn)
+            ds.SetGeoTransform(corrected_geotransform(ds.GetGeoTransform(), fit['coefs'], georef))
+            ds = None
+        result['updated'] = True
+
+    return result
+
+def _closest_reference(composite, references):
+    "Sentinel-2 composite of the same site that overlaps most (or is the closest in time)"
+    def days(date):
+        return np.datetime64(str(date)[:10], 'D').astype(int)
+    start, end = days(composite['start_date']), days(composite['end_date'])
+    def score(ref):
+        overlap = min(end, days(ref['end_date'])) - max(start, days(ref['start_date']))
+        return overlap if overlap >= 0 else overlap*1e6
+    candidates = [_ for _ in references if _['sitename'] == composite['sitename']]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=score)
+
+def coregister_sites(filepath, sitenames=None, satnames=['L5', 'L7', 'L8'], model='translation',
+                     params=None, n_workers=4, overwrite=False, update=True):
+    """
+    Co-registers the Landsat composites of the catalog with the Sentinel-2 composites of
+    their site (the one that overlaps most in time, see coregister_composite), with one
+    process per composite, and stores the offsets in the catalog (table coregistration,
+    see NOC_catalog.Catalog.add_coregistration). The checksums of the updated GeoTiffs
+    are recorded again.
+
+    Arguments:
+    -----------
+    filepath: str
+        data folder (inputs['filepath'])
+    sitenames: list of str
+        sites to co-register (all by default)
+    satnames: list of str
+        Landsat missions to co-register
+    model: str
+        'translation' or 'affine'
+    params: dict
+        parameters of the estimation (see COREG_PARAMS)
+    n_workers: int
+        number of processes
+    overwrite: bool
+        if False, the composites already co-registered are skipped, if True they are
+        co-registered again (the new correction is applied on top of the previous one)
+    update: bool
+        if False, the offsets are only estimated and stored
+
+    Returns:
+    -----------
+    results: list of dict
+        result of each composite (see coregister_composite)
+
+    """
+
+    catalog = NOC_catalog.get_catalog(filepath)
+    composites = catalog.query(sitenames, satnames)
+    references = catalog.query(sitenames, ['S2'])
+    done = set([(_['sitename'], _['satname'], _['filename']) for _ in
+                catalog.get_coregistration(sitenames) if _['updated']])
+    jobs = []
+    for composite in composites:
+        if not overwrite and (composite['sitename'], composite['satname'],
+                              composite['filename']) in done:
+            continue
+        reference = _closest_reference(composite, references)
+        if reference is None:
+            print('%s: no Sentinel-2 composite of %s, not co-registered' %
+                  (composite['filename'], composite['sitename']))
+            continue
+        jobs.append((composite, reference))
+    print('Co-registration of %d composites' % len(jobs))
+
+    results = []
+    func = functools.partial(_coregister_job, filepath, model=model, params=params,
+                             update=update)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for (composite, reference), result in zip(jobs, executor.map(func, jobs)):
+            if isinstance(result, Exception):
+                print('%s: co-registration failed (%s)' % (composite['filename'], result))
+                continue
+            catalog.add_coregistration(result)
+            if result['updated']:
+                catalog.update_checksums(composite['sitename'], composite['satname'],
+                                         composite['filename'])
+            print_result(result)
+            results.append(result)
+
+    return results
+
+def _coregister_job(filepath, job, model, params, update):
+    "coregister_composite in a worker process, the exceptions are returned"
+    try:
+        return coregister_composite(filepath, job[0], job[1], model, params, update)
+    except Exception as e:
+        return e
+
+def print_result(result):
+    "prints the offsets of a composite"
+    if result['model'] is None:
+        print('%s: not enough tiles (%d), not co-registered' % (result['filename'],
+                                                                 result['n_tiles']))
+        return
+    print('%s: dx = %.1f m, dy = %.1f m (%s, %d/%d tiles, rmse %.2f px)' %
+          (result['filename'], result['dx'], result['dy'], result['model'],
+           result['n_inliers'], result['n_tiles'], result['rmse']))
@@ -11,10 +11,14 @@ import numpy as npypers
 import matplotlib.pyplot as plt
 import pdb
 import numpy as np
+import threading
+import functools
+import json
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 # earth engine modules
 import ee
-from urllib.request import urlretrieve
-import zipfile
 import copy
 from datetime import date
 from dateutil.relativedelta import *
@@ -29,11 +33,72 @@ from scipy import ndimage
 
 # CoastSat modules
 #from coastsat import SDS_preprocess, SDS_tools, gdal_merge
+from coastsat import NOC_io, NOC_cache, NOC_scheduler, NOC_aoi, NOC_catalog, NOC_georef
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
-
-def check_images_available(inputs):
+# quality bands (bit masks), stored as integers without scale factor in the compact composites
+QA_BANDS = ['BQA', 'QA60']
+# scale factor of the reflectances stored as integers in the compact composites (the
+# Sentinel-2 bands are already scaled by 10000 in GEE and divided at read time)
+REFLECTANCE_SCALE = {'L5': 10000, 'L7': 10000, 'L8': 10000, 'S2': 1}
+
+# settings of the download recorded in the catalog of the composites
+DOWNLOAD_SETTINGS = NOC_cache.QUERY_SETTINGS + ['coregistration_mode', 'reducer', 'compact_storage',
+                                                'compression']
+
+# bands of the Landsat TOA collections and their common names in the composites
+LC8_BANDS = ['B2',   'B3',    'B4',  'B5',  'B6',    'B7',    'B10', 'BQA'] ## Landsat 8
+LC7_BANDS = ['B1',   'B2',    'B3',  'B4',  'B5',    'B7',    'B6_VCID_2','BQA'] ## Landsat 7
+LC5_BANDS = ['B1',   'B2',    'B3',  'B4',  'B5',    'B7',    'B6', 'BQA'] ## Landsat 5
+STD_NAMES = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'temp', 'BQA']
+
+# EE collections of the satellite missions
+COLLECTIONS = {'L5': 'LANDSAT/LT05/C01/T1_TOA',
+               'L7': 'LANDSAT/LE07/C01/T1_TOA',
+               'L8': 'LANDSAT/LC08/C01/T1_TOA',
+               'S2': 'COPERNICUS/S2'}
+
+# recipes of the composites (see build_composite): the collections ('sources') merged in the
+# composite, each with its cloud strategy ('landsat': simpleCloudScore, 's2cloudless'),
+# if its pixels are masked, its bands and their names in the composite, and the setting
+# that adds it to the composite; the bands reduced separately and added to the composite
+# ('extra_bands', from the masked collection of a source)
+RECIPES = {
+    'L5': {'sources': [{'satname': 'L5', 'cloud': 'landsat', 'mask': False,
+                        'bands': LC5_BANDS, 'names': STD_NAMES},
+                       {'satname': 'L7', 'cloud': 'landsat', 'mask': False,
+                        'bands': LC7_BANDS, 'names': STD_NAMES, 'setting': 'add_L7_to_L5'}],
+           'extra_bands': []},
+    'L7': {'sources': [{'satname': 'L7', 'cloud': 'landsat', 'mask': True,
+                        'bands': LC7_BANDS, 'names': STD_NAMES},
+                       {'satname': 'L5', 'cloud': 'landsat', 'mask': False,
+                        'bands': LC5_BANDS, 'names': STD_NAMES, 'setting': 'add_L5_to_L7'}],
+           'extra_bands': [{'satname': 'L7', 'bands': ['B8'], 'names': ['pan']}]},
+    'L8': {'sources': [{'satname': 'L8', 'cloud': 'landsat', 'mask': True,
+                        'bands': LC8_BANDS + ['B8'], 'names': STD_NAMES + ['pan']},
+                       {'satname': 'L7', 'cloud': 'landsat', 'mask': True,
+                        'bands': LC7_BANDS + ['B8'], 'names': STD_NAMES + ['pan']}],
+           'extra_bands': []},
+    # Landsat 8 without Landsat 7 (settings['add_L7_to_L8'] False), original band names
+    'L8_only': {'sources': [{'satname': 'L8', 'cloud': 'landsat', 'mask': False,
+                             'bands': 'B.*', 'names': None}],
+                'extra_bands': []},
+    # the s2cloudless mask keeps the B.* bands
+    'S2': {'sources': [{'satname': 'S2', 'cloud': 's2cloudless', 'mask': True,
+                        'bands': None, 'names': None}],
+           'extra_bands': []},
+    }
+
+# number of bands of the GeoTiffs of a composite, in each folder of the satellite missions
+# (same order as the folders of create_folder_structure)
+COMPOSITE_BANDS = {'L5': [('30m', 6)],
+                   'L7': [('pan', 1), ('ms', 6)],
+                   'L8': [('pan', 1), ('ms', 6)],
+                   'S2': [('10m', 4), ('20m', 1), ('60m', 1)]}
+
+
+def check_images_available(inputs, cache=None):
     """
     Create the structure of subfolders for each satellite mission
      
@@ -43,6 +108,8 @@ def check_images_available(inputs):
     -----------
     inputs: dict 
         inputs dictionnary
+    cache: NOC_cache.QueryCache
+        cache of the query results (optional)
     
     Returns:
     -----------
@@ -68,21 +135,26 @@ def check_images_available(inputs):
     print('- In Landsat Tier 1 & Sentinel-2 Level-1C:')
     im_dict_T1 = dict([])
     sum_img = 0
+    # number of images in each EE collection (counted on the server)
+    col_sizes = dict([])
     for sat_list in inputs['sat_list']:
-        
-        # get list of images in EE collection
-        while True:
-            try:
-                ee_col = ee.ImageCollection(col_names_T1[sat_list])
-                col = ee_col.filterBounds(ee.Geometry.Polygon(inputs['polygon']))\
-                            .filterDate(inputs['dates'][0],inputs['dates'][1])
-                im_list = col.getInfo().get('features')
-                break
-            except:
-                continue
-        print('  %s: %d images'%(sat_list,len(im_list)))
+        ee_col = ee.ImageCollection(col_names_T1[sat_list])
+        col = ee_col.filterBounds(ee.Geometry.Polygon(inputs['polygon']))\
+                    .filterDate(inputs['dates'][0],inputs['dates'][1])
+        col_sizes[sat_list] = col.size()
+    # evaluate all the counts with a single request (unless they are in the cache)
+    key = NOC_cache.query_key('available', inputs, {}, inputs['sat_list'])
+    im_count = None if cache is None else cache.get(key)
+    if im_count is None:
+        # retry with an exponential backoff if the server is busy
+        im_count = NOC_scheduler.call_with_backoff(ee.Dictionary(col_sizes).getInfo)
+        if cache is not None:
+            cache.set(key, im_count, 'available %s %s' % (inputs['sat_list'], inputs['dates']))
+    for sat_list in inputs['sat_list']:
+        print('  %s: %d images'%(sat_list,im_count[sat_list]))
+        sum_img = sum_img + im_count[sat_list]
     
-        return im_dict_T1, sum_img
+    return im_dict_T1, sum_img
 
 def time_in_range(start, end, x):
     """
@@ -137,8 +209,10 @@ def get_s2_sr_cld_col(aoi, start_date, end_date, CLOUD_FILTER):
 
     Returns
     -------
-    TYPE
-        DESCRIPTION.
+    ee.ImageCollection
+        S2 collection joined with the s2cloudless images
+    ee.Number
+        number of images in the collection
 
     """
     # End date from user input range
@@ -166,12 +240,8 @@ def get_s2_sr_cld_col(aoi, start_date, end_date, CLOUD_FILTER):
         .filterBounds(aoi)
         .filterDate(start_date, end_date))
 
-    ##Print Images in Collection
-    #List Images in Collection
-    img_list = s2_sr_col.toList(500)
-    sum_img = len(img_list.getInfo())
-    print ('- Cloud minimal images in Median:')
-    print ('   S2: ' + str(sum_img))   
+    # Number of images in Collection (evaluated with the other metadata in get_composite_info)
+    sum_img = s2_sr_col.size()
 
     # Join the filtered s2cloudless collection to the SR collection by the 'system:index' property.
     return ee.ImageCollection(ee.Join.saveFirst('s2cloudless').apply(**{
@@ -188,550 +258,499 @@ def obtain_image_median(collection, time_range, area, satname, settings):
     """ Selection of median from a collection of images in the Earth Engine library
     See also: https://developers.google.com/earth-engine/reducers_image_collection
 
+    The composite is built from its recipe (see RECIPES and build_composite).
+
     Parameters:
         collection (): name of the collection
         time_range (['YYYY-MT-DY','YYYY-MT-DY']): must be inside the available data
         area (ee.geometry.Geometry): area of interest
         satname: Satellite inital; 'L7', 'L8' or 'S2'
         settings: Use of 'LCloudScore' - Mean cloud score value in image. Value 
-        between 1-100
+        between 1-100. Optional 'reducer' (see reduce_collection, default 'median')
 
     Returns:
         image_median (ee.image.Image)
+        counts (dict): number of images of each mission in the median (ee.Number, evaluated
+            with the other metadata of the composite by get_composite_info)
      """
-    collect = ee.ImageCollection(collection)
-    
-    #Set bands to be extracted
-    LC8_BANDS = ['B2',   'B3',    'B4',  'B5',  'B6',    'B7',    'B10', 'BQA'] ## Landsat 8
-    LC7_BANDS = ['B1',   'B2',    'B3',  'B4',  'B5',    'B7',    'B6_VCID_2','BQA'] ## Landsat 7
-    LC5_BANDS = ['B1',   'B2',    'B3',  'B4',  'B5',    'B7',    'B6', 'BQA'] ## Landsat 5
-    STD_NAMES = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'temp', 'BQA']
 
-    if satname == ['L5']:
-       ## Filter by time range and location
-       collection = (collect.filterDate(time_range[0], time_range[1])
-                     .filterBounds(area))
+    recipe = satname[0]
+    if recipe == 'L8' and settings['add_L7_to_L8'] == False:
+        recipe = 'L8_only'
 
-       def LandsatCloudScore(image):
-           """ Computes mean cloud score value in a single image in a collection
-           
-           """
-           # Compute a cloud score band.
-           cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-           cloudiness = cloud.reduceRegion(
-               reducer = 'mean',
-               geometry = area,
-               scale = 30)
-           return image.set(cloudiness)
-       
-       # Apply Cloud Score layer to each image, then filter collection
-       withCloudiness = collection.map(LandsatCloudScore)
-       filteredCollection = (withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore']))
-                             .select(LC5_BANDS, STD_NAMES))
-       
-       def LandsatCloudMask(image):
-            """
-            Creates cloud mask from Landsat Cloud Score and user defined threshold
-        
-            Parameters
-            ----------
-                image : image in image collection, defined using .map
-        
-            Returns
-            -------
-            masked : image array
-                Single masked image within a collection
-                
-            """    
-            # Compute a cloud score band.
-            cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-            cloudmask = cloud.lt(settings['LCloudThreshold'])
-            masked = image.updateMask(cloudmask)            
-            return masked
-       
-       # Apply cloud masking to all images within collection then select bands
-       maskedcollection = filteredCollection.map(LandsatCloudMask)
-       filteredCollection_masked = maskedcollection.select(LC7_BANDS, STD_NAMES)
-       
-       ##Print Images in Collection
-       #List Images in Collection
-       img_list = filteredCollection.toList(500)
-       img_count = len(img_list.getInfo())
-       print ('- Cloud minimal images in Median:')
-       print ('   L5: ' + str(img_count))       
-       
-       if settings['add_L7_to_L5'] == True:
+    return build_composite(recipe, time_range, area, settings, collection)
 
-           #Add Landsat 7 to Collection
-           collect = ee.ImageCollection('LANDSAT/LE07/C01/T1_TOA')           
-           ## Filter by time range and location
-           L7_collection = (collect.filterDate(time_range[0], time_range[1])
-                      .filterBounds(area))
+def landsat_collection(collection, time_range, area, settings):
+    """
+    Landsat images of a collection scored for clouds once per image: the cloud score of
+    ee.Algorithms.Landsat.simpleCloudScore is computed once and used both for the mean
+    cloud score of the image over the area (property 'cloud') and for the cloud mask
+    (band 'cloudmask', score below settings['LCloudThreshold']). The images with a mean
+    cloud score above settings['LCloudScore'] are removed.
 
-           def LandsatCloudScore(L7_image):
-                """ Computes mean cloud score value in a single image in a collection
-                
-                """
-                # Compute a cloud score band.
-                L7_cloud = ee.Algorithms.Landsat.simpleCloudScore(L7_image).select('cloud')
-                L7_cloudiness = L7_cloud.reduceRegion(
-                    reducer = 'mean',
-                    geometry = area,
-                    scale = 30)                
-                return L7_image.set(L7_cloudiness)
-
-           # Apply Cloud Score layer to each image, then filter collection            
-           L7_withCloudiness = L7_collection.map(LandsatCloudScore)
-           L7_filteredCollection = (L7_withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore']))
-                                    .select(LC7_BANDS, STD_NAMES))
-           def LandsatCloudMask(image):
-                """
-                Creates cloud mask from Landsat Cloud Score and user defined threshold
-            
-                Parameters
-                ----------
-                    image : image in image collection, defined using .map
-            
-                Returns
-                -------
-                masked : image array
-                    Single masked image within a collection
-                    
-                """    
-                # Compute a cloud score band.
-                cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-                cloudmask = cloud.lt(settings['LCloudThreshold'])
-                masked = image.updateMask(cloudmask)            
-                return masked
-       
-           # Apply cloud masking to all images within collection then select bands
-           maskedcollection = filteredCollection.map(LandsatCloudMask)
-           filteredCollection_masked = maskedcollection.select(LC7_BANDS, STD_NAMES) 
-           
-           ##Print Images in Collection
-           #List Images in Collection           
-           L7_img_list = L7_filteredCollection.toList(500)
-           L7_count = len(L7_img_list.getInfo())
-           print ('   L7: ' + str(L7_count))
-           
-           # Merge collection with Landsat 5
-           combined_collection = filteredCollection.merge(L7_filteredCollection)
-           image_median = combined_collection.median()
-           sum_img = img_count + L7_count
-           print ('   Total: ' + str(img_count + L7_count))
-                  
-       else:
-           #Take median of Collection
-           image_median = filteredCollection.median()
-           sum_img = img_count
-           print ('   Total: ' + str(img_count))
-       
-       return image_median, sum_img
- 
-    if satname == ['L7']:
-       ## Filter by time range and location
-       collection = (collect.filterDate(time_range[0], time_range[1])
-                     .filterBounds(area))
-
-       def LandsatCloudScore(image):
-            """ Computes mean cloud score value in a single image in a collection
-           
-            """
-            # Compute a cloud score band.
-            cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-            cloudiness = cloud.reduceRegion(
-                reducer = 'mean',
-                geometry = area,
-                scale = 30)
-            return image.set(cloudiness)
-        
-       # Apply Cloud Score layer to each image, then filter collection
-       withCloudiness = collection.map(LandsatCloudScore)
-       filteredCollection_no_pan = (withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore'])))     
+    Arguments:
+    -----------
+    collection: str
+        name of the Landsat TOA collection
+    time_range: list of str
+        start and end dates
+    area: ee.Geometry
+        area of interest
+    settings: dict
+        settings with the keys 'LCloudScore' and 'LCloudThreshold'
 
-       def LandsatCloudMask(image):
-            """
-            Creates cloud mask from Landsat Cloud Score and user defined threshold
-        
-            Parameters
-            ----------
-                image : image in image collection, defined using .map
-        
-            Returns
-            -------
-            masked : image array
-                Single masked image within a collection
-                
-            """    
-            # Compute a cloud score band.
-            cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-            cloudmask = cloud.lt(settings['LCloudThreshold'])
-            masked = image.updateMask(cloudmask)            
-            return masked
-       
-       # Apply cloud masking to all images within collection then select bands
-       maskedcollection = filteredCollection_no_pan.map(LandsatCloudMask)
-       filteredCollection_masked = maskedcollection.select(LC7_BANDS, STD_NAMES)
-       
-       ##Print Images in Collection
-       #List Images in Collection
-       img_list = filteredCollection_no_pan.toList(500)
-       img_count = len(img_list.getInfo())
-       print ('- Cloud minimal images in Median:')
-       print ('   L7: ' + str(img_count))       
-       
-       if settings['add_L5_to_L7'] == True:
-           
-           #Add Landsat 7 to Collection
-           collect = ee.ImageCollection('LANDSAT/LT05/C01/T1_TOA')           
-           ## Filter by time range and location
-           L5_collection = (collect.filterDate(time_range[0], time_range[1])
-                      .filterBounds(area))
-
-           def LandsatCloudScore(L5_image):
-                """ Computes mean cloud score value in a single image in a collection
-                
-                """
-                # Compute a cloud score band.
-                L5_cloud = ee.Algorithms.Landsat.simpleCloudScore(L5_image).select('cloud')
-                L5_cloudiness = L5_cloud.reduceRegion(
-                    reducer = 'mean',
-                    geometry = area,
-                    scale = 30)
-                
-                return L5_image.set(L5_cloudiness)
-            
-           L5_withCloudiness = L5_collection.map(LandsatCloudScore)
-           L5_filteredCollection = (L5_withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore']))
-                                    .select(LC5_BANDS, STD_NAMES))
-           ##Print Images in Collection
-           #List Images in Collection
-           L5_img_list = L5_filteredCollection.toList(500)
-           L5_count = len(L5_img_list.getInfo())
-           print ('   L5: ' + str(L5_count))
-           
-           def LandsatCloudMask(image):
-                """
-                Creates cloud mask from Landsat Cloud Score and user defined threshold
-            
-                Parameters
-                ----------
-                    image : image in image collection, defined using .map
-            
-                Returns
-                -------
-                masked : image array
-                    Single masked image within a collection
-                    
-                """    
-                # Compute a cloud score band.
-                cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-                cloudmask = cloud.lt(settings['LCloudThreshold'])
-                masked = image.updateMask(cloudmask)            
-                return masked
-
-           if L5_count > 0:
-               
-               # Apply cloud masking to all images within collection then select bands
-               maskedcollection = filteredCollection_no_pan.map(LandsatCloudMask)
-               filteredCollection_masked = maskedcollection.select(LC7_BANDS, STD_NAMES)
-                          
-               # Merge Collections
-               filteredCollection_masked = filteredCollection_masked.merge(L5_filteredCollection)
-               sum_img = img_count + L5_count
-               print ('   Total: ' + str(sum_img))
-           else:
-               sum_img = img_count
-               print ('   Total: ' + str(sum_img))
-               pass
-       else:
-           sum_img = img_count
-           print ('   Total: ' + str(sum_img))
-                            
-       # Take median of Collection
-       image_median_no_pan = filteredCollection_masked.median()
-                       
-       ## Add panchromatic band to collection from Landsat 7
-       # Add Panchromatic Band
-       panchromatic = ['B8']
-       panchromatic_name = ['pan']
-       filteredCollection_pan = (withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore'])))
-        
-       # Repeat masking process and take median
-       maskedcollection_pan = filteredCollection_pan.map(LandsatCloudMask)
-       filteredCollection_masked_pan = maskedcollection_pan.select(panchromatic, panchromatic_name)
-       img_median_pan = filteredCollection_masked_pan.median()
-        
-       # Combine multiplspectral and panchromatic bands
-       image_median = image_median_no_pan.addBands(img_median_pan)
-           
-       return image_median, sum_img
-   
-    if satname == ['L8']:
-       ## Filter by time range and location
-       L8_collection = (collect.filterDate(time_range[0], time_range[1])
-                     .filterBounds(area))
+    Returns:
+    -----------
+    collection: ee.ImageCollection
+        filtered images with the 'cloud' property and the 'cloudmask' band (see
+        landsat_cloud_mask)
 
-       def LandsatCloudScore(image):
-           """ Computes mean cloud score value in a single image in a collection
-           
-           """
-           # Compute a cloud score band.
-           L8_cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-           L8_cloudiness = L8_cloud.reduceRegion(
-               reducer = 'mean',
-               geometry = area,
-               scale = 30)
-           return image.set(L8_cloudiness)
-       
-       # Apply cloud masking to all images within collection then select bands       
-       L8_withCloudiness = L8_collection.map(LandsatCloudScore)
-       L8_filteredCollection = (L8_withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore'])))   
+    """
 
-       def LandsatCloudMask(image):
-             """
-             Creates cloud mask from Landsat Cloud Score and user defined threshold
-         
-             Parameters
-             ----------
-                 image : image in image collection, defined using .map
-         
-             Returns
-             -------
-             masked : image array
-                 Single masked image within a collection
-                 
-             """    
-             # Compute a cloud score band.
-             cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-             cloudmask = cloud.lt(settings['LCloudThreshold'])
-             masked = image.updateMask(cloudmask)            
-             return masked
-       
-        
-       ## Need to add panchromatic band to collection
-       #Add Panchromatic Band
-       panchromatic = ['B8']
-       panchromatic_name = ['pan']
-       
-       # Apply cloud masking to all images within collection then select bands
-       maskedcollection = L8_filteredCollection.map(LandsatCloudMask)
-       filteredCollection_masked = maskedcollection.select(LC8_BANDS + panchromatic , STD_NAMES + panchromatic_name)
-       
-       ##Print Images in Collection
-       #List Images in Collection
-       img_list = L8_filteredCollection.toList(500)
-       img_count = len(img_list.getInfo())
-       print ('- Cloud minimal images in Median:')
-       print ('   L8: ' + str(img_count))       
-       
-       if settings['add_L7_to_L8'] == True:
-           
-           #Add Landsat 7 to Collection
-           collect = ee.ImageCollection('LANDSAT/LE07/C01/T1_TOA')           
-           ## Filter by time range and location
-           L7_collection = (collect.filterDate(time_range[0], time_range[1])
-                      .filterBounds(area))
-
-           def LandsatCloudScore(L7_image):
-                """ Computes mean cloud score value in a single image in a collection
-                
-                """
-                # Compute a cloud score band.
-                L7_cloud = ee.Algorithms.Landsat.simpleCloudScore(L7_image).select('cloud')
-                L7_cloudiness = L7_cloud.reduceRegion(
-                    reducer = 'mean',
-                    geometry = area,
-                    scale = 30)
-                
-                return L7_image.set(L7_cloudiness)
-            
-           # Apply cloud masking to all images within collection then select bands       
-           L7_withCloudiness = L7_collection.map(LandsatCloudScore)
-           L7_filteredCollection = (L7_withCloudiness.filter(ee.Filter.lt('cloud', settings['LCloudScore'])))   
-                
-           def LandsatCloudMask(image):
-                 """
-                 Creates cloud mask from Landsat Cloud Score and user defined threshold
-             
-                 Parameters
-                 ----------
-                     image : image in image collection, defined using .map
-             
-                 Returns
-                 -------
-                 masked : image array
-                     Single masked image within a collection
-                     
-                 """    
-                 # Compute a cloud score band.
-                 cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
-                 cloudmask = cloud.lt(settings['LCloudThreshold'])
-                 masked = image.updateMask(cloudmask)            
-                 return masked
-           
-           # Apply cloud masking to all images within collection then select bands
-           maskedcollection = L7_filteredCollection.map(LandsatCloudMask)
-           L7_filteredCollection_masked = maskedcollection.select(LC7_BANDS + panchromatic, STD_NAMES + panchromatic_name)  
-           
-           ## Print Images in Collection
-           # List Images in Collection
-           L7_img_list = L7_filteredCollection.toList(500)
-           L7_count = len(L7_img_list.getInfo())
-           print ('   L7: ' + str(L7_count))
-           
-           # Merge Collections
-           L8_filteredCollection = filteredCollection_masked.merge(L7_filteredCollection_masked)
-           sum_img = img_count + L7_count
-           print ('   Total: ' + str(img_count + L7_count))
-                  
-       else:
-           sum_img = img_count
-           print ('   Total: ' + str(img_count))
-           pass
-       
-       #Take median of Collection
-       image_median = L8_filteredCollection.median()
+    def add_cloud_score(image):
+        # Compute a cloud score band (once per image)
+        cloud = ee.Algorithms.Landsat.simpleCloudScore(image).select('cloud')
+        cloudiness = cloud.reduceRegion(
+            reducer = 'mean',
+            geometry = area,
+            scale = 30)
+        cloudmask = cloud.lt(settings['LCloudThreshold']).rename('cloudmask')
+        return image.addBands(cloudmask).set(cloudiness)
 
-       
-       return image_median, sum_img
+    ## Filter by time range and location, score and filter by mean cloud score
+    scored = (ee.ImageCollection(collection).filterDate(time_range[0], time_range[1])
+              .filterBounds(area)
+              .map(add_cloud_score))
 
-    elif satname == ['S2']:
-        
-        def add_cloud_bands(img):
-            """
-            Cloud components
-            Define a function to add the s2cloudless probability layer and
-            derived cloud mask as bands to an S2 SR image input.
-        
-            Parameters
-            ----------
-            img : TYPE
-                DESCRIPTION.
-        
-            Returns
-            -------
-            TYPE
-                DESCRIPTION.
-        
-            """
-            # Get s2cloudless image, subset the probability band.
-            cld_prb = ee.Image(img.get('s2cloudless')).select('probability')
-        
-            # Condition s2cloudless by the probability threshold value.
-            is_cloud = cld_prb.gt(settings['CLD_PRB_THRESH']).rename('clouds')
-        
-            # Add the cloud probability layer and cloud mask as image bands.
-            return img.addBands(ee.Image([cld_prb, is_cloud]))
-        
-        def add_shadow_bands(img):
-            """
-            #### Cloud shadow components
-        
-            Define a function to add dark pixels, cloud projection, and identified
-            shadows as bands to an S2 SR image input. Note that the image input needs
-            to be the result of the above `add_cloud_bands` function because it
-            relies on knowing which pixels are considered cloudy (`'clouds'` band).
-        
-            Parameters
-            ----------
-            img : TYPE
-                DESCRIPTION.
-        
-            Returns
-            -------
-            TYPE
-                DESCRIPTION.
-        
-            """
-            # Identify water pixels from the SCL band.
-            not_water = img.select('SCL').neq(6)
-        
-            # Identify dark NIR pixels that are not water (potential cloud shadow pixels).
-            SR_BAND_SCALE = 1e4
-            dark_pixels = img.select('B8').lt(settings['NIR_DRK_THRESH']*SR_BAND_SCALE).multiply(not_water).rename('dark_pixels')
-        
-            # Determine the direction to project cloud shadow from clouds (assumes UTM projection).
-            shadow_azimuth = ee.Number(90).subtract(ee.Number(img.get('MEAN_SOLAR_AZIMUTH_ANGLE')));
-        
-            # Project shadows from clouds for the distance specified by the CLD_PRJ_DIST input.
-            cld_proj = (img.select('clouds').directionalDistanceTransform(shadow_azimuth, settings['CLD_PRJ_DIST']*10)
-                .reproject(**{'crs': img.select(0).projection(), 'scale': 100})
-                .select('distance')
-                .mask()
-                .rename('cloud_transform'))
-        
-            # Identify the intersection of dark pixels with cloud shadow projection.
-            shadows = cld_proj.multiply(dark_pixels).rename('shadows')
-        
-            # Add dark pixels, cloud projection, and identified shadows as image bands.
-            return img.addBands(ee.Image([dark_pixels, cld_proj, shadows]))
-        
-        def add_cld_shdw_mask(img):
-            """
-            #### Final cloud-shadow mask
-        
-            Define a function to assemble all of the cloud and cloud shadow components and produce the final mask.
-        
-            """
+    return scored.filter(ee.Filter.lt('cloud', settings['LCloudScore']))
+
+def landsat_cloud_mask(image):
+    "masks the cloudy pixels of an image of landsat_collection"
+    return image.updateMask(image.select('cloudmask'))
+
+def s2_cloud_functions(time_range, settings):
+    """
+    Functions mapped over the Sentinel-2 collection joined with s2cloudless (see
+    get_s2_sr_cld_col) to compute the cloud and shadow mask of each image and to apply it.
+
+    Arguments:
+    -----------
+    time_range: list of str
+        start and end dates of the composite (the shadows are only computed with the
+        surface reflectance images)
+    settings: dict
+        settings with the keys 'CLD_PRB_THRESH', 'NIR_DRK_THRESH', 'CLD_PRJ_DIST' and
+        'BUFFER'
+
+    Returns:
+    -----------
+    add_cld_shdw_mask, apply_cld_shdw_mask: functions
+
+    """
+
+    def add_cloud_bands(img):
+        """
+        Cloud components
+        Define a function to add the s2cloudless probability layer and
+        derived cloud mask as bands to an S2 SR image input.
+    
+        Parameters
+        ----------
+        img : TYPE
+            DESCRIPTION.
+    
+        Returns
+        -------
+        TYPE
+            DESCRIPTION.
+    
+        """
+        # Get s2cloudless image, subset the probability band.
+        cld_prb = ee.Image(img.get('s2cloudless')).select('probability')
+    
+        # Condition s2cloudless by the probability threshold value.
+        is_cloud = cld_prb.gt(settings['CLD_PRB_THRESH']).rename('clouds')
+    
+        # Add the cloud probability layer and cloud mask as image bands.
+        return img.addBands(ee.Image([cld_prb, is_cloud]))
+    
+    def add_shadow_bands(img):
+        """
+        #### Cloud shadow components
+    
+        Define a function to add dark pixels, cloud projection, and identified
+        shadows as bands to an S2 SR image input. Note that the image input needs
+        to be the result of the above `add_cloud_bands` function because it
+        relies on knowing which pixels are considered cloudy (`'clouds'` band).
+    
+        Parameters
+        ----------
+        img : TYPE
+            DESCRIPTION.
+    
+        Returns
+        -------
+        TYPE
+            DESCRIPTION.
+    
+        """
+        # Identify water pixels from the SCL band.
+        not_water = img.select('SCL').neq(6)
+    
+        # Identify dark NIR pixels that are not water (potential cloud shadow pixels).
+        SR_BAND_SCALE = 1e4
+        dark_pixels = img.select('B8').lt(settings['NIR_DRK_THRESH']*SR_BAND_SCALE).multiply(not_water).rename('dark_pixels')
+    
+        # Determine the direction to project cloud shadow from clouds (assumes UTM projection).
+        shadow_azimuth = ee.Number(90).subtract(ee.Number(img.get('MEAN_SOLAR_AZIMUTH_ANGLE')));
+    
+        # Project shadows from clouds for the distance specified by the CLD_PRJ_DIST input.
+        cld_proj = (img.select('clouds').directionalDistanceTransform(shadow_azimuth, settings['CLD_PRJ_DIST']*10)
+            .reproject(**{'crs': img.select(0).projection(), 'scale': 100})
+            .select('distance')
+            .mask()
+            .rename('cloud_transform'))
+    
+        # Identify the intersection of dark pixels with cloud shadow projection.
+        shadows = cld_proj.multiply(dark_pixels).rename('shadows')
+    
+        # Add dark pixels, cloud projection, and identified shadows as image bands.
+        return img.addBands(ee.Image([dark_pixels, cld_proj, shadows]))
+    
+    def add_cld_shdw_mask(img):
+        """
+        #### Final cloud-shadow mask
+    
+        Define a function to assemble all of the cloud and cloud shadow components and produce the final mask.
+    
+        """
+        
+        # Add cloud component bands.
+        img_cloud = add_cloud_bands(img)
+
+        # End date from user input range
+        user_end = time_range[0].split("-")
+        # Period of Sentinel 2 data before Surface reflectance data is available
+        start = datetime(2015, 6, 23)
+        end = datetime(2019, 1, 28)                    
+
+        # Is start date within pre S2_SR period?
+        if time_in_range(start, end, datetime(int(user_end[0]), int(user_end[1]), int(user_end[2]))) == False:
+                               # Add cloud shadow component bands.
+                               img_cloud_shadow = add_shadow_bands(img_cloud)
+                               # Combine cloud and shadow mask, set cloud and shadow as value 1, else 0.
+                               is_cld_shdw = img_cloud_shadow.select('clouds').add(img_cloud_shadow.select('shadows')).gt(0)
+    
+        else:
+            # Add cloud shadow component bands.
+            img_cloud_shadow = img_cloud
+            # Combine cloud and shadow mask, set cloud and shadow as value 1, else 0.
+            is_cld_shdw = img_cloud.select('clouds').gt(0)
             
-            # Add cloud component bands.
-            img_cloud = add_cloud_bands(img)
-
-            # End date from user input range
-            user_end = time_range[0].split("-")
-            # Period of Sentinel 2 data before Surface reflectance data is available
-            start = datetime(2015, 6, 23)
-            end = datetime(2019, 1, 28)                    
-
-            # Is start date within pre S2_SR period?
-            if time_in_range(start, end, datetime(int(user_end[0]), int(user_end[1]), int(user_end[2]))) == False:
-                                   # Add cloud shadow component bands.
-                                   img_cloud_shadow = add_shadow_bands(img_cloud)
-                                   # Combine cloud and shadow mask, set cloud and shadow as value 1, else 0.
-                                   is_cld_shdw = img_cloud_shadow.select('clouds').add(img_cloud_shadow.select('shadows')).gt(0)
+    
+        # Remove small cloud-shadow patches and dilate remaining pixels by BUFFER input.
+        # 20 m scale is for speed, and assumes clouds don't require 10 m precision.
+        is_cld_shdw = (is_cld_shdw.focal_min(2).focal_max(settings['BUFFER']*2/20)
+            .reproject(**{'crs': img.select([0]).projection(), 'scale': 20})
+            .rename('cloudmask'))
+    
+        # Add the final cloud-shadow mask to the image.
+        return img_cloud_shadow.addBands(is_cld_shdw)
+    
+    def apply_cld_shdw_mask(img):
+        """
+        ### Define cloud mask application function
+    
+        Define a function to apply the cloud mask to each image in the collection.
         
+        """
+        # Subset the cloudmask band and invert it so clouds/shadow are 0, else 1.
+        not_cld_shdw = img.select('cloudmask').Not()
+    
+        # Subset reflectance bands and update their masks, return the result.
+        return img.select('B.*').updateMask(not_cld_shdw)
+
+    return add_cld_shdw_mask, apply_cld_shdw_mask
+
+def reduce_collection(collection, reducer='median'):
+    """
+    Reduces a collection of images to a composite.
+
+    Arguments:
+    -----------
+    collection: ee.ImageCollection
+        masked images of the composite
+    reducer: str or dict
+        'median', 'mean', 'min' or 'max', or a dict with the key 'type':
+            {'type': 'percentile', 'percentile': 20}: percentile of each band
+            {'type': 'quality_mosaic', 'band': 'nir'}: for each pixel, the image with
+            the highest value of a band of the composite
+
+    Returns:
+    -----------
+    image: ee.Image
+        composite, with the band names of the collection
+
+    """
+
+    if isinstance(reducer, str):
+        reducer = {'type': reducer}
+    if reducer['type'] in ['median', 'mean', 'min', 'max']:
+        return getattr(collection, reducer['type'])()
+    elif reducer['type'] == 'percentile':
+        percentile = reducer['percentile']
+        # ee names the bands <band>_p<percentile>
+        return (collection.reduce(ee.Reducer.percentile([percentile]))
+                .regexpRename('_p%s$' % percentile, ''))
+    elif reducer['type'] == 'quality_mosaic':
+        return collection.qualityMosaic(reducer['band'])
+    raise Exception('Unknown reducer %s' % str(reducer))
+
+# graphs of the composites already built (see build_composite), at most MAX_COMPOSITES
+_COMPOSITES = dict([])
+_COMPOSITES_LOCK = threading.Lock()
+MAX_COMPOSITES = 256
+
+def build_composite(recipe, time_range, area, settings, collection=None):
+    """
+    Builds the EE graph of a composite from its recipe (see RECIPES): the collections of
+    the sources are filtered and scored for clouds, masked, their bands are selected and
+    renamed, they are merged and reduced (settings['reducer'], median by default), and the
+    extra bands are reduced and added. The graphs are memoized: the same recipe, dates,
+    area (same geometry, even if it is another ee object) and settings return the same
+    ee objects.
+
+    Arguments:
+    -----------
+    recipe: str or dict
+        name of a recipe of RECIPES, or a recipe
+    time_range: list of str
+        start and end dates
+    area: ee.Geometry
+        area of interest
+    settings: dict
+        settings of the composite (cloud thresholds, merges, reducer)
+    collection: str
+        EE collection of the first source (default COLLECTIONS)
+
+    Returns:
+    -----------
+    image: ee.Image
+        composite
+    counts: dict
+        number of images of each mission in the composite (ee.Number)
+
+    """
+
+    params = dict([(key, settings[key]) for key in NOC_cache.QUERY_SETTINGS + ['reducer']
+                   if key in settings.keys()])
+    # the area is keyed by its serialized geometry (retrieve_images creates a new
+    # ee.Geometry for each composite)
+    key = (json.dumps(recipe, sort_keys=True, default=str), tuple(time_range),
+           area.serialize(), collection, json.dumps(params, sort_keys=True, default=str))
+    with _COMPOSITES_LOCK:
+        if key in _COMPOSITES.keys():
+            return _COMPOSITES[key]
+    if isinstance(recipe, str):
+        recipe = RECIPES[recipe]
+
+    counts = dict([])
+    masked = dict([])
+    parts = []
+    for k, source in enumerate(recipe['sources']):
+        if 'setting' in source.keys() and not settings[source['setting']] == True:
+            continue
+        col_name = COLLECTIONS[source['satname']]
+        if k == 0 and collection is not None:
+            col_name = collection
+        if source['cloud'] == 'landsat':
+            col = landsat_collection(col_name, time_range, area, settings)
+            counts[source['satname']] = col.size()
+            if source['mask']:
+                col = col.map(landsat_cloud_mask)
+        elif source['cloud'] == 's2cloudless':
+            col, counts[source['satname']] = get_s2_sr_cld_col(area, time_range[0], time_range[1],
+                                                               settings['CLOUD_FILTER'])
+            if source['mask']:
+                add_cld_shdw_mask, apply_cld_shdw_mask = s2_cloud_functions(time_range, settings)
+                col = col.map(add_cld_shdw_mask).map(apply_cld_shdw_mask)
+        else:
+            raise Exception('Unknown cloud strategy %s' % source['cloud'])
+        masked[source['satname']] = col
+        if source['bands'] is not None:
+            if source['names'] is None:
+                col = col.select(source['bands'])
             else:
-                # Add cloud shadow component bands.
-                img_cloud_shadow = img_cloud
-                # Combine cloud and shadow mask, set cloud and shadow as value 1, else 0.
-                is_cld_shdw = img_cloud.select('clouds').gt(0)
-                
-        
-            # Remove small cloud-shadow patches and dilate remaining pixels by BUFFER input.
-            # 20 m scale is for speed, and assumes clouds don't require 10 m precision.
-            is_cld_shdw = (is_cld_shdw.focal_min(2).focal_max(settings['BUFFER']*2/20)
-                .reproject(**{'crs': img.select([0]).projection(), 'scale': 20})
-                .rename('cloudmask'))
-        
-            # Add the final cloud-shadow mask to the image.
-            return img_cloud_shadow.addBands(is_cld_shdw)
-        
-        def apply_cld_shdw_mask(img):
-            """
-            ### Define cloud mask application function
-        
-            Define a function to apply the cloud mask to each image in the collection.
-            
-            """
-            # Subset the cloudmask band and invert it so clouds/shadow are 0, else 1.
-            not_cld_shdw = img.select('cloudmask').Not()
-        
-            # Subset reflectance bands and update their masks, return the result.
-            return img.select('B.*').updateMask(not_cld_shdw)
-        
-        #Build masks and apply to S2 image
-        s2_sr_cld_col, sum_img = get_s2_sr_cld_col(area, time_range[0], time_range[1], settings['CLOUD_FILTER'])
-        image_median = (s2_sr_cld_col.map(add_cld_shdw_mask)
-                             .map(apply_cld_shdw_mask)
-                             .median())
-        
-        # collection_time = collect.filterDate(time_range[0], time_range[1])
-        # image_area = collection_time.filterBounds(area)
-        # image_2 = image_area.filterMetadata('CLOUDY_PIXEL_PERCENTAGE','less_than', 40)
-        # image_median = image_2.median()
-        return image_median, sum_img 
+                col = col.select(source['bands'], source['names'])
+        parts.append(col)
+
+    # merge the collections and reduce them
+    combined = parts[0]
+    for part in parts[1:]:
+        combined = combined.merge(part)
+    reducer = settings.get('reducer', 'median')
+    image = reduce_collection(combined, reducer)
+    for extra in recipe.get('extra_bands', []):
+        if isinstance(reducer, dict) and reducer['type'] == 'quality_mosaic':
+            # the quality band is needed to pick the images of the extra bands
+            source = [_ for _ in recipe['sources'] if _['satname'] == extra['satname']][0]
+            quality = source['bands'][source['names'].index(reducer['band'])]
+            extra_image = (masked[extra['satname']]
+                           .select(extra['bands'] + [quality], extra['names'] + [reducer['band']])
+                           .qualityMosaic(reducer['band']).select(extra['names']))
+        else:
+            extra_image = reduce_collection(masked[extra['satname']].select(extra['bands'],
+                                                                            extra['names']), reducer)
+        image = image.addBands(extra_image)
+
+    with _COMPOSITES_LOCK:
+        if len(_COMPOSITES) >= MAX_COMPOSITES:
+            _COMPOSITES.clear()
+        _COMPOSITES[key] = (image, counts)
+
+    return image, counts
+
+def composite_windows(satname, start_date, end_date, window, step, area, settings):
+    """
+    Builds the composites of rolling windows (e.g. 12-month composites every 6 months)
+    from the same recipe.
+
+    Arguments:
+    -----------
+    satname: str
+        satellite mission ('L5', 'L7', 'L8' or 'S2')
+    start_date, end_date: str
+        dates 'yyyy-mm-dd' of the start of the first window and of the end of the last one
+    window: int
+        length of the windows in months
+    step: int
+        number of months between the starts of two windows
+    area: ee.Geometry
+        area of interest
+    settings: dict
+        settings of the composites
+
+    Returns:
+    -----------
+    composites: list of tuples
+        (time_range, image, counts) of each window
+
+    """
+
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    composites = []
+    while start + relativedelta(months=window) - timedelta(days=1) <= end:
+        time_range = [start.strftime('%Y-%m-%d'),
+                      (start + relativedelta(months=window) - timedelta(days=1)).strftime('%Y-%m-%d')]
+        image, counts = obtain_image_median(COLLECTIONS[satname], time_range, area, [satname],
+                                            settings)
+        composites.append((time_range, image, counts))
+        start = start + relativedelta(months=step)
+
+    return composites
+
+def get_composite_info(image, counts, references=None):
+    """
+    Evaluates the values of a composite that are needed on the client (number of images of
+    each mission, CRS and, with the co-registration, cloud cover and id of the reference
+    images) with a single request to the EE server, instead of one getInfo per value.
+
+    Arguments:
+    -----------
+    image: ee.Image
+        median composite
+    counts: dict
+        number of images of each mission in the composite (ee.Number), as returned by
+        obtain_image_median
+    references: ee.Dictionary
+        metadata of the co-registration images, as returned by Landsat_Coregistration
+
+    Returns:
+    -----------
+    info: dict
+        'counts': number of images of each mission
+        'median_no': total number of images in the composite
+        'crs': coordinate reference system of the composite (e.g. 'EPSG:4326')
+        'references': metadata of the co-registration images (if references is not None)
+
+    """
+
+    values = dict([])
+    values['counts'] = ee.Dictionary(counts)
+    values['crs'] = image.select(0).projection().crs()
+    if references is not None:
+        values['references'] = references
+    # single round-trip to the server
+    info = ee.Dictionary(values).getInfo()
+    info['satnames'] = list(counts.keys())
+    info['median_no'] = sum([info['counts'][key] for key in counts.keys()])
+    print_composite_info(info)
+
+    return info
+
+def print_composite_info(info):
+    "prints the number of images and the co-registration images of a composite"
+    print ('- Cloud minimal images in Median:')
+    for key in info['satnames']:
+        print ('   %s: %d' % (key, info['counts'][key]))
+    print ('   Total: ' + str(info['median_no']))
+    if 'references' in info.keys():
+        print('Landsat co-registration (slave) image cloud cover: ', info['references']['L8_cloud_cover'])
+        print('Sentinel co-registration (master) image cloud cover: ', info['references']['S2_cloud_cover'])
+
+def get_composite_metadata(image, counts, inputs, settings, cache=None, coregistration=False):
+    """
+    Returns the metadata of a composite (see get_composite_info) from the cache of the
+    queries if the same composite (polygon, dates, missions and settings) was already
+    queried, otherwise from the EE server (and stores it in the cache). With the
+    co-registration, the displacement is computed with the reference images of the cache
+    instead of searching them again.
 
+    Arguments:
+    -----------
+    image: ee.Image
+        median composite
+    counts: dict
+        number of images of each mission in the composite, from obtain_image_median
+    inputs: dict
+        input parameters (polygon, dates, sat_list)
+    settings: dict
+        settings of the composite, with the optional key 'refresh_cache' (if True the
+        metadata is queried again and replaced in the cache)
+    cache: NOC_cache.QueryCache
+        cache of the query results, if None the server is always queried
+    coregistration: bool
+        if True, also computes the co-registration displacement
+
+    Returns:
+    -----------
+    info: dict
+        metadata of the composite
+    displacement: ee.Image
+        co-registration displacement (None if coregistration is False)
+
+    """
+
+    key = NOC_cache.query_key('composite', inputs, settings, inputs['sat_list'])
+    info = None
+    if cache is not None and not settings.get('refresh_cache', False):
+        info = cache.get(key)
+    displacement = None
+    references = None
+    if coregistration:
+        cached_references = None if info is None else info.get('references')
+        displacement, references = Landsat_Coregistration(inputs, cached_references)
+    if info is None:
+        info = get_composite_info(image, counts, references)
+        if cache is not None:
+            cache.set(key, info, 'composite %s %s %s' % (inputs['sitename'], inputs['sat_list'],
+                                                         inputs['dates']))
+    else:
+        print('Metadata of the composite loaded from the cache')
+        print_composite_info(info)
+
+    return info, displacement
 
 def retrieve_images(settings, inputs):
     """
@@ -744,6 +763,42 @@ def retrieve_images(settings, inputs):
 
     Arguments:
     -----------
+    settings: dict with the following keys
+        'coregistration': bool
+            if True, the Landsat composites are co-registered with Sentinel-2
+        'coregistration_mode': str (optional)
+            'local' (default): the displacement of the site is computed once and applied
+            to the downloaded composites, 'server': the displacement is computed and
+            applied on the GEE server for each composite (see coregistration_mode)
+        'download_workers': int (optional)
+            maximum number of band groups downloaded at the same time (default 3)
+        'cache': bool or str (optional)
+            cache of the query results (see NOC_cache), False to disable it or path of
+            the SQLite file (default True: ee_cache.sqlite in the data folder)
+        'cache_ttl': float (optional)
+            number of days after which the cached query results expire (default None)
+        'refresh_cache': bool (optional)
+            if True, the query results are requested again and replaced in the cache
+        'offline': bool (optional)
+            if True, the metadata of the composite is rebuilt from the cache and the
+            images already downloaded, without connecting to the GEE server
+        'skip_existing': bool (optional)
+            if True (default), a composite that was already downloaded and passes the
+            integrity check (see check_composite) is not downloaded again
+        'compact_storage': bool (optional)
+            if True, the composites are stored as uint16 (Landsat reflectances scaled by
+            10000, with the scale factor in the GeoTiff) with internal overviews, see
+            storage_options (default False, float32)
+        'compression': str (optional)
+            compression of the GeoTiffs of the compact composites, 'DEFLATE' (default)
+            or 'ZSTD' (if available in GDAL)
+        'tile_area': float (optional)
+            the regions larger than tile_area km2 are downloaded in tiles that are
+            mosaicked locally (default 100 km2, the limit of the GEE downloads)
+        'reducer': str or dict (optional)
+            reducer of the composites, 'median' (default), 'mean', 'min', 'max',
+            {'type': 'percentile', 'percentile': p} or {'type': 'quality_mosaic',
+            'band': name}, see reduce_collection
     inputs: dict with the following keys
         'sitename': str
             name of the site
@@ -777,15 +832,33 @@ def retrieve_images(settings, inputs):
 
     """
     
+    # cache of the queries to the GEE server
+    cache = NOC_cache.get_cache(inputs, settings)
+    
+    if settings.get('offline', False):
+        # rebuild the metadata from the cache, without connecting to the GEE server
+        return _retrieve_offline(settings, inputs, cache)
+    
+    # skip the composites that were already downloaded
+    if settings.get('skip_existing', True):
+        status, problems = check_composite(inputs)
+        if status == 'complete':
+            print('%s already downloaded, skipped' % composite_filename(inputs['sat_list'][0],
+                  inputs['sitename'], inputs['dates']))
+            return get_metadata(inputs)
+        elif status == 'corrupt':
+            print('Downloading again %s: %s' % (composite_filename(inputs['sat_list'][0],
+                  inputs['sitename'], inputs['dates']), ', '.join(problems)))
+    
     # initialise connection with GEE server
     ee.Initialize()
     
     # check image availabiliy and retrieve list of images
-    im_dict_T1, sum_img = check_images_available(inputs)
+    im_dict_T1, sum_img = check_images_available(inputs, cache)
     
     # create a new directory for this site with the name of the site
     im_folder = os.path.join(inputs['filepath'],inputs['sitename'])
-    if not os.path.exists(im_folder): os.makedirs(im_folder)    
+    os.makedirs(im_folder, exist_ok=True)
 
     print('\nDownloading images:')
     suffix = '.tif'
@@ -798,7 +871,7 @@ def retrieve_images(settings, inputs):
         # initialise variables and loop through images
         filenames = []; all_names = [];
         #for year in sat_list:
-        median_img, sum_img = obtain_image_median('LANDSAT/LT05/C01/T1_TOA',
+        median_img, counts = obtain_image_median('LANDSAT/LT05/C01/T1_TOA',
                                          inputs['dates'],
                                          ee.Geometry.Polygon(inputs['polygon']),inputs['sat_list'], settings)
       
@@ -821,47 +894,49 @@ def retrieve_images(settings, inputs):
         all_names.append(im_fn[''])
         filenames.append(im_fn[''])
         
-        ##Extract band metadata and define those to download
-        metadata = median_img.getInfo()
-        im_bands = metadata['bands']
+        ##Extract band metadata (and co-registration displacement) with a single request
+        metadata, displacement = get_composite_metadata(median_img, counts, inputs, settings,
+                                                        cache,
+                                                        coregistration_mode(settings) == 'server')
         
         bands = dict([])
         bands[''] = ['blue', 'green', 'red', 'nir','swir1','BQA']
 
-        if settings['coregistration'] == True:
+        if coregistration_mode(settings) == 'server':
 
-            displacement = Landsat_Coregistration(inputs)
-            print ('displacement calculated')
-    
             #Apply XY displacement values from overlapping images to the median composite
             registered = median_img.displace(displacement, mode="bicubic")     
             print ('Registered')
             
             # download .tif from EE
-            get_url('data', registered, 30, inputs['polygon'], filepaths[1], bands[''])
+            download_bands(registered, inputs['polygon'],
+                           [(30, filepaths[1], bands[''])],
+                           im_fn[''], settings.get('download_workers', 3),
+                           settings.get('tile_area', 100),
+                           storage_options(settings, satname[0]))
             print ('Downloaded')
         
         else:
+            if coregistration_mode(settings) == 'local':
+                # displacement of the site, computed once for all the periods
+                fn_displacement = site_displacement(inputs, settings)
             # download .tif from EE
-            get_url('data', median_img, ee.Number(30), inputs['polygon'], filepaths[1], bands[''])
+            paths = download_bands(median_img, inputs['polygon'],
+                                   [(30, filepaths[1], bands[''])],
+                                   im_fn[''], settings.get('download_workers', 3),
+                                   settings.get('tile_area', 100),
+                                   storage_options(settings, satname[0]))
+            if coregistration_mode(settings) == 'local':
+                coregister_composite(paths, [bands['']], fn_displacement)
+                print ('Co-registered')
             print ('Downloaded')            
-        
-        #rename the file as the image is downloaded as 'data.tif'
-        #locate download
-        local_data = filepaths[1] + '\data.tif'
-
-        try:
-            os.rename(local_data, os.path.join(filepaths[1], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[1], im_fn['']))
-            os.rename(local_data, os.path.join(filepaths[1], im_fn['']))
         #metadata for .txt file
         filename_txt = im_fn[''].replace('.tif','')
         metadict = {'filename':im_fn[''],
-                    'epsg':metadata['bands'][0]['crs'][5:],
+                    'epsg':metadata['crs'][5:],
                     'start_date': inputs['dates'][0],
                     'end_date': inputs['dates'][1],
-                    'median_no': sum_img} 
+                    'median_no': metadata['median_no']} 
   
     
 # Landsat 7 download                
@@ -871,7 +946,7 @@ def retrieve_images(settings, inputs):
         # initialise variables and loop through images
         filenames = []; all_names = [];
         #for year in sat_list:
-        median_img, sum_img = obtain_image_median('LANDSAT/LE07/C01/T1_TOA',
+        median_img, counts = obtain_image_median('LANDSAT/LE07/C01/T1_TOA',
                                          inputs['dates'],
                                          ee.Geometry.Polygon(inputs['polygon']),
                                          inputs['sat_list'],
@@ -896,55 +971,52 @@ def retrieve_images(settings, inputs):
         all_names.append(im_fn[''])
         filenames.append(im_fn[''])
         
-        ##Extract band metadata and define those to download
-        metadata = median_img.getInfo()
-        im_bands = metadata['bands']
+        ##Extract band metadata (and co-registration displacement) with a single request
+        metadata, displacement = get_composite_metadata(median_img, counts, inputs, settings,
+                                                        cache,
+                                                        coregistration_mode(settings) == 'server')
         
         bands = dict([])
         bands['pan'] = ['pan'] # panchromatic band
         bands['ms'] = ['blue', 'green', 'red', 'nir','swir1','BQA']
         
-        if settings['coregistration'] == True:
-            displacement = Landsat_Coregistration(inputs)
+        if coregistration_mode(settings) == 'server':
             
             #Apply XY displacement values from overlapping images to the median composite
             registered = median_img.displace(displacement, mode="bicubic")     
             print ('Co-registered')
          
-            #download .tif from EE
-            get_url('data', registered, 30, inputs['polygon'], filepaths[2], bands['ms'])
-            get_url('data', registered, 15, inputs['polygon'], filepaths[1], bands['pan'])
+            #download .tif from EE (the ms and pan bands at the same time)
+            download_bands(registered, inputs['polygon'],
+                           [(30, filepaths[2], bands['ms']),
+                            (15, filepaths[1], bands['pan'])],
+                           im_fn[''], settings.get('download_workers', 3),
+                           settings.get('tile_area', 100),
+                           storage_options(settings, satname[0]))
             print ('Downloaded')
         else:
+            if coregistration_mode(settings) == 'local':
+                # displacement of the site, computed once for all the periods
+                fn_displacement = site_displacement(inputs, settings)
             #download .tif from EE
-            get_url('data', median_img, ee.Number(30), inputs['polygon'], filepaths[2], bands['ms'])
-            get_url('data', median_img, ee.Number(15), inputs['polygon'], filepaths[1], bands['pan'])
+            paths = download_bands(median_img, inputs['polygon'],
+                                   [(30, filepaths[2], bands['ms']),
+                                    (15, filepaths[1], bands['pan'])],
+                                   im_fn[''], settings.get('download_workers', 3),
+                                   settings.get('tile_area', 100),
+                                   storage_options(settings, satname[0]))
+            if coregistration_mode(settings) == 'local':
+                coregister_composite(paths, [bands['ms'], bands['pan']], fn_displacement)
+                print ('Co-registered')
             print ('Downloaded')           
         
-        #rename the file as the image is downloaded as 'data.tif'
-        #locate download
-        local_data = filepaths[2] + '\data.tif'
-        local_data_pan = filepaths[1] + '\data.tif'
-                
-        try:
-            os.rename(local_data, os.path.join(filepaths[2], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[2], im_fn['']))
-            os.rename(local_data, os.path.join(filepaths[2], im_fn['']))
-       
-        try:
-            os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[1], im_fn['']))
-            os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['']))
-        
        #metadata for .txt file
         filename_txt = im_fn[''].replace('.tif','')
         metadict = {'filename':im_fn[''],
-                    'epsg':metadata['bands'][0]['crs'][5:],
+                    'epsg':metadata['crs'][5:],
                     'start_date': inputs['dates'][0],
                     'end_date': inputs['dates'][1],
-                    'median_no': sum_img} 
+                    'median_no': metadata['median_no']} 
   
     # Landsat 8 download                
     elif satname == ['L8']:
@@ -953,7 +1025,7 @@ def retrieve_images(settings, inputs):
         # initialise variables and loop through images
         filenames = []; all_names = [];
         #for year in sat_list:
-        median_img, sum_img = obtain_image_median('LANDSAT/LC08/C01/T1_TOA',
+        median_img, counts = obtain_image_median('LANDSAT/LC08/C01/T1_TOA',
                                          inputs['dates'],
                                          ee.Geometry.Polygon(inputs['polygon']),inputs['sat_list'],
                                          settings)
@@ -977,9 +1049,10 @@ def retrieve_images(settings, inputs):
         all_names.append(im_fn[''])
         filenames.append(im_fn[''])
         
-        ##Extract band metadata and define those to download
-        metadata = median_img.getInfo()
-        im_bands = metadata['bands']
+        ##Extract band metadata (and co-registration displacement) with a single request
+        metadata, displacement = get_composite_metadata(median_img, counts, inputs, settings,
+                                                        cache,
+                                                        coregistration_mode(settings) == 'server')
 
         if settings['add_L7_to_L8'] == False:
         
@@ -992,49 +1065,44 @@ def retrieve_images(settings, inputs):
             bands['ms'] = ['blue', 'green', 'red', 'nir','swir1','BQA']
         
         
-        if settings['coregistration'] == True:
+        if coregistration_mode(settings) == 'server':
        
-            displacement = Landsat_Coregistration(inputs)
-    
             #Apply XY displacement values from overlapping images to the median composite
             registered = median_img.displace(displacement, mode="bicubic")     
             print ('Co-registered')
                     
-            #download .tif from EE
-            get_url('data', registered, 30, inputs['polygon'], filepaths[2], bands['ms'])
-            get_url('data', registered, 15, inputs['polygon'], filepaths[1], bands['pan'])
+            #download .tif from EE (the ms and pan bands at the same time)
+            download_bands(registered, inputs['polygon'],
+                           [(30, filepaths[2], bands['ms']),
+                            (15, filepaths[1], bands['pan'])],
+                           im_fn[''], settings.get('download_workers', 3),
+                           settings.get('tile_area', 100),
+                           storage_options(settings, satname[0]))
             print ('Downloaded')
             
         else:
-             #download .tif from EE
-            get_url('data', median_img, ee.Number(30), inputs['polygon'], filepaths[2], bands['ms'])
-            get_url('data', median_img, ee.Number(15), inputs['polygon'], filepaths[1], bands['pan'])
+            if coregistration_mode(settings) == 'local':
+                # displacement of the site, computed once for all the periods
+                fn_displacement = site_displacement(inputs, settings)
+            #download .tif from EE
+            paths = download_bands(median_img, inputs['polygon'],
+                                   [(30, filepaths[2], bands['ms']),
+                                    (15, filepaths[1], bands['pan'])],
+                                   im_fn[''], settings.get('download_workers', 3),
+                                   settings.get('tile_area', 100),
+                                   storage_options(settings, satname[0]))
+            if coregistration_mode(settings) == 'local':
+                coregister_composite(paths, [bands['ms'], bands['pan']], fn_displacement)
+                print ('Co-registered')
             print ('Downloaded')           
         
-        #rename the file as the image is downloaded as 'data.tif'
-        #locate download
-        local_data = filepaths[2] + '\data.tif'
-        local_data_pan = filepaths[1] + '\data.tif'
-                
-        try:
-            os.rename(local_data, os.path.join(filepaths[2], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[2], im_fn['']))
-            os.rename(local_data, os.path.join(filepaths[2], im_fn['']))
-       
-        try:
-            os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[1], im_fn['']))
-            os.rename(local_data_pan, os.path.join(filepaths[1], im_fn['']))
-        
        #metadata for .txt file
         filename_txt = im_fn[''].replace('.tif','')
         metadict = {'filename':im_fn[''],
-                    'epsg':metadata['bands'][0]['crs'][5:],
+                    'epsg':metadata['crs'][5:],
                     'start_date': inputs['dates'][0],
                     'end_date': inputs['dates'][1],
-                    'median_no': sum_img} 
+                    'median_no': metadata['median_no']} 
   
         # Sentinel 2 download                
     elif satname == ['S2']:
@@ -1043,7 +1111,7 @@ def retrieve_images(settings, inputs):
         # initialise variables and loop through images
         filenames = []; all_names = [];
         #for year in sat_list:
-        median_img, sum_img = obtain_image_median('COPERNICUS/S2',
+        median_img, counts = obtain_image_median('COPERNICUS/S2',
                                          inputs['dates'],
                                          ee.Geometry.Polygon(inputs['polygon']),inputs['sat_list'],
                                          settings)
@@ -1066,52 +1134,31 @@ def retrieve_images(settings, inputs):
         all_names.append(im_fn[''])
         filenames.append(im_fn[''])
         
-        ##Extract band metadata and define those to download
-        metadata = median_img.getInfo()
-        #im_bands = metadata['bands']
+        ##Extract band metadata with a single request
+        metadata, _ = get_composite_metadata(median_img, counts, inputs, settings, cache)
               
         bands = dict([])
         bands['10m'] = ['B2', 'B3', 'B4', 'B8'] # multispectral bands
         bands['20m'] = ['B12'] # SWIR band
         bands['60m'] = ['QA60'] # QA band
            
-        #download .tif from EE
-        get_url('data', median_img, ee.Number(10), inputs['polygon'], filepaths[1], bands['10m'])
-        get_url('data', median_img, ee.Number(20), inputs['polygon'], filepaths[2], bands['20m'])
-        get_url('data', median_img, ee.Number(60), inputs['polygon'], filepaths[3], bands['20m'])
+        #download .tif from EE (the 10m, 20m and 60m bands at the same time)
+        download_bands(median_img, inputs['polygon'],
+                       [(10, filepaths[1], bands['10m']),
+                        (20, filepaths[2], bands['20m']),
+                        (60, filepaths[3], bands['60m'])],
+                       im_fn[''], settings.get('download_workers', 3),
+                       settings.get('tile_area', 100),
+                       storage_options(settings, satname[0]))
         print ('Downloaded')
         
-        #rename the file as the image is downloaded as 'data.tif'
-        #locate download
-        local_data_10m = filepaths[1] + '\data.tif'
-        local_data_20m = filepaths[2] + '\data.tif'
-        local_data_60m = filepaths[3] + '\data.tif'
-                
-        try:
-            os.rename(local_data_10m, os.path.join(filepaths[1], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[1], im_fn['']))
-            os.rename(local_data_10m, os.path.join(filepaths[1], im_fn['']))
-       
-        try:
-            os.rename(local_data_20m, os.path.join(filepaths[2], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[2], im_fn['']))
-            os.rename(local_data_20m, os.path.join(filepaths[2], im_fn['']))
-        
-        try:
-            os.rename(local_data_60m, os.path.join(filepaths[3], im_fn['']))
-        except: # overwrite if already exists
-            os.remove(os.path.join(filepaths[3], im_fn['']))
-            os.rename(local_data_60m, os.path.join(filepaths[3], im_fn['']))
-        
        #metadata for .txt file
         filename_txt = im_fn[''].replace('.tif','')
         metadict = {'filename':im_fn[''],
-                    'epsg':metadata['bands'][0]['crs'][5:],
+                    'epsg':metadata['crs'][5:],
                     'start_date': inputs['dates'][0],
                     'end_date': inputs['dates'][1],
-                    'median_no': sum_img
+                    'median_no': metadata['median_no']
                     
                     #'LCloudScore': settings['LCloudScore'],         # Mean cloud score threshold (include images with less then threshold)
                     #'add_L7_to_L5': settings['add_L7_to_L5'],       # Add Landsat 7 to Landsat 5 median composite if they are in same time period
@@ -1128,47 +1175,658 @@ def retrieve_images(settings, inputs):
                     } 
           
     # write metadata
-    with open(os.path.join(filepaths[0],filename_txt + '.txt'), 'w') as f:
+    return write_metadata(inputs, filepaths[0], filename_txt, metadict, settings)
+
+# lock of the metadata of the sites (see write_metadata)
+_METADATA_LOCK = threading.Lock()
+
+def write_metadata(inputs, filepath_meta, filename_txt, metadict, settings=None):
+    """
+    Writes the metadata .txt file of a composite and records the composite in the catalog
+    (see NOC_catalog), then loads the metadata of all the images of the site and saves it
+    as <sitename>_metadata.pkl.
+
+    Arguments:
+    -----------
+    inputs: dict
+        input parameters (sitename, filepath)
+    filepath_meta: str
+        folder of the metadata .txt files
+    filename_txt: str
+        name of the .txt file (without extension)
+    metadict: dict
+        metadata of the composite
+    settings: dict
+        settings of the download, the keys in DOWNLOAD_SETTINGS are recorded in the
+        catalog
+
+    Returns:
+    -----------
+    metadata: dict
+        contains the information about the satellite images that were downloaded
+
+    """
+
+    with open(os.path.join(filepath_meta,filename_txt + '.txt'), 'w') as f:
           for key in metadict.keys():
                 f.write('%s\t%s\n'%(key,metadict[key]))                                 
     print('')
-             
-    # once all images have been downloaded, load metadata from .txt files
-    metadata = get_metadata(inputs)
-          
-    # save metadata dict
-    with open(os.path.join(im_folder, inputs['sitename'] + '_metadata' + '.pkl'), 'wb') as f:
-        pickle.dump(metadata, f)
+
+    # record the composite in the catalog (with the checksums of the GeoTiffs)
+    satname = inputs['sat_list'][0]
+    settings = dict([]) if settings is None else settings
+    # one composite at a time, so that the last metadata dict saved has all the composites
+    with _METADATA_LOCK:
+        NOC_catalog.get_catalog(inputs['filepath']).add(
+            inputs['sitename'], satname, metadict,
+            composite_paths(inputs['sitename'], satname, metadict['filename']),
+            dict([(key, settings[key]) for key in DOWNLOAD_SETTINGS if key in settings.keys()]))
+        # once all images have been downloaded, load metadata from .txt files (and save the
+        # metadata dict, see save_metadata)
+        metadata = get_metadata(inputs)
 
     return metadata
 
-def get_url(name, image, scale, region, filepath, bands):
+def save_metadata(inputs, metadata):
+    """
+    Saves the metadata dict of a site as <sitename>_metadata.pkl. The file is written with
+    a temporary name and renamed atomically, as several periods of a site can be
+    downloaded at the same time (see retrieve_matrix).
+    """
+    fn = os.path.join(inputs['filepath'], inputs['sitename'],
+                      inputs['sitename'] + '_metadata.pkl')
+    fn_tmp = fn + '.%d.%d' % (os.getpid(), threading.get_ident())
+    with open(fn_tmp, 'wb') as f:
+        pickle.dump(metadata, f)
+    os.replace(fn_tmp, fn)
+
+def retrieve_matrix(settings, sites, periods, sat_lists, max_in_flight=4, rate=1,
+                    max_retries=5, dry_run=False):
+    """
+    Downloads the composites of several sites, periods and satellite missions concurrently
+    with NOC_scheduler: at most max_in_flight composites are downloaded at the same time,
+    at most rate are started per second, and the failed downloads (e.g. when the quotas of
+    the GEE server are exceeded) are retried with an exponential backoff with jitter.
+    The composites that were already downloaded and pass the integrity check are not
+    submitted (see plan_downloads), unless settings['skip_existing'] is False.
+
+    Arguments:
+    -----------
+    settings: dict
+        settings of the composites (see retrieve_images)
+    sites: list of dict
+        inputs of each site with the keys 'sitename', 'polygon' and 'filepath'
+    periods: list of lists
+        start and end dates of each composite, e.g. [['2019-01-01', '2019-12-31'], ...]
+    sat_lists: list of lists
+        satellite missions of the composites, e.g. [['L8'], ['S2']]
+    max_in_flight: int
+        maximum number of composites downloaded at the same time
+    rate: float
+        maximum number of downloads started per second
+    max_retries: int
+        number of retries of a failed download
+    dry_run: bool
+        if True, only prints the report of the composites that would be downloaded
+
+    Returns:
+    -----------
+    results: dict
+        metadata returned by retrieve_images (or the exception if the download failed)
+        for each (sitename, start date, satellite mission), None for the composites that
+        were skipped. With dry_run, the plan of the downloads (see plan_downloads)
+
+    """
+
+    plan = plan_downloads(sites, periods, sat_lists)
+    print_download_plan(plan)
+    if dry_run:
+        return plan
+
+    results = dict([])
+    keys = []
+    tasks = []
+    for item in plan:
+        key = (item['sitename'], item['dates'][0], item['satname'])
+        if item['status'] == 'complete' and settings.get('skip_existing', True):
+            results[key] = None
+            continue
+        keys.append(key)
+        tasks.append(functools.partial(retrieve_images, settings, item['inputs']))
+    if len(tasks) > 0:
+        results.update(zip(keys, NOC_scheduler.run_tasks(tasks, max_in_flight, rate,
+                                                         max_retries=max_retries)))
+
+    return results
+
+def retrieve_footprints(settings, sites, periods, sat_lists, max_in_flight=4, rate=1,
+                        max_retries=5, dry_run=False):
+    """
+    Downloads the composites of several overlapping sites once per download footprint
+    (see NOC_aoi.plan_footprints) and crops the composite of each site locally from the
+    composite of its footprint, in the folders of the site (same layout and metadata
+    files as retrieve_images). The footprints are downloaded concurrently like in
+    retrieve_matrix and saved in the folder 'footprints' of the data folder. The sites
+    that do not overlap any other site are downloaded directly.
+
+    The number of images in the composite of a site is the number of images of its
+    footprint.
+
+    Arguments:
+    -----------
+    settings: dict
+        settings of the composites (see retrieve_images), with the optional keys:
+        'footprint_gap': float
+            distance in degrees below which two sites are merged (default 0)
+        'footprint_max_area': float
+            maximum area of a footprint in km2 (default 1000)
+    sites: list of dict
+        inputs of each site with the keys 'sitename', 'polygon' and 'filepath'
+    periods: list of lists
+        start and end dates of each composite
+    sat_lists: list of lists
+        satellite missions of the composites, e.g. [['L8'], ['S2']]
+    max_in_flight, rate, max_retries:
+        parameters of the scheduler (see retrieve_matrix)
+    dry_run: bool
+        if True, only prints the footprints and the composites that would be downloaded
+
+    Returns:
+    -----------
+    results: dict
+        metadata of the composite (or the exception if the download failed) for each
+        (sitename, start date, satellite mission), None for the composites that were
+        skipped. With dry_run, the plan of the downloads of the sites (see plan_downloads)
+
+    """
+
+    footprints = NOC_aoi.plan_footprints(sites, settings.get('footprint_gap', 0),
+                                         settings.get('footprint_max_area', 1000))
+    NOC_aoi.print_footprints(footprints, sites)
+    plan = plan_downloads(sites, periods, sat_lists)
+    print_download_plan(plan)
+    if dry_run:
+        return plan
+
+    # composites of the sites still to download
+    todo = dict([((item['sitename'], item['dates'][0], item['satname']), item) for item in plan
+                 if not item['status'] == 'complete' or not settings.get('skip_existing', True)])
+    results = dict([((item['sitename'], item['dates'][0], item['satname']), None)
+                    for item in plan])
+    keys = []
+    tasks = []
+    for footprint in footprints:
+        members = [sites[k] for k in footprint['sites']]
+        if len(members) == 1:
+            # a single site is downloaded directly
+            site = members[0]
+            fp_inputs = dict(site)
+        else:
+            fp_inputs = {'sitename': footprint['name'], 'polygon': footprint['polygon'],
+                         'filepath': os.path.join(members[0]['filepath'], 'footprints')}
+        for dates in periods:
+            for sat_list in sat_lists:
+                site_keys = [(site['sitename'], dates[0], sat_list[0]) for site in members]
+                site_keys = [key for key in site_keys if key in todo.keys()]
+                if len(site_keys) == 0:
+                    continue
+                inputs = dict(fp_inputs)
+                inputs['dates'] = list(dates)
+                inputs['sat_list'] = list(sat_list)
+                keys.append((inputs, site_keys))
+                tasks.append(functools.partial(retrieve_images, settings, inputs))
+    if len(tasks) > 0:
+        downloads = NOC_scheduler.run_tasks(tasks, max_in_flight, rate, max_retries=max_retries)
+    else:
+        downloads = []
+
+    # crop the composites of the sites
+    for (fp_inputs, site_keys), download in zip(keys, downloads):
+        for key in site_keys:
+            if isinstance(download, Exception):
+                results[key] = download
+            elif fp_inputs['sitename'] == key[0]:
+                results[key] = download
+            else:
+                try:
+                    results[key] = crop_composite(fp_inputs, todo[key]['inputs'], settings)
+                except Exception as e:
+                    results[key] = e
+
+    return results
+
+def crop_composite(fp_inputs, inputs, settings=None):
+    """
+    Crops the composite of a site from the composite of its download footprint with GDAL
+    windows (see NOC_io.crop_geotiff) and writes its metadata, in the folders of the site.
+
+    Arguments:
+    -----------
+    fp_inputs: dict
+        inputs of the footprint (sitename, polygon, filepath, dates, sat_list)
+    inputs: dict
+        inputs of the site (sitename, polygon, filepath, same dates and sat_list)
+    settings: dict
+        settings of the download (recorded in the catalog)
+
+    Returns:
+    -----------
+    metadata: dict
+        contains the information about the satellite images of the site
+
+    """
+
+    satname = inputs['sat_list'][0]
+    fp_folder = os.path.join(fp_inputs['filepath'], fp_inputs['sitename'], satname)
+    fn_fp = composite_filename(satname, fp_inputs['sitename'], inputs['dates'])
+    fn = composite_filename(satname, inputs['sitename'], inputs['dates'])
+    filepaths = create_folder_structure(os.path.join(inputs['filepath'], inputs['sitename']),
+                                        satname)
+    bounds = NOC_aoi.polygon_bounds(inputs['polygon'])
+    for (folder, _), filepath in zip(COMPOSITE_BANDS[satname], filepaths[1:]):
+        NOC_io.crop_geotiff(os.path.join(fp_folder, folder, fn_fp), os.path.join(filepath, fn),
+                            bounds)
+    # metadata of the footprint, with the name of the composite of the site
+    with open(os.path.join(fp_folder, 'meta', fn_fp.replace('.tif', '.txt')), 'r') as f:
+        metadict = dict([_.split('\t') for _ in f.read().splitlines() if '\t' in _])
+    metadict['filename'] = fn
+    print('%s cropped from %s' % (fn, fn_fp))
+
+    return write_metadata(inputs, filepaths[0], fn.replace('.tif', ''), metadict, settings)
+
+def composite_filename(satname, sitename, dates):
+    "name of the GeoTiffs of a composite, e.g. L8_site_median_S20190101_E20191231.tif"
+    start = str(dates[0].replace('-', ''))
+    end = str(dates[1].replace('-', ''))
+    return satname + '_' + sitename + '_median_' + "S" + start + "_E" + end + '.tif'
+
+def check_composite(inputs):
+    """
+    Checks if a composite was already downloaded: the GeoTiff of each group of bands (see
+    COMPOSITE_BANDS) must pass the integrity check of NOC_io.check_geotiff (header read by
+    GDAL, number of bands, size) and the metadata .txt file must be complete. The pixels
+    are not read and the GEE server is not queried.
+
+    Arguments:
+    -----------
+    inputs: dict
+        input parameters (sitename, filepath, dates and sat_list with a single mission)
+
+    Returns:
+    -----------
+    status: str
+        'complete', 'missing' (nothing downloaded) or 'corrupt' (some files missing or
+        failing the check)
+    problems: list of str
+        description of the problems of each file
+
+    """
+
+    satname = inputs['sat_list'][0]
+    im_folder = os.path.join(inputs['filepath'], inputs['sitename'], satname)
+    fn = composite_filename(satname, inputs['sitename'], inputs['dates'])
+    problems = []
+    n_missing = 0
+    for folder, n_bands in COMPOSITE_BANDS[satname]:
+        problem = NOC_io.check_geotiff(os.path.join(im_folder, folder, fn), n_bands)
+        if problem is not None:
+            problems.append('%s/%s: %s' % (folder, fn, problem))
+            n_missing += problem == 'missing'
+    # metadata .txt file (written after the GeoTiffs)
+    fn_meta = os.path.join(im_folder, 'meta', fn.replace('.tif', '.txt'))
+    if not os.path.exists(fn_meta):
+        problems.append('meta/%s: missing' % os.path.basename(fn_meta))
+        n_missing += 1
+    else:
+        with open(fn_meta, 'r') as f:
+            lines = [_.split('\t') for _ in f.read().splitlines()]
+        if len(lines) < 5 or any([not len(_) == 2 for _ in lines[:5]]) or not lines[0][1] == fn:
+            problems.append('meta/%s: incomplete' % os.path.basename(fn_meta))
+
+    if len(problems) == 0:
+        status = 'complete'
+    elif n_missing == len(COMPOSITE_BANDS[satname]) + 1:
+        status = 'missing'
+    else:
+        status = 'corrupt'
+
+    return status, problems
+
+def plan_downloads(sites, periods, sat_lists):
+    """
+    Lists the composites of several sites, periods and satellite missions and checks which
+    ones were already downloaded (see check_composite), without connecting to the GEE
+    server.
+
+    Arguments:
+    -----------
+    sites: list of dict
+        inputs of each site with the keys 'sitename', 'polygon' and 'filepath'
+    periods: list of lists
+        start and end dates of each composite
+    sat_lists: list of lists
+        satellite missions of the composites, e.g. [['L8'], ['S2']]
+
+    Returns:
+    -----------
+    plan: list of dict
+        one dict per composite with the keys 'sitename', 'dates', 'satname', 'filename',
+        'status' ('complete', 'missing' or 'corrupt'), 'problems' and 'inputs' (the inputs
+        of retrieve_images)
+
+    """
+
+    plan = []
+    for site in sites:
+        for dates in periods:
+            for sat_list in sat_lists:
+                inputs = dict(site)
+                inputs['dates'] = list(dates)
+                inputs['sat_list'] = list(sat_list)
+                status, problems = check_composite(inputs)
+                plan.append({'sitename': site['sitename'],
+                             'dates': list(dates),
+                             'satname': sat_list[0],
+                             'filename': composite_filename(sat_list[0], site['sitename'], dates),
+                             'status': status,
+                             'problems': problems,
+                             'inputs': inputs})
+
+    return plan
+
+def print_download_plan(plan):
+    "prints the number of composites to download and the problems of the corrupt ones"
+    n = dict([(status, sum([1 for _ in plan if _['status'] == status]))
+              for status in ['complete', 'missing', 'corrupt']])
+    print('%d composites: %d already downloaded, %d missing, %d corrupt' %
+          (len(plan), n['complete'], n['missing'], n['corrupt']))
+    for item in plan:
+        if item['status'] == 'complete':
+            continue
+        print('  %s %s: %s' % ('download' if item['status'] == 'missing' else 'download again',
+                               item['filename'], ', '.join(item['problems'])
+                               if item['status'] == 'corrupt' else 'missing'))
+
+def _retrieve_offline(settings, inputs, cache):
+    """
+    Rebuilds the metadata of a composite that was already downloaded from the cache of the
+    queries, without connecting to the GEE server (settings['offline'] = True).
+
+    Returns:
+    -----------
+    metadata: dict
+        contains the information about the satellite images that were downloaded
+
+    """
+
+    if cache is None:
+        raise Exception('The offline mode needs the cache of the queries (settings cache)')
+    key = NOC_cache.query_key('composite', inputs, settings, inputs['sat_list'])
+    info = cache.get(key)
+    if info is None:
+        raise Exception('The %s composite of %s between %s and %s is not in the cache, '
+                        'run retrieve_images online first' % (inputs['sat_list'][0],
+                        inputs['sitename'], inputs['dates'][0], inputs['dates'][1]))
+    print('Metadata of the composite loaded from the cache (offline)')
+    print_composite_info(info)
+
+    satname = inputs['sat_list'][0]
+    filepaths = create_folder_structure(os.path.join(inputs['filepath'],inputs['sitename']), satname)
+    im_fn = composite_filename(satname, inputs['sitename'], inputs['dates'])
+    for filepath in filepaths[1:]:
+        if not os.path.exists(os.path.join(filepath, im_fn)):
+            print('Warning: %s was not downloaded in %s' % (im_fn, filepath))
+
+    metadict = {'filename':im_fn,
+                'epsg':info['crs'][5:],
+                'start_date': inputs['dates'][0],
+                'end_date': inputs['dates'][1],
+                'median_no': info['median_no']}
+
+    return write_metadata(inputs, filepaths[0], im_fn.replace('.tif',''), metadict, settings)
+
+def get_url(name, image, scale, region, filepath, bands, fn=None, tile=None, options=None):
     """It will open and download automatically a zip folder containing Geotiff data of 'image'.
     If additional parameters are needed, see also:
     https://github.com/google/earthengine-api/blob/master/python/ee/image.py
 
+    The zip file is streamed into memory and the bands are written directly as a compressed
+    and tiled GeoTiff (see NOC_io), with a unique temporary name in filepath that is then
+    renamed atomically, so that several band groups can be downloaded at the same time in
+    the same folder.
+
     Parameters:
         name (str): name of the created folder
         image (ee.image.Image): image to export
         scale (int): resolution of export in meters (e.g: 30 for Landsat)
         region (list): region of interest
+        filepath (str): folder where the GeoTiff is saved
+        bands (list): names of the bands to export
+        fn (str): name of the GeoTiff (default name + '.tif')
+        tile (dict): tile of tile_grid, if given the pixel grid of the tile (crs_transform
+            and dimensions) is exported instead of the region at the scale
+        options (dict): options of the GeoTiff (creation_options, scales, overviews),
+            see NOC_io.download_geotiff
 
     Returns:
         path (str)
       """      
       
-    path = image.getDownloadURL({
-        'name':'data',
-        'scale': scale,
-        'region': region,
-        'filePerBand': False,
-        'bands': bands,
-        'crs': 'EPSG:4326'
-        })
+    params = {'name': name,
+              'filePerBand': False,
+              'bands': bands,
+              'crs': 'EPSG:4326'}
+    if tile is None:
+        params['scale'] = scale
+        params['region'] = region
+    else:
+        params['crs_transform'] = tile['crs_transform']
+        params['dimensions'] = '%dx%d' % tuple(tile['dimensions'])
+    path = image.getDownloadURL(params)
+
+    if fn is None:
+        fn = name + '.tif'
 
-    local_zip, headers = urlretrieve(path)
-    with zipfile.ZipFile(local_zip) as local_zipfile:
-        return local_zipfile.extractall(path=str(filepath))
+    if options is None:
+        options = dict([])
+
+    return NOC_io.download_geotiff(path, os.path.join(str(filepath), fn), **options)
+
+def bbox_area(region):
+    "area of the bounding box of a lon/lat polygon in km2 (what Earth Engine downloads)"
+    coords = np.array(region, dtype=float).reshape(-1, 2)
+    lat = np.radians(np.mean(coords[:,1]))
+    width = np.ptp(coords[:,0])*NOC_georef.KM_PER_DEGREE*np.cos(lat)
+    height = np.ptp(coords[:,1])*NOC_georef.KM_PER_DEGREE
+    return width*height
+
+def tile_grid(region, scale, tile_area=100):
+    """
+    Splits the bounding box of a lon/lat polygon into tiles that can be downloaded from
+    Earth Engine one at a time (smaller than tile_area km2). The tiles share the same pixel
+    grid in EPSG:4326 (pixels of scale metres at the equator, like Earth Engine, aligned on
+    multiples of the pixel size), so they can be mosaicked without resampling.
+
+    Arguments:
+    -----------
+    region: list
+        polygon of the region of interest (lon/lat)
+    scale: float
+        pixel size in metres
+    tile_area: float
+        maximum area of a tile in km2
+
+    Returns:
+    -----------
+    tiles: list of dict
+        'row', 'col': position of the tile in the grid
+        'crs_transform': affine transformation of the tile [xres, 0, x0, 0, -yres, y0]
+        'dimensions': number of columns and rows of the tile
+
+    """
+
+    coords = np.array(region, dtype=float).reshape(-1, 2)
+    res = scale/(NOC_georef.KM_PER_DEGREE*1000)
+    # snap the bounding box to the pixel grid
+    x0 = np.floor(coords[:,0].min()/res)*res
+    y0 = np.ceil(coords[:,1].max()/res)*res
+    nx = int(np.ceil(round((coords[:,0].max() - x0)/res, 6)))
+    ny = int(np.ceil(round((y0 - coords[:,1].min())/res, 6)))
+    # number of pixels on the side of a tile (area at the equator, larger than at the site)
+    side = max(1, int(np.sqrt(tile_area)*1000/scale))
+    tiles = []
+    for row, i in enumerate(range(0, ny, side)):
+        for col, j in enumerate(range(0, nx, side)):
+            tiles.append({'row': row,
+                          'col': col,
+                          'crs_transform': [res, 0, x0 + j*res, 0, -res, y0 - i*res],
+                          'dimensions': [min(side, nx - j), min(side, ny - i)]})
+
+    return tiles
+
+def download_bands(image, region, band_groups, fn, n_workers=3, tile_area=None, storage=None):
+    """
+    Downloads the groups of bands of an image (e.g. the 30 m multispectral bands and the
+    15 m panchromatic band) at the same time from a pool of threads.
+
+    If the region is larger than tile_area km2 (Earth Engine limits the size of the
+    downloads), each group is split into tiles (see tile_grid), all the tiles are
+    downloaded at the same time and mosaicked locally into a single GeoTiff.
+
+    Arguments:
+    -----------
+    image: ee.Image
+        image to export
+    region: list
+        region of interest
+    band_groups: list of tuples
+        (scale, filepath, bands) for each group of bands, see get_url
+    fn: str
+        name of the GeoTiff saved in the folder of each group
+    n_workers: int
+        maximum number of downloads at the same time
+    tile_area: float
+        maximum area of a download in km2, if None the region is never split
+    storage: dict
+        storage of the compact composites (see storage_options), if None the bands are
+        stored as float
+
+    Returns:
+    -----------
+    paths: list of str
+        paths of the GeoTiffs, in the same order as band_groups
+
+    """
+
+    tiled = tile_area is not None and bbox_area(region) > tile_area
+    # downloads of the tiles of all the groups, in temporary folders
+    jobs = []
+    folders = []
+    mosaic_options = []
+    for scale, filepath, bands in band_groups:
+        image_group, options = image, dict([])
+        if storage is not None:
+            image_group, options = compact_image(image, bands, storage)
+        if not tiled:
+            jobs.append([(get_url, 'data', image_group, scale, region, filepath, bands, fn,
+                          None, options)])
+            continue
+        folder = tempfile.mkdtemp(prefix=fn + '.tiles.', dir=str(filepath))
+        folders.append(folder)
+        tiles = tile_grid(region, scale, tile_area)
+        # the overviews are built on the mosaic
+        mosaic_options.append(dict([(key, options[key]) for key in options.keys()
+                                    if key in ['creation_options', 'overviews']]))
+        options = dict([(key, options[key]) for key in options.keys() if not key == 'overviews'])
+        jobs.append([(get_url, 'data_%dm_r%d_c%d' % (scale, tile['row'], tile['col']),
+                      image_group, scale, region, folder, bands, None, tile, options)
+                     for tile in tiles])
+    n_jobs = sum([len(_) for _ in jobs])
+    if tiled:
+        print('Region of %.0f km2 downloaded in %d tiles' % (bbox_area(region), n_jobs))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(n_workers, n_jobs))) as executor:
+            futures = [[executor.submit(*job) for job in group] for group in jobs]
+            # raises the exception of the first failed download
+            results = [[future.result() for future in group] for group in futures]
+        paths = []
+        for k, ((scale, filepath, bands), result) in enumerate(zip(band_groups, results)):
+            if not tiled:
+                paths.append(result[0])
+            else:
+                paths.append(NOC_io.mosaic_geotiffs(result, os.path.join(str(filepath), fn),
+                                                    **mosaic_options[k]))
+    finally:
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return paths
+
+def storage_options(settings, satname):
+    """
+    Storage of the compact composites (settings['compact_storage']): the reflectances are
+    stored as uint16 (scaled by REFLECTANCE_SCALE), the quality bands as uint16, in GeoTiffs
+    compressed with a predictor and with internal overviews.
+
+    Arguments:
+    -----------
+    settings: dict
+        settings with the optional keys 'compact_storage' and 'compression'
+    satname: str
+        satellite mission
+
+    Returns:
+    -----------
+    storage: dict
+        'scale_factor' of the reflectances and 'compression' of the GeoTiffs, None if the
+        composites are stored as float
+
+    """
+
+    if not settings.get('compact_storage', False):
+        return None
+    return {'scale_factor': REFLECTANCE_SCALE[satname],
+            'compression': settings.get('compression', 'DEFLATE')}
+
+def compact_image(image, bands, storage):
+    """
+    Converts the bands of a composite to uint16 on the GEE server (the reflectances are
+    multiplied by the scale factor and rounded, the masked pixels are stored as 0 like in
+    the float downloads) and returns the options of the GeoTiff: scale factor of the
+    reflectances (so that they are read as reflectances, see NOC_io.read_bands),
+    compression with a predictor and overviews.
+
+    Arguments:
+    -----------
+    image: ee.Image
+        composite
+    bands: list of str
+        names of the bands to download
+    storage: dict
+        see storage_options
+
+    Returns:
+    -----------
+    image: ee.Image
+        composite with uint16 bands
+    options: dict
+        options of the GeoTiff, see NOC_io.download_geotiff
+
+    """
+
+    scale_factor = storage['scale_factor']
+    reflectances = [_ for _ in bands if not _ in QA_BANDS]
+    qa = [_ for _ in bands if _ in QA_BANDS]
+    compact = image.select(reflectances).multiply(scale_factor).round().clamp(0, 65535).toUint16()
+    if len(qa) > 0:
+        compact = compact.addBands(image.select(qa).toUint16())
+    scales = [None if _ in QA_BANDS or scale_factor == 1 else 1/scale_factor for _ in bands]
+    options = {'creation_options': NOC_io.gtiff_options(storage['compression']) + ['PREDICTOR=2'],
+               'scales': scales,
+               'overviews': NOC_io.OVERVIEW_LEVELS}
+
+    return compact, options
 
 def create_folder_structure(im_folder, sat_list):
     """
@@ -1203,7 +1861,7 @@ def create_folder_structure(im_folder, sat_list):
         filepaths.append(os.path.join(im_folder, sat_list, '60m'))
     # create the subfolders if they don't exist already
     for fp in filepaths: 
-        if not os.path.exists(fp): os.makedirs(fp)
+        os.makedirs(fp, exist_ok=True)
     
     return filepaths        
 
@@ -1244,8 +1902,11 @@ def remove_cloudy_images(im_list, sat_list, prc_cloud_cover=40):
 
 def get_metadata(inputs):
     """
-    Gets the metadata from the downloaded images by parsing .txt files located 
-    in the \meta subfolder. 
+    Gets the metadata from the downloaded images from the catalog of the composites (see
+    NOC_catalog) with a single query. The .txt files located in the \meta subfolder that
+    are not in the catalog yet (e.g. images downloaded before the catalog existed) are
+    parsed once and added to it, and the composites whose .txt file was deleted are
+    removed from it.
     
     KV WRL 2018
         
@@ -1264,48 +1925,75 @@ def get_metadata(inputs):
     """
     # directory containing the images
     filepath = os.path.join(inputs['filepath'],inputs['sitename'])
-    # initialize metadata dict
-    metadata = dict([])
+    catalog = NOC_catalog.get_catalog(inputs['filepath'])
+    # satellite missions downloaded for this site
+    sat_folders = [_ for _ in ['L5','L7','L8','S2'] if _ in os.listdir(filepath)]
     # loop through the satellite missions
-    for sat_list in ['L5','L7','L8','S2']:
-        # if a folder has been created for the given satellite mission
-        if sat_list in os.listdir(filepath):
-            # update the metadata dict
-            metadata[sat_list] = {'filenames':[], 'epsg':[], 'start_date':[], 'end_date':[], 'median_no':[]}
-            # directory where the metadata .txt files are stored
-            filepath_meta = os.path.join(filepath, sat_list, 'meta')
-            # get the list of filenames and sort it chronologically
-            filenames_meta = os.listdir(filepath_meta)
-            filenames_meta.sort()
-            # loop through the .txt files
-            for im_meta in filenames_meta:
-                # read them and extract the metadata info: filename, number of images in median
-                # epsg code and dates
-                with open(os.path.join(filepath_meta, im_meta), 'r') as f:
-                    filename = f.readline().split('\t')[1].replace('\n','')
-                    epsg = int(f.readline().split('\t')[1].replace('\n',''))
-                    start_date = f.readline().split('\t')[1].replace('\n','')
-                    end_date = f.readline().split('\t')[1].replace('\n','')
-                    
-                    #text = (f.readline().split('\t').replace('\n',''))
-                    #print (text)
-                    
-                    median_no = int(f.readline().split('\t')[1].replace('\n',''))
-                    
-                # store the information in the metadata dict
-                metadata[sat_list]['filenames'].append(filename)
-                metadata[sat_list]['median_no'].append(median_no)
-                metadata[sat_list]['epsg'].append(epsg)
-                metadata[sat_list]['start_date'].append(start_date)
-                metadata[sat_list]['end_date'].append(end_date)
+    for sat_list in sat_folders:
+        # directory where the metadata .txt files are stored
+        filepath_meta = os.path.join(filepath, sat_list, 'meta')
+        filenames_meta = [_ for _ in os.listdir(filepath_meta) if _.endswith('.txt')]
+        indexed = catalog.filenames(inputs['sitename'], sat_list)
+        # remove the composites whose .txt file was deleted
+        for filename in indexed - set([_.replace('.txt', '.tif') for _ in filenames_meta]):
+            catalog.remove(inputs['sitename'], sat_list, filename)
+        # loop through the .txt files that are not in the catalog
+        for im_meta in sorted(filenames_meta):
+            if im_meta.replace('.txt', '.tif') in indexed:
+                continue
+            # read them and extract the metadata info: filename, number of images in median
+            # epsg code and dates
+            with open(os.path.join(filepath_meta, im_meta), 'r') as f:
+                filename = f.readline().split('\t')[1].replace('\n','')
+                epsg = int(f.readline().split('\t')[1].replace('\n',''))
+                start_date = f.readline().split('\t')[1].replace('\n','')
+                end_date = f.readline().split('\t')[1].replace('\n','')
+                median_no = int(f.readline().split('\t')[1].replace('\n',''))
+            metadict = {'filename': filename, 'epsg': epsg, 'start_date': start_date,
+                        'end_date': end_date, 'median_no': median_no}
+            catalog.add(inputs['sitename'], sat_list, metadict,
+                        composite_paths(inputs['sitename'], sat_list, filename), checksums=False)
+
+    # single query for all the satellite missions of the site
+    metadata = catalog.get_metadata(inputs['sitename'], sat_folders)
+    for sat_list in sat_folders:
+        if not sat_list in metadata.keys():
+            metadata[sat_list] = {'filenames':[], 'epsg':[], 'start_date':[], 'end_date':[],
+                                  'median_no':[]}
                 
     # save a .pkl file containing the metadata dict
-    with open(os.path.join(filepath, inputs['sitename'] + '_metadata' + '.pkl'), 'wb') as f:
-        pickle.dump(metadata, f)
+    save_metadata(inputs, metadata)
     
     return metadata
 
-def Landsat_Coregistration(inputs):
+def composite_paths(sitename, satname, filename):
+    "paths of the GeoTiffs of a composite, relative to the data folder"
+    return [os.path.join(sitename, satname, folder, filename)
+            for folder, _ in COMPOSITE_BANDS[satname]]
+
+def Landsat_Coregistration(inputs, references=None):
+        """
+        Computes on the EE server the displacement between the least cloudy Landsat 8 image
+        (since 2019) and the least cloudy Sentinel-2 image acquired within 3 months of it.
+        Nothing is evaluated on the client: the metadata of the reference images is returned
+        as an ee.Dictionary, to be evaluated with the other metadata of the composite
+        (see get_composite_info).
+
+        Parameters:
+            inputs (dict): input parameters (polygon)
+            references (dict): ids of the reference images already selected (e.g. from the
+                cache of the queries), if None the reference images are searched
+
+        Returns:
+            displacement (ee.Image): X and Y displacement (in meters) at each pixel
+            references (ee.Dictionary): id and cloud cover of the reference images
+        """
+        if references is not None:
+            # reference images selected in a previous run
+            L8_reference = ee.Image('LANDSAT/LC08/C01/T1_SR/' + references['L8_id']).select('B2','B3','B4')
+            S2_reference = ee.Image('COPERNICUS/S2_SR/' + references['S2_id']).select('B2','B3','B4')
+            return _displacement(L8_reference, S2_reference), ee.Dictionary(references)
+
         #Co-register with Sentinel image
         #Find Overlapping cloud-minimal image of Landsat 8 and Sentinel 2
         #Landsat 8 image
@@ -1318,35 +2006,32 @@ def Landsat_Coregistration(inputs):
                         .select('B2','B3','B4')
 
 
-        # Extract Date and find S2 image within 4 months
-        cloud = L8_reference.get('CLOUD_COVER').getInfo()
-        time = (L8_reference.get('system:index').getInfo())
-        year = time[12:16]
-        month = time[16:18]
-        day = time[18:20]
-        L8_date = datetime(int(year), int(month), int(day))
-        #print('Landsat co-registration (slave) image date: ', L8_date)
-        print('Landsat co-registration (slave) image cloud cover: ', cloud)        
-        s2_start_date = L8_date + relativedelta(months=-3)
-        s2_end_date = L8_date + relativedelta(months=+3)
+        # Find S2 image within 3 months of the Landsat 8 image (dates computed on the server)
+        L8_date = ee.Date(L8_reference.get('system:time_start'))
+        s2_start_date = L8_date.advance(-3, 'month')
+        s2_end_date = L8_date.advance(3, 'month')
 
         #Sentinel 2 image
         S2_reference = ee.ImageCollection('COPERNICUS/S2_SR')\
-            .filterDate(str(s2_start_date)[:10], str(s2_end_date)[:10])\
+            .filterDate(s2_start_date, s2_end_date)\
             .filterBounds(ee.Geometry.Polygon(inputs['polygon']))\
             .filterMetadata('CLOUDY_PIXEL_PERCENTAGE','less_than', 60)\
             .sort('CLOUDY_PIXEL_PERCENTAGE')\
             .first()\
             .select('B2','B3','B4')
         
-        cloud = S2_reference.get('CLOUDY_PIXEL_PERCENTAGE').getInfo()
-        # time = (S2_reference.get('system:index').getInfo())
-        # year = time[0:3]
-        # month = time[3:6]
-        # day = time[6:8]
-        # s2_date = datetime(int(year), int(month), int(day))
-        # print('Sentinel co-registration (master) image date: ', s2_date)    
-        print('Sentinel co-registration (master) image cloud cover: ', cloud)
+        # metadata of the reference images (evaluated later with a single request)
+        references = ee.Dictionary({
+            'L8_id': L8_reference.get('system:index'),
+            'L8_cloud_cover': L8_reference.get('CLOUD_COVER'),
+            'S2_id': S2_reference.get('system:index'),
+            'S2_cloud_cover': S2_reference.get('CLOUDY_PIXEL_PERCENTAGE'),
+            })
+
+        return _displacement(L8_reference, S2_reference), references
+
+def _displacement(L8_reference, S2_reference):
+        "displacement between the Landsat 8 and Sentinel-2 reference images"
         
         #Extract Projection of Landsat 8 image
         proj = L8_reference.projection()
@@ -1363,3 +2048,86 @@ def Landsat_Coregistration(inputs):
             )
 
         return displacement
+
+def coregistration_mode(settings):
+    """
+    Co-registration of the Landsat composites: None if settings['coregistration'] is not
+    True, otherwise settings['coregistration_mode'] (optional):
+        'local' (default): the displacement of the site is computed once (see
+        site_displacement) and applied to the downloaded composites of all the periods
+        'server': the displacement is computed for each composite and applied on the EE
+        server before the download
+    """
+    if not settings.get('coregistration', False) == True:
+        return None
+    mode = settings.get('coregistration_mode', 'local')
+    if not mode in ['local', 'server']:
+        raise Exception('Unknown co-registration mode %s' % mode)
+    return mode
+
+# one lock per displacement raster, so that the periods of a site downloaded at the same
+# time compute its displacement once
+_DISPLACEMENT_LOCKS = dict([])
+_DISPLACEMENT_LOCKS_LOCK = threading.Lock()
+
+def site_displacement(inputs, settings):
+    """
+    Co-registration displacement of a site: the displacement between the Landsat 8 and
+    Sentinel-2 reference images (see Landsat_Coregistration) only depends on the polygon,
+    so it is computed once per site and stored as a GeoTiff with the bands dx and dy (in
+    metres) at 30 m in the coregistration folder of the site, then applied locally to the
+    Landsat composites of all the periods (see coregister_composite).
+
+    Arguments:
+    -----------
+    inputs: dict
+        input parameters (sitename, polygon, filepath)
+    settings: dict
+        settings of the download ('tile_area')
+
+    Returns:
+    -----------
+    fn: str
+        path of the displacement GeoTiff
+
+    """
+
+    folder = os.path.join(inputs['filepath'], inputs['sitename'], 'coregistration')
+    fn = inputs['sitename'] + '_displacement.tif'
+    path = os.path.join(folder, fn)
+    with _DISPLACEMENT_LOCKS_LOCK:
+        lock = _DISPLACEMENT_LOCKS.setdefault(path, threading.Lock())
+    with lock:
+        if os.path.exists(path) and NOC_io.check_geotiff(path, 2) is None:
+            return path
+        os.makedirs(folder, exist_ok=True)
+        displacement, references = Landsat_Coregistration(inputs)
+        references = references.getInfo()
+        print('Landsat co-registration (slave) image cloud cover: ', references['L8_cloud_cover'])
+        print('Sentinel co-registration (master) image cloud cover: ', references['S2_cloud_cover'])
+        download_bands(displacement.select(['dx', 'dy']), inputs['polygon'],
+                       [(30, folder, ['dx', 'dy'])], fn, 1, settings.get('tile_area', 100))
+        with open(os.path.join(folder, fn.replace('.tif', '.json')), 'w') as f:
+            json.dump(references, f)
+        print('Co-registration displacement of %s saved' % inputs['sitename'])
+
+    return path
+
+def coregister_composite(paths, bands, fn_displacement):
+    """
+    Co-registers the downloaded GeoTiffs of a Landsat composite with the displacement of
+    its site (see site_displacement), the QA bands are resampled with the nearest pixel.
+
+    Arguments:
+    -----------
+    paths: list of str
+        paths of the GeoTiffs of the composite (from download_bands)
+    bands: list of lists
+        names of the bands of each GeoTiff
+    fn_displacement: str
+        path of the displacement GeoTiff of the site
+
+    """
+    for path, names in zip(paths, bands):
+        NOC_io.displace_geotiff(path, fn_displacement,
+                                [k for k, name in enumerate(names) if name in QA_BANDS])
@@ -0,0 +1,250 @@
+"""
+This module contains the georeferencing functions: a lightweight affine transformation
+built from the 6-element georef vector returned by SDS_preprocess.preprocess_single and a
+ragged container for the contours of an image (one flat array of coordinates + offsets),
+so that all the contours of an image are converted with one vectorized call instead of
+one call per contour.
+
+Only numpy is used, so this module can be imported by SDS_tools.
+"""
+
+# load modules
+import numpy as np
+
+# length of a degree of latitude (and of longitude at the equator) in km, used by Earth Engine
+# to convert the scale of the downloads in EPSG:4326 and to convert offsets in degrees to metres
+KM_PER_DEGREE = 111.31949079327357
+
+###################################################################################################
+# AFFINE TRANSFORMATION
+###################################################################################################
+
+class Affine(object):
+    """
+    Affine transformation between pixel coordinates and world projected coordinates,
+    defined by the georef vector [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale] (same as
+    the GDAL geotransform). Replaces skimage.transform.AffineTransform, which was
+    created at every conversion.
+
+    Arguments:
+    -----------
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+    """
+
+    def __init__(self, georef):
+        georef = np.asarray(georef, dtype=float)
+        self.matrix = np.array([[georef[1], georef[2], georef[0]],
+                                [georef[4], georef[5], georef[3]],
+                                [0, 0, 1]])
+        self.inverse = np.linalg.inv(self.matrix)
+
+    def pix2world(self, points):
+        """
+        Converts pixel coordinates (row first and column second) to world coordinates (X,Y).
+
+        Arguments:
+        -----------
+        points: np.array
+            array with 2 columns (row first and column second)
+
+        Returns:
+        -----------
+        points_converted: np.array
+            array with 2 columns (X,Y)
+
+        """
+
+        points = np.asarray(points, dtype=float)
+        # columns are along X and rows along Y
+        return _apply(self.matrix, points[:,1], points[:,0])
+
+    def world2pix(self, points):
+        """
+        Converts world coordinates (X,Y) to image coordinates. As in the original
+        SDS_tools.convert_world2pix, the first column is the pixel column and the
+        second column the pixel row (so that they can be plotted directly as x,y).
+
+        Arguments:
+        -----------
+        points: np.array
+            array with 2 columns (X,Y)
+
+        Returns:
+        -----------
+        points_converted: np.array
+            array with 2 columns (column first and row second)
+
+        """
+
+        points = np.asarray(points, dtype=float)
+        return _apply(self.inverse, points[:,0], points[:,1])
+
+def _apply(mat, x, y):
+    "applies a 3x3 affine matrix to the vectors of coordinates x and y"
+    points_converted = np.empty((len(x),2))
+    points_converted[:,0] = mat[0,0]*x + mat[0,1]*y + mat[0,2]
+    points_converted[:,1] = mat[1,0]*x + mat[1,1]*y + mat[1,2]
+    return points_converted
+
+###################################################################################################
+# RAGGED ARRAYS OF COORDINATES
+###################################################################################################
+
+def ragged_from_list(arrays, ncols=2):
+    """
+    Concatenates a list of arrays of coordinates (e.g. the contours of an image) into one
+    flat array and the offsets of each array (array i is coords[offsets[i]:offsets[i+1]]).
+
+    Arguments:
+    -----------
+    arrays: list of np.array
+        arrays with at least ncols columns
+    ncols: int
+        number of columns that are kept
+
+    Returns:
+    -----------
+    coords: np.array
+        array with ncols columns containing all the coordinates
+    offsets: np.array
+        vector of len(arrays)+1 integers with the start/end of each array in coords
+
+    """
+
+    lengths = np.array([len(arr) for arr in arrays], dtype=int)
+    offsets = np.zeros(len(arrays)+1, dtype=int)
+    offsets[1:] = np.cumsum(lengths)
+    if offsets[-1] == 0:
+        return np.zeros((0,ncols)), offsets
+    coords = np.concatenate([np.asarray(arr, dtype=float).reshape(-1,np.shape(arr)[-1])[:,:ncols]
+                             for arr in arrays if len(arr) > 0])
+
+    return coords, offsets
+
+def ragged_to_list(coords, offsets):
+    """
+    Splits a flat array of coordinates back into a list of arrays (views, no copy).
+
+    Arguments:
+    -----------
+    coords: np.array
+        array containing all the coordinates
+    offsets: np.array
+        vector with the start/end of each array in coords (as from ragged_from_list)
+
+    Returns:
+    -----------
+    arrays: list of np.array
+        list with one array per contour
+
+    """
+
+    return [coords[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+def ragged_ids(offsets):
+    """
+    Returns the index of the array to which each coordinate of the flat array belongs.
+
+    Arguments:
+    -----------
+    offsets: np.array
+        vector with the start/end of each array (as from ragged_from_list)
+
+    Returns:
+    -----------
+    ids: np.array
+        vector of integers with one element per coordinate
+
+    """
+
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+def ragged_lengths(coords, offsets):
+    """
+    Computes the length of each polyline of a ragged array (sum of the distances between
+    consecutive points of the same polyline), like the shapely LineString.length.
+
+    Arguments:
+    -----------
+    coords: np.array
+        array with 2 columns (X,Y) containing all the coordinates
+    offsets: np.array
+        vector with the start/end of each polyline in coords
+
+    Returns:
+    -----------
+    lengths: np.array
+        vector with the length of each polyline
+
+    """
+
+    n = len(offsets)-1
+    if len(coords) < 2:
+        return np.zeros(n)
+    ids = ragged_ids(offsets)
+    # only the segments joining two points of the same polyline
+    same = ids[1:] == ids[:-1]
+    dist = np.hypot(np.diff(coords[:,0]), np.diff(coords[:,1]))
+
+    return np.bincount(ids[:-1][same], weights=dist[same], minlength=n)
+
+###################################################################################################
+# CONVERSION FUNCTIONS
+###################################################################################################
+
+def convert_pix2world(points, georef):
+    """
+    Converts pixel coordinates (row first and column second) to world projected
+    coordinates. A list of arrays is converted in a single vectorized call.
+
+    Arguments:
+    -----------
+    points: np.array or list of np.array
+        array with 2 columns (row first and column second)
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+
+    Returns:
+    -----------
+    points_converted: np.array or list of np.array
+        converted coordinates, first columns with X and second column with Y
+
+    """
+
+    tform = Affine(georef)
+    if type(points) is list:
+        coords, offsets = ragged_from_list(points)
+        return ragged_to_list(tform.pix2world(coords), offsets)
+    elif type(points) is np.ndarray:
+        return tform.pix2world(points)
+    else:
+        raise Exception('invalid input type')
+
+def convert_world2pix(points, georef):
+    """
+    Converts world projected coordinates (X,Y) to image coordinates (column first and
+    row second). A list of arrays is converted in a single vectorized call.
+
+    Arguments:
+    -----------
+    points: np.array or list of np.array
+        array with 2 columns (X,Y)
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+
+    Returns:
+    -----------
+    points_converted: np.array or list of np.array
+        converted coordinates (pixel column and row)
+
+    """
+
+    tform = Affine(georef)
+    if type(points) is list:
+        coords, offsets = ragged_from_list(points)
+        return ragged_to_list(tform.world2pix(coords), offsets)
+    elif type(points) is np.ndarray:
+        return tform.world2pix(points)
+    else:
+        raise Exception('invalid input type')
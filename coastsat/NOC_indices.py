@@ -0,0 +1,119 @@
+"""
+This module contains the spectral index engine: all the normalised-difference indices
+of an image (used for the classification features, the contouring and the figures)
+are computed from one band-major copy of the image and one cloud mask, written into
+a preallocated array and kept for the whole processing of the image, so that each
+index is only computed once per image.
+
+Only numpy is used.
+"""
+
+# load modules
+import numpy as np
+
+np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
+
+# normalised-difference indices as (band1, band2) in the order (B,G,R,NIR,SWIR1)
+INDICES = {'NIR-G': (3,1),      # NDWI
+           'SWIR-G': (4,1),     # MNDWI
+           'NIR-R': (3,2),      # NDVI
+           'SWIR-NIR': (4,3),
+           'B-R': (0,2)}
+
+# indices used as features by the classifier (in this order)
+FEATURE_INDICES = ['NIR-G', 'SWIR-G', 'NIR-R', 'SWIR-NIR', 'B-R']
+
+###################################################################################################
+# INDEX ENGINE
+###################################################################################################
+
+class SpectralIndices(object):
+    """
+    Computes and memoizes the normalised-difference indices of one image.
+    The indices are NaN on the cloudy pixels and where the sum of the two bands is 0.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        3D array containing the pansharpened/down-sampled bands (B,G,R,NIR,SWIR1)
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+
+    Use:
+    ```
+    indices = NOC_indices.SpectralIndices(im_ms, cloud_mask)
+    indices.compute(NOC_indices.FEATURE_INDICES) # all the indices in one pass
+    im_mndwi = indices['SWIR-G'] # already computed, not recalculated
+    ```
+    """
+
+    def __init__(self, im_ms, cloud_mask):
+        # band-major copy of the image, so that each band is contiguous in memory
+        self.bands = np.ascontiguousarray(np.moveaxis(im_ms, -1, 0), dtype=float)
+        self.valid = ~cloud_mask.astype(bool)
+        self.memo = dict([])
+
+    def compute(self, names):
+        """
+        Computes the indices that are not already in memory, writing them into one
+        preallocated array (one slice per index).
+
+        Arguments:
+        -----------
+        names: list of str
+            names of the indices (keys of NOC_indices.INDICES)
+
+        Returns:
+        -----------
+        im_indices: list of np.array
+            2D arrays with the indices in the same order as names
+
+        """
+
+        missing = [_ for _ in dict.fromkeys(names) if _ not in self.memo]
+        if len(missing) > 0:
+            out = np.empty((len(missing),) + self.valid.shape)
+            out.fill(np.nan)
+            num = np.empty(self.valid.shape)
+            den = np.empty(self.valid.shape)
+            for k, name in enumerate(missing):
+                if name not in INDICES:
+                    raise Exception('unknown spectral index: %s' % name)
+                b1, b2 = INDICES[name]
+                np.subtract(self.bands[b1], self.bands[b2], out=num)
+                np.add(self.bands[b1], self.bands[b2], out=den)
+                np.divide(num, den, out=out[k], where=np.logical_and(self.valid, den != 0))
+                self.memo[name] = out[k]
+                # the indices are shared by several functions, they must not be modified in place
+                self.memo[name].setflags(write=False)
+
+        return [self.memo[_] for _ in names]
+
+    def __getitem__(self, name):
+        return self.compute([name])[0]
+
+def get_indices(im_ms, cloud_mask, indices=None):
+    """
+    Returns the index engine of an image, creating it if indices is None (allows the
+    functions to be called with or without an engine shared by the caller).
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        3D array containing the pansharpened/down-sampled bands (B,G,R,NIR,SWIR1)
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    indices: SpectralIndices or None
+        engine already created for this image
+
+    Returns:
+    -----------
+    indices: SpectralIndices
+        engine for this image
+
+    """
+
+    if indices is None:
+        indices = SpectralIndices(im_ms, cloud_mask)
+
+    return indices
@@ -0,0 +1,529 @@
+"""
+This module contains the functions to download the zip files of Earth Engine and write the
+GeoTiffs without temporary files on disk: the HTTP response is streamed by chunks into a
+GDAL in-memory file (/vsimem/), the bands are read through /vsizip/ and the final
+compressed and tiled GeoTiff is written directly in the destination folder. Also contains
+a cheap integrity check of the GeoTiffs already downloaded, the mosaicking of the tiles of
+large downloads, the cropping of the sites of a download footprint and the local
+co-registration of the composites with the displacement raster of their site.
+"""
+
+# load modules
+import os
+import math
+import uuid
+import numpy as np
+from urllib.request import urlopen
+
+# other modules (osgeo is imported in the functions that read and write the GeoTiffs, so
+# that NOC_download can be imported without GDAL)
+from scipy import ndimage
+
+# CoastSat modules
+from coastsat import NOC_georef
+
+# creation options of the downloaded GeoTiffs
+GTIFF_OPTIONS = ['COMPRESS=DEFLATE', 'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+# overview levels of the compact composites (see NOC_download settings 'compact_storage')
+OVERVIEW_LEVELS = [2, 4, 8]
+
+###################################################################################################
+# IN-MEMORY DOWNLOAD
+###################################################################################################
+
+def stream_to_vsimem(url, chunk_size=2**20, timeout=600):
+    """
+    Downloads a file by chunks into a GDAL in-memory file.
+
+    Arguments:
+    -----------
+    url: str
+        URL of the file
+    chunk_size: int
+        number of bytes read at once
+    timeout: float
+        timeout of the connection in seconds
+
+    Returns:
+    -----------
+    fn_vsimem: str
+        path of the in-memory file (to be deleted with gdal.Unlink)
+
+    """
+
+    from osgeo import gdal
+
+    fn_vsimem = '/vsimem/%s.zip' % uuid.uuid4().hex
+    f = gdal.VSIFOpenL(fn_vsimem, 'wb')
+    if f is None:
+        raise Exception('Could not create %s' % fn_vsimem)
+    complete = False
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                gdal.VSIFWriteL(chunk, 1, len(chunk), f)
+        complete = True
+    finally:
+        gdal.VSIFCloseL(f)
+        if not complete:
+            gdal.Unlink(fn_vsimem)
+
+    return fn_vsimem
+
+def zip_members(fn_zip):
+    "paths (/vsizip/) of the .tif files in a zip file, in the order of the zip"
+    from osgeo import gdal
+    names = gdal.ReadDir('/vsizip/' + fn_zip) or []
+    return ['/vsizip/' + fn_zip + '/' + _ for _ in names if _.endswith('.tif')]
+
+###################################################################################################
+# WRITE GEOTIFF
+###################################################################################################
+
+def _creation_options(ds, compression='DEFLATE'):
+    "GeoTiff options with the predictor that suits the data type of the bands"
+    from osgeo import gdal
+    options = gtiff_options(compression)
+    data_type = ds.GetRasterBand(1).DataType
+    if data_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
+        return options + ['PREDICTOR=3']
+    return options + ['PREDICTOR=2']
+
+def gtiff_options(compression='DEFLATE'):
+    """
+    GTIFF_OPTIONS with another compression method (e.g. 'ZSTD'), DEFLATE if the GDAL
+    library was built without it.
+    """
+    from osgeo import gdal
+    if compression == 'DEFLATE':
+        return list(GTIFF_OPTIONS)
+    option_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST')
+    if option_list is None or not compression in option_list:
+        print('%s compression not available in GDAL %s, DEFLATE used instead' %
+              (compression, gdal.__version__))
+        return list(GTIFF_OPTIONS)
+    return ['COMPRESS=%s' % compression] + GTIFF_OPTIONS[1:]
+
+def read_bands(ds):
+    """
+    Reads the bands of a dataset and applies their scale factor and offset if they are
+    set (e.g. the reflectances of the compact composites stored as scaled integers), the
+    bands without scale factor are returned as stored.
+
+    Arguments:
+    -----------
+    ds: gdal.Dataset
+        dataset to read
+
+    Returns:
+    -----------
+    bands: list of np.array
+        2D array of each band
+
+    """
+
+    bands = []
+    for k in range(ds.RasterCount):
+        band = ds.GetRasterBand(k + 1)
+        im = band.ReadAsArray()
+        scale = band.GetScale()
+        offset = band.GetOffset()
+        if (scale is not None and not scale == 1) or (offset is not None and not offset == 0):
+            im = im.astype(np.float32)*(1 if scale is None else scale) + (offset or 0)
+        bands.append(im)
+
+    return bands
+
+def write_geotiff(src, fn, creation_options=None, scales=None, overviews=None):
+    """
+    Writes a dataset (or the path of a dataset) as a compressed and tiled GeoTiff. The file
+    is written with a temporary name in the destination folder and renamed atomically.
+    Optionally sets the scale factor of the bands (for the values stored as scaled
+    integers) and adds internal overviews.
+
+    Arguments:
+    -----------
+    src: gdal.Dataset or str
+        dataset to write
+    fn: str
+        path of the GeoTiff
+    creation_options: list of str
+        GeoTiff creation options, by default GTIFF_OPTIONS and a predictor
+    scales: list of float
+        scale factor of each band (physical value = stored value * scale), None for the
+        bands stored as physical values
+    overviews: list of int
+        levels of the internal overviews (e.g. OVERVIEW_LEVELS), None for no overviews
+
+    Returns:
+    -----------
+    fn: str
+        path of the GeoTiff
+
+    """
+
+    from osgeo import gdal
+
+    if isinstance(src, str):
+        src = gdal.Open(src)
+    if src is None:
+        raise Exception('Could not read the image of %s' % os.path.basename(fn))
+    if creation_options is None:
+        creation_options = _creation_options(src)
+    fn_tmp = '%s.%s.part' % (fn, uuid.uuid4().hex[:8])
+    try:
+        ds = gdal.Translate(fn_tmp, src, format='GTiff', creationOptions=creation_options)
+        if ds is None:
+            raise Exception('Could not write %s' % fn)
+        if scales is not None:
+            for k, scale in enumerate(scales):
+                if scale is not None:
+                    ds.GetRasterBand(k + 1).SetScale(scale)
+                    ds.GetRasterBand(k + 1).SetOffset(0)
+        if overviews is not None:
+            ds.BuildOverviews('AVERAGE', list(overviews))
+        ds = None
+        # overwrite if already exists
+        os.replace(fn_tmp, fn)
+    finally:
+        if os.path.exists(fn_tmp):
+            os.remove(fn_tmp)
+
+    return fn
+
+def download_geotiff(url, fn, chunk_size=2**20, creation_options=None, scales=None,
+                     overviews=None):
+    """
+    Downloads the zip file of an Earth Engine image and writes its bands as a single
+    compressed and tiled GeoTiff (the .tif files of the zip are stacked in the order of the
+    zip when there is one file per band). Nothing is written on disk except the GeoTiff.
+
+    Arguments:
+    -----------
+    url: str
+        download URL of the image (from getDownloadURL)
+    fn: str
+        path of the GeoTiff
+    chunk_size: int
+        number of bytes downloaded at once
+    creation_options, scales, overviews:
+        options of the GeoTiff, see write_geotiff
+
+    Returns:
+    -----------
+    fn: str
+        path of the GeoTiff
+
+    """
+
+    from osgeo import gdal
+
+    fn_zip = stream_to_vsimem(url, chunk_size)
+    fn_vrt = None
+    try:
+        members = zip_members(fn_zip)
+        if len(members) == 0:
+            raise Exception('No .tif file in the download of %s' % os.path.basename(fn))
+        elif len(members) == 1:
+            src = gdal.Open(members[0])
+        else:
+            # stack the single-band files
+            fn_vrt = fn_zip.replace('.zip', '.vrt')
+            src = gdal.BuildVRT(fn_vrt, members, separate=True)
+        write_geotiff(src, fn, creation_options, scales, overviews)
+        src = None
+    finally:
+        gdal.Unlink(fn_zip)
+        if fn_vrt is not None:
+            gdal.Unlink(fn_vrt)
+
+    return fn
+
+###################################################################################################
+# INTEGRITY CHECK
+###################################################################################################
+
+def check_geotiff(fn, n_bands=None):
+    """
+    Cheap integrity check of a downloaded GeoTiff: the file exists and is not empty, its
+    header can be read by GDAL, it has the expected number of bands and a valid size and
+    georeferencing. The pixels are not read.
+
+    Arguments:
+    -----------
+    fn: str
+        path of the GeoTiff
+    n_bands: int
+        expected number of bands (not checked if None)
+
+    Returns:
+    -----------
+    problem: str
+        description of the problem, or None if the GeoTiff passes the check
+
+    """
+
+    from osgeo import gdal
+
+    if not os.path.exists(fn):
+        return 'missing'
+    if os.path.getsize(fn) == 0:
+        return 'empty file'
+    ds = gdal.Open(fn, gdal.GA_ReadOnly)
+    if ds is None:
+        return 'header cannot be read by GDAL'
+    try:
+        if n_bands is not None and not ds.RasterCount == n_bands:
+            return '%d bands instead of %d' % (ds.RasterCount, n_bands)
+        if ds.RasterXSize == 0 or ds.RasterYSize == 0:
+            return 'empty raster (%d x %d pixels)' % (ds.RasterXSize, ds.RasterYSize)
+        georef = ds.GetGeoTransform(can_return_null=True)
+        if georef is None or georef[1] == 0 or georef[5] == 0:
+            return 'no georeferencing'
+    finally:
+        ds = None
+
+    return None
+
+###################################################################################################
+# MOSAIC
+###################################################################################################
+
+def _band_scales(ds):
+    "scale factor of each band of a dataset (None if not set), None if no band has one"
+    scales = [ds.GetRasterBand(k + 1).GetScale() for k in range(ds.RasterCount)]
+    scales = [None if _ is None or _ == 1 else _ for _ in scales]
+    return None if all([_ is None for _ in scales]) else scales
+
+def mosaic_geotiffs(fns, fn, creation_options=None, overviews=None):
+    """
+    Mosaics GeoTiffs on the same pixel grid (e.g. the tiles of a download) into a single
+    compressed and tiled GeoTiff, through a virtual mosaic (VRT) in memory. The scale
+    factors of the bands of the first GeoTiff are kept.
+
+    Arguments:
+    -----------
+    fns: list of str
+        paths of the GeoTiffs, with the same bands and pixel size
+    fn: str
+        path of the mosaic
+    creation_options: list of str
+        GeoTiff creation options, by default GTIFF_OPTIONS and a predictor
+    overviews: list of int
+        levels of the internal overviews, None for no overviews
+
+    Returns:
+    -----------
+    fn: str
+        path of the mosaic
+
+    """
+
+    from osgeo import gdal
+
+    ds = gdal.Open(fns[0])
+    scales = None if ds is None else _band_scales(ds)
+    ds = None
+    fn_vrt = '/vsimem/%s.vrt' % uuid.uuid4().hex
+    try:
+        vrt = gdal.BuildVRT(fn_vrt, list(fns))
+        if vrt is None:
+            raise Exception('Could not mosaic the tiles of %s' % os.path.basename(fn))
+        write_geotiff(vrt, fn, creation_options, scales, overviews)
+        vrt = None
+    finally:
+        gdal.Unlink(fn_vrt)
+
+    return fn
+
+def crop_geotiff(src, fn, bounds, creation_options=None):
+    """
+    Crops a GeoTiff to a bounding box (e.g. the site of a download footprint) with a GDAL
+    window: the pixels are copied without resampling, the window is extended to the
+    pixels that intersect the bounding box. The scale factors of the bands are kept and
+    the overviews are built again if the GeoTiff has overviews.
+
+    Arguments:
+    -----------
+    src: str
+        path of the GeoTiff to crop
+    fn: str
+        path of the cropped GeoTiff
+    bounds: tuple
+        bounding box (xmin, ymin, xmax, ymax) in the coordinates of the GeoTiff
+    creation_options: list of str
+        GeoTiff creation options, by default GTIFF_OPTIONS and a predictor
+
+    Returns:
+    -----------
+    fn: str
+        path of the cropped GeoTiff
+
+    """
+
+    from osgeo import gdal
+
+    ds = gdal.Open(src)
+    if ds is None:
+        raise Exception('Could not read %s' % src)
+    georef = ds.GetGeoTransform()
+    # window of the pixels (rows are from the top, georef[5] < 0)
+    col0 = max(0, int(math.floor(round((bounds[0] - georef[0])/georef[1], 6))))
+    col1 = min(ds.RasterXSize, int(math.ceil(round((bounds[2] - georef[0])/georef[1], 6))))
+    row0 = max(0, int(math.floor(round((bounds[3] - georef[3])/georef[5], 6))))
+    row1 = min(ds.RasterYSize, int(math.ceil(round((bounds[1] - georef[3])/georef[5], 6))))
+    if col1 <= col0 or row1 <= row0:
+        raise Exception('%s does not cover the bounding box %s' % (os.path.basename(src),
+                                                                    str(bounds)))
+    fn_vrt = '/vsimem/%s.vrt' % uuid.uuid4().hex
+    try:
+        vrt = gdal.Translate(fn_vrt, ds, format='VRT', srcWin=[col0, row0, col1 - col0,
+                                                                row1 - row0])
+        overviews = OVERVIEW_LEVELS if ds.GetRasterBand(1).GetOverviewCount() > 0 else None
+        write_geotiff(vrt, fn, creation_options, _band_scales(ds), overviews)
+        vrt = None
+    finally:
+        gdal.Unlink(fn_vrt)
+    ds = None
+
+    return fn
+
+###################################################################################################
+# CO-REGISTRATION
+###################################################################################################
+
+def displacement_coordinates(georef, shape, displacement_fn):
+    """
+    Pixel coordinates in a lon/lat image (EPSG:4326, like the downloads) of the pixels to
+    sample to apply a displacement raster (bands dx and dy in metres towards the east and
+    the north, e.g. the co-registration displacement of a site, see
+    NOC_download.site_displacement): the value of the pixel at p is the value of the image
+    at p + (dx, dy), like ee.Image.displace. The displacement is interpolated bilinearly
+    at the centre of the pixels of the image.
+
+    Arguments:
+    -----------
+    georef: tuple
+        geotransform of the image
+    shape: tuple
+        number of rows and columns of the image
+    displacement_fn: str
+        path of the displacement raster (lon/lat)
+
+    Returns:
+    -----------
+    rows, cols: np.array
+        fractional row and column of the image to sample for each pixel
+
+    """
+
+    from osgeo import gdal
+
+    ds = gdal.Open(displacement_fn)
+    if ds is None:
+        raise Exception('Could not read %s' % displacement_fn)
+    georef_d = ds.GetGeoTransform()
+    dx, dy = [_.astype(float) for _ in read_bands(ds)[:2]]
+    ds = None
+
+    # coordinates of the centre of the pixels of the image
+    lon = georef[0] + (np.arange(shape[1]) + 0.5)*georef[1]
+    lat = georef[3] + (np.arange(shape[0]) + 0.5)*georef[5]
+    lon, lat = np.meshgrid(lon, lat)
+    # displacement at the centre of the pixels (bilinear, the edges are extended)
+    rows_d = (lat - georef_d[3])/georef_d[5] - 0.5
+    cols_d = (lon - georef_d[0])/georef_d[1] - 0.5
+    dx = ndimage.map_coordinates(np.nan_to_num(dx), [rows_d, cols_d], order=1, mode='nearest')
+    dy = ndimage.map_coordinates(np.nan_to_num(dy), [rows_d, cols_d], order=1, mode='nearest')
+    # metres to degrees
+    lon = lon + dx/(1000*NOC_georef.KM_PER_DEGREE*np.cos(np.radians(lat)))
+    lat = lat + dy/(1000*NOC_georef.KM_PER_DEGREE)
+
+    return (lat - georef[3])/georef[5] - 0.5, (lon - georef[0])/georef[1] - 0.5
+
+def displace_array(im, rows, cols, order=3):
+    """
+    Samples a band at fractional pixel coordinates (see displacement_coordinates), with a
+    cubic spline (order 3) or the nearest pixel (order 0, e.g. for the QA bands). The
+    integer bands are rounded and clipped to their data type.
+
+    Arguments:
+    -----------
+    im: np.array
+        2D array of the band
+    rows, cols: np.array
+        fractional row and column of each pixel
+    order: int
+        order of the spline interpolation
+
+    Returns:
+    -----------
+    im_displaced: np.array
+        band with the same data type
+
+    """
+
+    displaced = ndimage.map_coordinates(im.astype(float), [rows, cols], order=order,
+                                        mode='nearest')
+    if np.issubdtype(im.dtype, np.integer):
+        info = np.iinfo(im.dtype)
+        displaced = np.clip(np.round(displaced), info.min, info.max)
+    return displaced.astype(im.dtype)
+
+def displace_geotiff(fn, displacement_fn, nearest_bands=None, fn_out=None):
+    """
+    Co-registers a GeoTiff locally with a displacement raster (see
+    displacement_coordinates): each band is resampled with a cubic spline (the QA bands
+    with the nearest pixel) and the GeoTiff is written again with the same data type,
+    compression, scale factors and overviews.
+
+    Arguments:
+    -----------
+    fn: str
+        path of the GeoTiff (lon/lat)
+    displacement_fn: str
+        path of the displacement raster (bands dx and dy in metres)
+    nearest_bands: list of int
+        indices of the bands resampled with the nearest pixel (e.g. the QA band)
+    fn_out: str
+        path of the co-registered GeoTiff (default: fn is replaced)
+
+    Returns:
+    -----------
+    fn_out: str
+        path of the co-registered GeoTiff
+
+    """
+
+    from osgeo import gdal
+
+    nearest_bands = [] if nearest_bands is None else nearest_bands
+    fn_out = fn if fn_out is None else fn_out
+    ds = gdal.Open(fn)
+    if ds is None:
+        raise Exception('Could not read %s' % fn)
+    rows, cols = displacement_coordinates(ds.GetGeoTransform(),
+                                          (ds.RasterYSize, ds.RasterXSize), displacement_fn)
+    compression = ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION', 'DEFLATE')
+    creation_options = _creation_options(ds, compression)
+    overviews = OVERVIEW_LEVELS if ds.GetRasterBand(1).GetOverviewCount() > 0 else None
+    scales = _band_scales(ds)
+    # resampled bands in memory, with the georeferencing and no data of the GeoTiff
+    mem = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize,
+                                             ds.RasterCount, ds.GetRasterBand(1).DataType)
+    mem.SetGeoTransform(ds.GetGeoTransform())
+    mem.SetProjection(ds.GetProjection())
+    for k in range(ds.RasterCount):
+        band = ds.GetRasterBand(k + 1)
+        im = displace_array(band.ReadAsArray(), rows, cols, 0 if k in nearest_bands else 3)
+        mem.GetRasterBand(k + 1).WriteArray(im)
+        if band.GetNoDataValue() is not None:
+            mem.GetRasterBand(k + 1).SetNoDataValue(band.GetNoDataValue())
+    ds = None
+    write_geotiff(mem, fn_out, creation_options, scales, overviews)
+    mem = None
+
+    return fn_out
@@ -0,0 +1,220 @@
+"""
+This module contains the functions to compute shoreline change statistics along the transects,
+as in the Digital Shoreline Analysis System (DSAS, Himmelstoss et al. 2018): Shoreline Change
+Envelope (SCE), Net Shoreline Movement (NSM), End Point Rate (EPR), Linear Regression Rate
+(LRR) and Weighted Linear Regression (WLR), with confidence intervals.
+
+The statistics are computed from the time-series of cross-shore distance returned by
+SDS_transects.compute_intersection, for all the transects at once.
+"""
+
+# load modules
+import os
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# other modules
+from scipy import stats
+
+np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
+
+###################################################################################################
+# DATES
+###################################################################################################
+
+def decimal_years(dates):
+    """
+    Converts dates into decimal years (e.g. 2018-07-02 12:00 --> 2018.5).
+
+    Arguments:
+    -----------
+    dates: list of datetimes or str ('yyyy-mm-dd')
+        dates to convert
+
+    Returns:
+    -----------
+    years: np.array
+        dates in decimal years
+
+    """
+
+    years = []
+    for date in dates:
+        if isinstance(date, str):
+            date = datetime.strptime(date[:10], '%Y-%m-%d')
+        date = date.replace(tzinfo=None)
+        start = datetime(date.year, 1, 1)
+        end = datetime(date.year + 1, 1, 1)
+        years.append(date.year + (date - start).total_seconds()/(end - start).total_seconds())
+
+    return np.array(years)
+
+def output_years(output):
+    """
+    Returns the date of each shoreline of the output dict in decimal years. For the
+    composites (output of NOC_shoreline.extract_shorelines) this is the middle of the
+    period of the composite, otherwise the date of the image.
+
+    Arguments:
+    -----------
+    output: dict
+        contains the extracted shorelines and corresponding metadata
+
+    Returns:
+    -----------
+    years: np.array
+        dates of the shorelines in decimal years
+
+    """
+
+    if 'dates' in output.keys():
+        return decimal_years(output['dates'])
+    else:
+        return 0.5*(decimal_years(output['start']) + decimal_years(output['end']))
+
+###################################################################################################
+# SHORELINE CHANGE STATISTICS
+###################################################################################################
+
+def _regression(years, Y, W, confidence):
+    """
+    weighted least-squares line fitted to each row of Y (NaN where W = 0), returns the slope,
+    the half-width of its confidence interval and the coefficient of determination
+    """
+
+    n = np.sum(W > 0, axis=1)
+    sw = np.sum(W, axis=1)
+    X = np.broadcast_to(years, Y.shape)
+    Y0 = np.where(W > 0, Y, 0)
+    xm = np.sum(W*X, axis=1)/sw
+    ym = np.sum(W*Y0, axis=1)/sw
+    dx = X - xm[:,None]
+    dy = np.where(W > 0, Y0 - ym[:,None], 0)
+    sxx = np.sum(W*dx**2, axis=1)
+    sxy = np.sum(W*dx*dy, axis=1)
+    syy = np.sum(W*dy**2, axis=1)
+    slope = sxy/sxx
+    # weighted residuals
+    ss_res = np.sum(W*(dy - slope[:,None]*dx)**2, axis=1)
+    se = np.sqrt(ss_res/(n - 2)/sxx)
+    ci = stats.t.ppf(0.5 + confidence/2, np.maximum(n - 2, 1))*se
+    r2 = 1 - ss_res/syy
+    # at least 3 points to get a confidence interval
+    ci[n < 3] = np.nan
+
+    return slope, ci, r2
+
+def compute_rates(cross_dist, years, weights=None, min_shorelines=6, confidence=0.95):
+    """
+    Computes the shoreline change statistics along all the transects at once:
+        - n_shorelines: number of shorelines intersecting the transect
+        - SCE: Shoreline Change Envelope, distance between the furthest and closest
+               shorelines to the origin [m]
+        - NSM: Net Shoreline Movement, distance between the oldest and youngest shorelines [m]
+        - EPR: End Point Rate, NSM divided by the time elapsed [m/year]
+        - LRR, LCI, LR2: Linear Regression Rate [m/year], half-width of its confidence
+          interval and coefficient of determination
+        - WLR, WCI, WR2: Weighted Linear Regression, same as LRR with the weights of the
+          shorelines (e.g. number of images in each composite)
+    The statistics are NaN for the transects intersected by less than min_shorelines.
+
+    Arguments:
+    -----------
+    cross_dist: dict
+        time-series of cross-shore distance along each of the transects (as returned by
+        SDS_transects.compute_intersection)
+    years: np.array
+        dates of the shorelines in decimal years (see output_years)
+    weights: np.array
+        weight of each shoreline for the WLR (e.g. output['median_no']), if None the WLR
+        is the same as the LRR
+    min_shorelines: int
+        minimum number of shorelines intersecting a transect (intersection threshold)
+    confidence: float
+        confidence level of the confidence intervals (e.g. 0.95 for 95%)
+
+    Returns:
+    -----------
+    rates: pd.DataFrame
+        table with one row per transect (index = name of the transect) and one column per
+        statistic
+
+    """
+
+    keys = list(cross_dist.keys())
+    years = np.asarray(years, dtype=float)
+    # one row per transect, one column per shoreline (in chronological order)
+    order = np.argsort(years, kind='mergesort')
+    years = years[order]
+    Y = np.array([np.asarray(cross_dist[key], dtype=float)[order] for key in keys]).reshape(len(keys), len(years))
+    valid = ~np.isnan(Y)
+    n = np.sum(valid, axis=1)
+
+    rates = pd.DataFrame(index=keys)
+    rates['n_shorelines'] = n
+    # shoreline change envelope
+    rates['SCE'] = np.nanmax(Y, axis=1) - np.nanmin(Y, axis=1)
+    # net shoreline movement and end point rate (oldest and youngest valid shorelines)
+    idx_first = np.argmax(valid, axis=1)
+    idx_last = len(years) - 1 - np.argmax(valid[:,::-1], axis=1)
+    rows = np.arange(len(keys))
+    rates['NSM'] = Y[rows,idx_last] - Y[rows,idx_first]
+    rates['EPR'] = rates['NSM'].values/(years[idx_last] - years[idx_first])
+    # linear regression rate
+    rates['LRR'], rates['LCI'], rates['LR2'] = _regression(years, Y, valid.astype(float), confidence)
+    # weighted linear regression
+    if weights is None:
+        w = np.ones(len(years))
+    else:
+        w = np.asarray(weights, dtype=float)[order]
+    W = np.where(valid, w[None,:], 0)
+    rates['WLR'], rates['WCI'], rates['WR2'] = _regression(years, Y, W, confidence)
+
+    # intersection threshold
+    rates.loc[n < max(min_shorelines, 2), rates.columns[1:]] = np.nan
+
+    return rates
+
+def save_rates(rates, transects, settings):
+    """
+    Saves the shoreline change statistics as a table (.csv) and as a .geojson file with the
+    transects and their statistics as attributes, in the folder of the site.
+
+    Arguments:
+    -----------
+    rates: pd.DataFrame
+        table of statistics returned by compute_rates
+    transects: dict
+        contains the X and Y coordinates of each transect
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath)
+        'output_epsg': int
+            spatial reference system of the transects
+
+    Returns:
+    -----------
+    gdf: gpd.GeoDataFrame
+        transects with the statistics as attributes
+
+    """
+
+    # SDS_tools imports GDAL (osgeo), so it is only imported to save the files
+    from coastsat import SDS_tools
+
+    sitename = settings['inputs']['sitename']
+    filepath = os.path.join(settings['inputs']['filepath'], sitename)
+    # table
+    fn = os.path.join(filepath, sitename + '_transect_rates.csv')
+    rates.to_csv(fn, sep=',', index_label='transect')
+    # transects with the statistics as attributes
+    gdf = SDS_tools.transects_to_gdf(transects)
+    for col in rates.columns:
+        gdf[col] = rates.loc[gdf['name'].values, col].values
+    gdf.crs = {'init':'epsg:'+str(settings['output_epsg'])}
+    gdf.to_file(os.path.join(filepath, sitename + '_transect_rates.geojson'),
+                driver='GeoJSON', encoding='utf-8')
+    print('Shoreline change statistics saved in ' + filepath)
+
+    return gdf
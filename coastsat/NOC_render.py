@@ -0,0 +1,345 @@
+"""
+This module contains the functions to render quicklook .jpg files straight from
+the image arrays (without matplotlib) and to write them from background threads,
+so that the shoreline extraction does not wait on figure I/O.
+
+The interactive quality control (settings['check_detection']) still uses the
+matplotlib figures in NOC_shoreline.show_detection.
+"""
+
+# load modules
+import queue
+import threading
+import numpy as np
+
+# other modules
+from PIL import Image, ImageDraw
+
+np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
+
+# colours of the classes in the order (sand, whitewater, water), same as in show_detection
+CLASS_COLOURS = np.array([[253/255, 141/255, 60/255],
+                          [204/255, 1, 1],
+                          [0, 91/255, 1]])
+
+###################################################################################################
+# ARRAY RENDERING FUNCTIONS
+###################################################################################################
+
+def rescale_rgb(im_ms, cloud_mask, prob_high=99.9):
+    """
+    Stretches the contrast of the RGB bands of a multispectral image between 0 and
+    the prob_high percentile of the cloud-free pixels (same as
+    SDS_preprocess.rescale_image_intensity) and paints the masked pixels in white.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        3D array containing the pansharpened/down-sampled bands (B,G,R,NIR,SWIR1)
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    prob_high: float
+        probability of exceedence used to calculate the upper percentile
+
+    Returns:
+    -----------
+    im_RGB: np.array
+        3D array (rows, columns, 3) with the rescaled RGB values between 0 and 1
+
+    """
+
+    im_RGB = np.ones((im_ms.shape[0], im_ms.shape[1], 3))
+    # nothing to stretch if the whole image is masked
+    if np.all(cloud_mask):
+        return im_RGB
+    for i, k in enumerate([2,1,0]):
+        band = im_ms[:,:,k]
+        prc_high = np.nanpercentile(band[~cloud_mask], prob_high)
+        if not prc_high > 0:
+            prc_high = 1
+        im_RGB[:,:,i] = np.clip(band/prc_high, 0, 1)
+    # masked pixels and no data are painted in white
+    im_RGB[cloud_mask,:] = 1.0
+    im_RGB[np.isnan(im_RGB)] = 1.0
+
+    return im_RGB
+
+def classified_rgb(im_RGB, im_labels):
+    """
+    Paints the classified pixels (sand, whitewater, water) on top of an RGB image.
+
+    Arguments:
+    -----------
+    im_RGB: np.array
+        3D array with the RGB values between 0 and 1
+    im_labels: np.array
+        3D image containing a boolean image for each class in the order (sand, swash, water)
+
+    Returns:
+    -----------
+    im_class: np.array
+        3D array with the RGB values between 0 and 1
+
+    """
+
+    im_class = np.copy(im_RGB)
+    for k in range(im_labels.shape[2]):
+        im_class[im_labels[:,:,k],:] = CLASS_COLOURS[k,:]
+
+    return im_class
+
+def index_rgb(im_index):
+    """
+    Maps a spectral index (e.g. MNDWI) to the blue-white-red colormap, stretched between
+    the minimum and maximum of the index like matplotlib's imshow. NaNs are painted white.
+
+    Arguments:
+    -----------
+    im_index: np.array
+        2D array with the index values
+
+    Returns:
+    -----------
+    im_bwr: np.array
+        3D array with the RGB values between 0 and 1
+
+    """
+
+    im_bwr = np.ones((im_index.shape[0], im_index.shape[1], 3))
+    valid = ~np.isnan(im_index)
+    if not np.any(valid):
+        return im_bwr
+    vmin = np.min(im_index[valid])
+    vmax = np.max(im_index[valid])
+    t = np.zeros(im_index.shape)
+    if vmax > vmin:
+        t[valid] = (im_index[valid] - vmin)/(vmax - vmin)
+    # blue -> white for t < 0.5, white -> red for t > 0.5
+    low = np.logical_and(valid, t < 0.5)
+    high = np.logical_and(valid, t >= 0.5)
+    im_bwr[low,0] = 2*t[low]
+    im_bwr[low,1] = 2*t[low]
+    im_bwr[high,1] = 2*(1 - t[high])
+    im_bwr[high,2] = 2*(1 - t[high])
+
+    return im_bwr
+
+def draw_points(im, pts_pix, colour=(0,0,0), size=2):
+    """
+    Rasterizes a set of points (e.g. the shoreline in pixel coordinates) on an RGB image
+    as small squares, without any plotting library.
+
+    Arguments:
+    -----------
+    im: np.array
+        3D array with the RGB values (modified in place)
+    pts_pix: np.array
+        array with 2 columns (column first and row second), as returned by
+        SDS_tools.convert_world2pix
+    colour: tuple
+        RGB colour of the points, between 0 and 1
+    size: int
+        width in pixels of the squares drawn at each point
+
+    Returns:
+    -----------
+    im: np.array
+        the same image with the points drawn on it
+
+    """
+
+    if len(pts_pix) == 0:
+        return im
+    pts_pix = pts_pix[~np.any(np.isnan(pts_pix), axis=1),:]
+    cols = np.round(pts_pix[:,0]).astype(int)
+    rows = np.round(pts_pix[:,1]).astype(int)
+    # one square of size x size pixels around each point
+    offsets = np.arange(size) - size//2
+    rows = (rows[:,None,None] + offsets[None,:,None]).ravel()
+    cols = (cols[:,None,None] + offsets[None,None,:]).ravel()
+    idx_inside = np.logical_and(np.logical_and(rows >= 0, rows < im.shape[0]),
+                                np.logical_and(cols >= 0, cols < im.shape[1]))
+    im[rows[idx_inside], cols[idx_inside],:] = colour
+
+    return im
+
+def compose_panels(panels, gap=10):
+    """
+    Places several RGB images next to each other (or on top of each other if the
+    images are much wider than high, as in show_detection) separated by a white gap.
+
+    Arguments:
+    -----------
+    panels: list of np.array
+        3D arrays of the same shape with the RGB values between 0 and 1
+    gap: int
+        width of the white gap between the panels (in pixels)
+
+    Returns:
+    -----------
+    im: np.array
+        3D array with all the panels
+
+    """
+
+    nrows, ncols = panels[0].shape[:2]
+    vertical = ncols > 2.5*nrows
+    n = len(panels)
+    if vertical:
+        im = np.ones((n*nrows + (n-1)*gap, ncols, 3))
+        for k, panel in enumerate(panels):
+            im[k*(nrows+gap):k*(nrows+gap)+nrows,:,:] = panel
+    else:
+        im = np.ones((nrows, n*ncols + (n-1)*gap, 3))
+        for k, panel in enumerate(panels):
+            im[:,k*(ncols+gap):k*(ncols+gap)+ncols,:] = panel
+
+    return im
+
+def save_image(im, fn, title='', quality=95):
+    """
+    Saves an RGB array as a .jpg file with PIL, with an optional title written above the image.
+
+    Arguments:
+    -----------
+    im: np.array
+        3D array with the RGB values between 0 and 1
+    fn: str
+        filepath + filename of the .jpg file
+    title: str
+        text written in a white band above the image
+    quality: int
+        jpeg quality (0-100)
+
+    Returns:
+    -----------
+    Saves the .jpg file
+
+    """
+
+    im_uint8 = (np.clip(im, 0, 1)*255 + 0.5).astype(np.uint8)
+    img = Image.fromarray(im_uint8, mode='RGB')
+    if title:
+        img_title = Image.new('RGB', (img.width, img.height + 20), (255,255,255))
+        img_title.paste(img, (0,20))
+        ImageDraw.Draw(img_title).text((5,4), title, fill=(0,0,0))
+        img = img_title
+    img.save(fn, quality=quality)
+
+def render_preprocessed(im_ms, cloud_mask, date, satname, fn):
+    """
+    Renders the RGB quicklook of a preprocessed image (replaces SDS_preprocess.create_jpg
+    when no interactive figure is needed).
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        3D array containing the pansharpened/down-sampled bands (B,G,R,NIR,SWIR1)
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    date: str
+        string containing the date at which the image was acquired
+    satname: str
+        name of the satellite mission (e.g., 'L5')
+    fn: str
+        filepath + filename of the .jpg file
+
+    Returns:
+    -----------
+    Saves the .jpg file
+
+    """
+
+    im_RGB = rescale_rgb(im_ms, cloud_mask)
+    save_image(im_RGB, fn, title=date + '   ' + satname)
+
+def render_detection(im_ms, cloud_mask, im_labels, im_mwi, sl_pix, title, fn):
+    """
+    Renders the three panels of NOC_shoreline.show_detection (RGB, classified image and
+    MNDWI) with the shoreline drawn on top, without creating a matplotlib figure.
+
+    Arguments:
+    -----------
+    im_ms: np.array
+        RGB + downsampled NIR and SWIR
+    cloud_mask: np.array
+        2D cloud mask with True where cloud pixels are
+    im_labels: np.array
+        3D image containing a boolean image for each class in the order (sand, swash, water)
+    im_mwi: np.array
+        2D array with the MNDWI
+    sl_pix: np.array
+        shoreline in pixel coordinates (column first and row second)
+    title: str
+        text written above the panels (sitename, date and satellite)
+    fn: str
+        filepath + filename of the .jpg file
+
+    Returns:
+    -----------
+    Saves the .jpg file
+
+    """
+
+    im_RGB = rescale_rgb(im_ms, cloud_mask)
+    im_class = classified_rgb(im_RGB, im_labels)
+    im_bwr = index_rgb(im_mwi)
+    panels = [draw_points(_, sl_pix) for _ in [im_RGB, im_class, im_bwr]]
+    save_image(compose_panels(panels), fn, title=title)
+
+###################################################################################################
+# BACKGROUND WRITER
+###################################################################################################
+
+class JpgWriter(object):
+    """
+    Runs the rendering functions of this module in background threads fed by a bounded
+    queue. When the queue is full, submit() blocks, so the memory used by the pending
+    images stays bounded. Numpy and PIL release the GIL while rendering and encoding,
+    so the threads run alongside the shoreline extraction.
+
+    Use as a context manager:
+    ```
+    with NOC_render.JpgWriter() as writer:
+        writer.submit(NOC_render.render_preprocessed, im_ms, cloud_mask, date, satname, fn)
+    ```
+    """
+
+    def __init__(self, n_workers=2, max_queued=4):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(n_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+            except Exception as e: # do not stop the other images (for long runs)
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        "queue func(*args), blocks if there are already max_queued images pending"
+        self.queue.put((func, args))
+
+    def close(self):
+        "wait for all the queued images to be written and stop the threads"
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for e in self.errors:
+            print('Could not save .jpg file: %s' % e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
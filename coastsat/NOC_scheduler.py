@@ -0,0 +1,232 @@
+"""
+This module contains a scheduler to run many requests to the Earth Engine server (e.g. the
+downloads of the site x period x satellite matrix) without exceeding its quotas:
+    - a token bucket limits the rate at which the requests are started
+    - a semaphore bounds the number of requests in flight
+    - the failed requests (e.g. HTTP 429 Too Many Requests) are retried with an exponential
+      backoff with jitter
+    - progress and throughput metrics are printed while the requests run
+
+The requests are blocking functions (ee client, urllib, GDAL), run by asyncio in a pool of
+threads.
+"""
+
+# load modules
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+###################################################################################################
+# RATE LIMITING AND BACKOFF
+###################################################################################################
+
+class TokenBucket(object):
+    """
+    Token bucket: requests can be started at rate per second on average, with bursts of
+    up to capacity requests.
+
+    Arguments:
+    -----------
+    rate: float
+        number of tokens added per second
+    capacity: int
+        maximum number of tokens in the bucket (default: 1 second of tokens, at least 1)
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = max(1, self.rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    async def acquire(self):
+        "waits for a token (all the coroutines run in the same event loop)"
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens)/self.rate)
+
+def backoff_delay(attempt, base_delay=1, max_delay=60):
+    """
+    Delay before retrying a request, exponential backoff with full jitter: random between 0
+    and min(max_delay, base_delay*2**attempt) seconds.
+    """
+    return random.uniform(0, min(max_delay, base_delay*2**attempt))
+
+def call_with_backoff(func, max_retries=5, base_delay=1, max_delay=60):
+    """
+    Calls a function and retries it with an exponential backoff with jitter if it raises
+    an exception (e.g. a request to the Earth Engine server).
+
+    Arguments:
+    -----------
+    func: function
+        function without arguments (use functools.partial or a lambda)
+    max_retries: int
+        number of retries before the exception is raised
+    base_delay, max_delay: float
+        parameters of the backoff in seconds (see backoff_delay)
+
+    Returns:
+    -----------
+    result:
+        value returned by func
+
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print('Request failed (%s), retrying in %.1f s' % (str(e)[:80], delay))
+            time.sleep(delay)
+
+###################################################################################################
+# METRICS
+###################################################################################################
+
+class Metrics(object):
+    """
+    Progress and throughput of the requests run by the scheduler.
+    """
+
+    def __init__(self, n_tasks=0):
+        self.n_tasks = n_tasks
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_retries = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.durations = []
+        self.t_start = time.monotonic()
+
+    def start(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def stop(self, duration):
+        self.in_flight -= 1
+        self.durations.append(duration)
+
+    def summary(self):
+        "dict with the metrics"
+        elapsed = time.monotonic() - self.t_start
+        return {'tasks': self.n_tasks,
+                'done': self.n_done,
+                'failed': self.n_failed,
+                'retries': self.n_retries,
+                'max_in_flight': self.max_in_flight,
+                'elapsed': elapsed,
+                'throughput': self.n_done/elapsed*60 if elapsed > 0 else 0,
+                'mean_duration': sum(self.durations)/len(self.durations) if self.durations else 0}
+
+    def print_progress(self, end='\r'):
+        m = self.summary()
+        print('%d/%d done, %d failed, %d retries, %d in flight, %.1f tasks/min      ' %
+              (m['done'], m['tasks'], m['failed'], m['retries'], self.in_flight,
+               m['throughput']), end=end)
+
+###################################################################################################
+# SCHEDULER
+###################################################################################################
+
+async def _run_task(func, loop, executor, semaphore, bucket, metrics, max_retries,
+                    base_delay, max_delay, verbose):
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            await bucket.acquire()
+            metrics.start()
+            t0 = time.monotonic()
+            try:
+                result = await loop.run_in_executor(executor, func)
+                error = None
+            except Exception as e:
+                error = e
+            metrics.stop(time.monotonic() - t0)
+        if error is None:
+            metrics.n_done += 1
+            if verbose:
+                metrics.print_progress()
+            return result
+        if attempt == max_retries:
+            metrics.n_failed += 1
+            if verbose:
+                metrics.print_progress()
+            return error
+        # wait outside of the semaphore, so that other requests can run
+        metrics.n_retries += 1
+        await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay))
+
+async def run_tasks_async(tasks, max_in_flight=4, rate=1, burst=None, max_retries=5,
+                          base_delay=1, max_delay=60, metrics=None, verbose=True):
+    """
+    Coroutine of run_tasks.
+    """
+
+    loop = asyncio.get_running_loop()
+    metrics = Metrics(len(tasks)) if metrics is None else metrics
+    metrics.n_tasks = len(tasks)
+    metrics.t_start = time.monotonic()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    bucket = TokenBucket(rate, burst)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        results = await asyncio.gather(*[_run_task(func, loop, executor, semaphore, bucket,
+                                                   metrics, max_retries, base_delay, max_delay,
+                                                   verbose) for func in tasks])
+    if verbose:
+        metrics.print_progress(end='\n')
+
+    return results
+
+def run_tasks(tasks, max_in_flight=4, rate=1, burst=None, max_retries=5, base_delay=1,
+              max_delay=60, metrics=None, verbose=True):
+    """
+    Runs blocking functions (e.g. the downloads of several sites and periods) concurrently,
+    with at most max_in_flight running at the same time, started at most at rate per second,
+    and retries the functions that raise an exception with an exponential backoff with
+    jitter.
+
+    Arguments:
+    -----------
+    tasks: list of functions
+        functions without arguments (use functools.partial)
+    max_in_flight: int
+        maximum number of functions running at the same time
+    rate: float
+        maximum number of functions started per second (on average)
+    burst: int
+        maximum number of functions started at once (default: 1 second of rate)
+    max_retries: int
+        number of retries before a function is reported as failed
+    base_delay, max_delay: float
+        parameters of the backoff in seconds (see backoff_delay)
+    metrics: Metrics
+        metrics updated while the functions run (e.g. to monitor them from another thread)
+    verbose: bool
+        if True, prints the progress
+
+    Returns:
+    -----------
+    results: list
+        value returned by each function, or the exception raised by its last attempt
+
+    """
+
+    coroutine = run_tasks_async(tasks, max_in_flight, rate, burst, max_retries, base_delay,
+                                max_delay, metrics, verbose)
+    # run the event loop in its own thread, so that it also works from an IPython console
+    # where an event loop may already be running
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
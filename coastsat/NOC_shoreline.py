@@ -18,7 +18,6 @@ import skimage.morphology as morphology
 
 # machine learning modules
 from sklearn.externals import joblib
-from shapely.geometry import LineString
 
 # other modules
 import matplotlib.patches as mpatches
@@ -29,7 +28,8 @@ from pylab import ginput
 import pickle
 
 # CoastSat modules
-from coastsat import SDS_tools, SDS_preprocess, NOC_tools
+from coastsat import SDS_tools, SDS_preprocess, NOC_tools, NOC_render, NOC_georef, NOC_indices, \
+                    NOC_store
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
@@ -37,7 +37,7 @@ np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 # IMAGE CLASSIFICATION FUNCTIONS
 ###################################################################################################
 
-def calculate_features(im_ms, cloud_mask, im_bool):
+def calculate_features(im_ms, cloud_mask, im_bool, indices=None):
     """
     Calculates features on the image that are used for the supervised classification. 
     The features include spectral normalized-difference indices and standard 
@@ -53,6 +53,8 @@ def calculate_features(im_ms, cloud_mask, im_bool):
         2D cloud mask with True where cloud pixels are
     im_bool: np.array
         2D array of boolean indicating where on the image to calculate the features
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -63,44 +65,29 @@ def calculate_features(im_ms, cloud_mask, im_bool):
     """
 
     # add all the multispectral bands
-    features = np.expand_dims(im_ms[im_bool,0],axis=1)
-    for k in range(1,im_ms.shape[2]):
-        feature = np.expand_dims(im_ms[im_bool,k],axis=1)
-        features = np.append(features, feature, axis=-1)
-    # NIR-G
-    im_NIRG = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRG[im_bool],axis=1), axis=-1)
-    # SWIR-G
-    im_SWIRG = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRG[im_bool],axis=1), axis=-1)
-    # NIR-R
-    im_NIRR = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRR[im_bool],axis=1), axis=-1)
-    # SWIR-NIR
-    im_SWIRNIR = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,3], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRNIR[im_bool],axis=1), axis=-1)
-    # B-R
-    im_BR = SDS_tools.nd_index(im_ms[:,:,0], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_BR[im_bool],axis=1), axis=-1)
+    n_bands = im_ms.shape[2]
+    n_indices = len(NOC_indices.FEATURE_INDICES)
+    features = np.empty((int(np.sum(im_bool)), 2*(n_bands + n_indices)))
+    for k in range(n_bands):
+        features[:,k] = im_ms[im_bool,k]
+    # spectral indices (NIR-G, SWIR-G, NIR-R, SWIR-NIR, B-R), computed in one pass and
+    # kept in the index engine for the contouring and the figures
+    indices = NOC_indices.get_indices(im_ms, cloud_mask, indices)
+    im_indices = indices.compute(NOC_indices.FEATURE_INDICES)
+    for k, im_ind in enumerate(im_indices):
+        features[:,n_bands+k] = im_ind[im_bool]
     # calculate standard deviation of individual bands
-    for k in range(im_ms.shape[2]):
+    for k in range(n_bands):
         im_std =  SDS_tools.image_std(im_ms[:,:,k], 1)
-        features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+        features[:,n_bands+n_indices+k] = im_std[im_bool]
     # calculate standard deviation of the spectral indices
-    im_std = SDS_tools.image_std(im_NIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_NIRR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRNIR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_BR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+    for k, im_ind in enumerate(im_indices):
+        im_std = SDS_tools.image_std(im_ind, 1)
+        features[:,2*n_bands+n_indices+k] = im_std[im_bool]
 
     return features
 
-def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
+def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf, indices=None):
     """
     Classifies every pixel in the image in one of 4 classes:
         - sand                                          --> label = 1
@@ -124,6 +111,8 @@ def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
         minimum number of pixels that have to be connected to belong to the SAND class
     clf: joblib object
         pre-trained classifier
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -135,7 +124,8 @@ def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
     """
 
     # calculate features
-    vec_features = calculate_features(im_ms, cloud_mask, np.ones(cloud_mask.shape).astype(bool))
+    vec_features = calculate_features(im_ms, cloud_mask, np.ones(cloud_mask.shape).astype(bool),
+                                      indices)
     vec_features[np.isnan(vec_features)] = 1e-9 # NaN values are create when std is too close to 0
 
     # remove NaNs and cloudy pixels
@@ -218,7 +208,7 @@ def find_wl_contours1(im_ndwi, cloud_mask, im_ref_buffer):
 
     return contours
 
-def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
+def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer, indices=None):
     """
     New robust method for extracting shorelines. Incorporates the classification
     component to refine the treshold and make it specific to the sand/water interface.
@@ -238,6 +228,8 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
         thresholding algorithm.
     im_ref_buffer: np.array
         binary image containing a buffer around the reference shoreline
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -253,10 +245,10 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
     nrows = cloud_mask.shape[0]
     ncols = cloud_mask.shape[1]
 
-    # calculate Normalized Difference Modified Water Index (SWIR - G)
-    im_mwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    # calculate Normalized Difference Modified Water Index (NIR - G)
-    im_wi = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
+    # get Normalized Difference Modified Water Index (SWIR - G) and
+    # Normalized Difference Water Index (NIR - G), already computed for the features
+    indices = NOC_indices.get_indices(im_ms, cloud_mask, indices)
+    im_mwi, im_wi = indices.compute(['SWIR-G', 'NIR-G'])
     # stack indices together
     im_ind = np.stack((im_wi, im_mwi), axis=-1)
     vec_ind = im_ind.reshape(nrows*ncols,2)
@@ -363,7 +355,7 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings):
 
         # convert reference shoreline to pixel coordinates
         ref_sl = settings['reference_shoreline']
-        ref_sl_conv = SDS_tools.convert_epsg(ref_sl, settings['output_epsg'],image_epsg)[:,:-1]
+        ref_sl_conv = SDS_tools.convert_epsg_xy(ref_sl, settings['output_epsg'],image_epsg)
         ref_sl_pix = SDS_tools.convert_world2pix(ref_sl_conv, georef)
         ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
 
@@ -417,28 +409,17 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
 
     """
 
+    # flatten the contours into one array of coordinates + offsets (ragged array)
+    coords, offsets = NOC_georef.ragged_from_list(list(contours))
     # convert pixel coordinates to world coordinates
-    contours_world = SDS_tools.convert_pix2world(contours, georef)
+    coords_world = NOC_georef.Affine(georef).pix2world(coords)
     # convert world coordinates to desired spatial reference system
-    contours_epsg = SDS_tools.convert_epsg(contours_world, image_epsg, settings['output_epsg'])
+    coords_epsg = SDS_tools.convert_epsg_xy(coords_world, image_epsg, settings['output_epsg'])
     # remove contours that have a perimeter < min_length_sl (provided in settings dict)
     # this enables to remove the very small contours that do not correspond to the shoreline
-    contours_long = []
-    for l, wl in enumerate(contours_epsg):
-        coords = [(wl[k,0], wl[k,1]) for k in range(len(wl))]
-        a = LineString(coords) # shapely LineString structure
-        if a.length >= settings['min_length_sl']:
-            #if settings['satname'] == 'L5':
-                #print(a.length)
-            contours_long.append(wl)
-            
+    idx_long = NOC_georef.ragged_lengths(coords_epsg, offsets) >= settings['min_length_sl']
     # format points into np.array
-    x_points = np.array([])
-    y_points = np.array([])
-    for k in range(len(contours_long)):
-        x_points = np.append(x_points,contours_long[k][:,0])
-        y_points = np.append(y_points,contours_long[k][:,1])
-    contours_array = np.transpose(np.array([x_points,y_points]))
+    contours_array = coords_epsg[idx_long[NOC_georef.ragged_ids(offsets)]]
 
     shoreline = contours_array
 
@@ -448,8 +429,8 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
         idx_cloud = np.where(cloud_mask)
         idx_cloud = np.array([(idx_cloud[0][k], idx_cloud[1][k]) for k in range(len(idx_cloud[0]))])
         # convert to world coordinates and same epsg as the shoreline points
-        coords_cloud = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(idx_cloud, georef),
-                                               image_epsg, settings['output_epsg'])[:,:-1]
+        coords_cloud = SDS_tools.convert_epsg_xy(SDS_tools.convert_pix2world(idx_cloud, georef),
+                                                  image_epsg, settings['output_epsg'])
         
         # only keep the shoreline points that are at least 30m from any cloud pixel
         idx_keep = np.ones(len(shoreline)).astype(bool)
@@ -460,8 +441,43 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
 
     return shoreline
 
+def shoreline_to_pix(shoreline, image_epsg, georef, settings):
+    """
+    Converts the shoreline from world coordinates (output_epsg) into the pixel
+    coordinates of the image, for plotting.
+
+    Arguments:
+    -----------
+    shoreline: np.array
+        array of points with the X and Y coordinates of the shoreline
+    image_epsg: int
+        spatial reference system of the image from which the contours were extracted
+    georef: np.array
+        vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale]
+    settings: dict with the following keys
+        'output_epsg': int
+            output spatial reference system as EPSG code
+
+    Returns:
+    -----------
+    sl_pix: np.array
+        shoreline in pixel coordinates (column first and row second)
+
+    """
+
+    # use try/except in case there are no coordinates to be transformed (shoreline = [])
+    try:
+        sl_pix = SDS_tools.convert_world2pix(SDS_tools.convert_epsg(shoreline,
+                                                                    settings['output_epsg'],
+                                                                    image_epsg)[:,[0,1]], georef)
+    except:
+        # if try fails, just add nan into the shoreline vector so the next parts can still run
+        sl_pix = np.array([[np.nan, np.nan],[np.nan, np.nan]])
+
+    return sl_pix
+
 def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
-                   settings, date, satname):
+                   settings, date, satname, indices=None):
     """
     Shows the detected shoreline to the user for visual quality control. 
     The user can accept/reject the detected shorelines  by using keep/skip
@@ -496,6 +512,8 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
             if True, lets user manually accept/reject the mapped shorelines
         'save_figure': bool
             if True, saves a -jpg file for each mapped shoreline
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:
     -----------
@@ -524,18 +542,11 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
         im_class[im_labels[:,:,k],1] = colours[k,1]
         im_class[im_labels[:,:,k],2] = colours[k,2]
 
-    # compute MNDWI grayscale image
-    im_mwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+    # get MNDWI grayscale image
+    im_mwi = NOC_indices.get_indices(im_ms, cloud_mask, indices)['SWIR-G']
 
     # transform world coordinates of shoreline into pixel coordinates
-    # use try/except in case there are no coordinates to be transformed (shoreline = [])
-    try:
-        sl_pix = SDS_tools.convert_world2pix(SDS_tools.convert_epsg(shoreline,
-                                                                    settings['output_epsg'],
-                                                                    image_epsg)[:,[0,1]], georef)
-    except:
-        # if try fails, just add nan into the shoreline vector so the next parts can still run
-        sl_pix = np.array([[np.nan, np.nan],[np.nan, np.nan]])
+    sl_pix = shoreline_to_pix(shoreline, image_epsg, georef, settings)
 
     if plt.get_fignums():
             # get open figure if it exists
@@ -693,6 +704,11 @@ def extract_shorelines(metadata, settings, inputs):
             if True, lets user manually accept/reject the mapped shorelines
         'save_figure': bool
             if True, saves a -jpg file for each mapped shoreline
+        'jpg_workers': int (optional)
+            number of background threads writing the .jpg files (default 2)
+        'save_legacy_output': bool (optional)
+            if True, also saves the output as _output.pkl and _output.geojson
+            (default True), the shorelines are always saved in _output.gpkg (see NOC_store)
             
     Returns:
     -----------
@@ -703,9 +719,6 @@ def extract_shorelines(metadata, settings, inputs):
 
     sitename = settings['inputs']['sitename']
     filepath_data = settings['inputs']['filepath']
-    filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
-    # initialise output structure
-    output = dict([])
     # create a subfolder to store the .jpg images showing the detection
     filepath_jpg = os.path.join(filepath_data, sitename, 'jpg_files', 'detection')
     if not os.path.exists(filepath_jpg):
@@ -715,6 +728,59 @@ def extract_shorelines(metadata, settings, inputs):
 
     print('Mapping shorelines:')
 
+    # when the detections are not checked by the user, the figures are rendered from the
+    # arrays in background threads instead of matplotlib
+    writer = NOC_render.JpgWriter(n_workers=settings.get('jpg_workers', 2))
+
+    try:
+        output = _extract_shorelines_loop(metadata, settings, writer)
+    finally:
+        # wait for the last .jpg files to be written
+        writer.close()
+
+    # Close figure window if still open
+    if plt.get_fignums():
+        plt.close()
+
+    # change the format to have one list sorted by date with all the shorelines (easier to use)
+    output = NOC_tools.merge_output(output)
+
+    # save the shorelines in the GeoPackage of the site (one layer per satellite)
+    NOC_store.save_output(output, filepath_data, sitename, settings['output_epsg'])
+
+    if settings.get('save_legacy_output', True):
+        # save outputput structure as output.pkl
+        filepath = os.path.join(filepath_data, sitename)
+        with open(os.path.join(filepath, sitename + '_output.pkl'), 'wb') as f:
+            pickle.dump(output, f)
+
+        # save output into a gdb.GeoDataFrame
+        gdf = NOC_tools.output_to_gdf(output)
+        # set projection
+        gdf.crs = {'init':'epsg:'+str(settings['output_epsg'])}
+        # save as geojson
+        gdf.to_file(os.path.join(filepath, sitename + '_output.geojson'), driver='GeoJSON', encoding='utf-8')
+
+    return output
+
+def _extract_shorelines_loop(metadata, settings, writer):
+    """
+    Loops through the satellite missions and images of extract_shorelines and maps
+    the shorelines. The .jpg files of the detections are submitted to writer.
+
+    Returns:
+    -----------
+    output: dict
+        contains the extracted shorelines organised by satellite mission
+
+    """
+
+    sitename = settings['inputs']['sitename']
+    filepath_data = settings['inputs']['filepath']
+    filepath_models = os.path.join(os.getcwd(), 'classification', 'models')
+    filepath_jpg = os.path.join(filepath_data, sitename, 'jpg_files', 'detection')
+    output = dict([])
+
     # loop through satellite list
     for satname in metadata.keys():
         
@@ -771,23 +837,27 @@ def extract_shorelines(metadata, settings, inputs):
             im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
                                                     pixel_size, settings)
 
+            # spectral indices of the image, computed once and shared by the steps below
+            indices = NOC_indices.SpectralIndices(im_ms, cloud_mask)
+
             # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
             im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
-                                    min_beach_area_pixels, clf)
+                                    min_beach_area_pixels, clf, indices)
 
             # there are two options to map the contours:
             # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
             # otherwise use find_wl_contours2 (traditional)
             try: # use try/except structure for long runs
                 if sum(sum(im_labels[:,:,0])) < 10 :
-                    # compute MNDWI image (SWIR-G)
-                    im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+                    # get MNDWI image (SWIR-G)
+                    im_mndwi = indices['SWIR-G']
                     # find water contours on MNDWI grayscale image
                     contours_mwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
                 else:
                     # use classification to refine threshold and extract the sand/water interface
                     contours_wi, contours_mwi = find_wl_contours2(im_ms, im_labels,
-                                                cloud_mask, buffer_size_pixels, im_ref_buffer)
+                                                cloud_mask, buffer_size_pixels, im_ref_buffer,
+                                                indices)
             except:
                 print('Could not map shoreline for this image: ' + filenames[i])
                 continue
@@ -797,15 +867,21 @@ def extract_shorelines(metadata, settings, inputs):
             # visualise the mapped shorelines, there are two options:
             # if settings['check_detection'] = True, shows the detection to the user for accept/reject
             # if settings['save_figure'] = True, saves a figure for each mapped shoreline
-            if settings['check_detection'] or settings['save_figure']:
-                date = filenames[i][:19]
-                if not settings['check_detection']:
-                    plt.ioff() # turning interactive plotting off
+            date = filenames[i][:19]
+            if settings['check_detection']:
                 skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
-                                            image_epsg, georef, settings, date, satname)
+                                            image_epsg, georef, settings, date, satname,
+                                            indices)
                 # if the user decides to skip the image, continue and do not save the mapped shoreline
                 if skip_image:
                     continue
+            elif settings['save_figure']:
+                # no user interaction, render the figure in the background
+                sl_pix = shoreline_to_pix(shoreline, image_epsg, georef, settings)
+                im_mwi = indices['SWIR-G']
+                writer.submit(NOC_render.render_detection, im_ms, cloud_mask, im_labels, im_mwi,
+                              sl_pix, sitename + '   ' + date + '   ' + satname,
+                              os.path.join(filepath_jpg, date + '_' + satname + '.jpg'))
 
             # append to output variables
             output_start_time.append(metadata[satname]['start_date'][i])
@@ -826,23 +902,4 @@ def extract_shorelines(metadata, settings, inputs):
                 }
         print('')
 
-    # Close figure window if still open
-    if plt.get_fignums():
-        plt.close()
-
-    # change the format to have one list sorted by date with all the shorelines (easier to use)
-    output = NOC_tools.merge_output(output)
-
-    # save outputput structure as output.pkl
-    filepath = os.path.join(filepath_data, sitename)
-    with open(os.path.join(filepath, sitename + '_output.pkl'), 'wb') as f:
-        pickle.dump(output, f)
-
-    # save output into a gdb.GeoDataFrame
-    gdf = NOC_tools.output_to_gdf(output)
-    # set projection
-    gdf.crs = {'init':'epsg:'+str(settings['output_epsg'])}
-    # save as geojson
-    gdf.to_file(os.path.join(filepath, sitename + '_output.geojson'), driver='GeoJSON', encoding='utf-8')
-
     return output
@@ -0,0 +1,245 @@
+"""
+This module contains the functions to store the mapped shorelines in a GeoPackage per site,
+with one layer per satellite mission, instead of a pickled dict and a .geojson file.
+
+The shorelines of a site are written in bulk (one transaction per layer) and can be queried
+by bounding box (using the spatial index of the GeoPackage) and by date without loading the
+other shorelines. The coordinates are returned as one flat array + offsets (see NOC_georef),
+with the attributes (start, end, satname, median_no) as columns.
+
+The GeoPackages can also be opened directly in QGIS/ArcGIS.
+"""
+
+# load modules
+import os
+import numpy as np
+
+# other modules
+from osgeo import ogr, osr
+
+# CoastSat modules
+from coastsat import NOC_georef
+
+# attribute columns of the layers
+FIELDS = [('start_date', ogr.OFTString),
+          ('end_date', ogr.OFTString),
+          ('satname', ogr.OFTString),
+          ('median_no', ogr.OFTInteger),
+          ('filename', ogr.OFTString)]
+
+###################################################################################################
+# WKB ENCODING/DECODING
+###################################################################################################
+
+def _linestring_wkb(coords):
+    "little-endian WKB of a 2D LineString, built from the array of coordinates"
+    header = np.array([1], dtype=np.uint8).tobytes() + np.array([2, len(coords)], dtype='<u4').tobytes()
+    return header + np.ascontiguousarray(coords[:,:2], dtype='<f8').tobytes()
+
+def _linestring_coords(wkb):
+    "array of coordinates of a 2D LineString from its WKB"
+    wkb = bytes(wkb)
+    dtype = '<' if wkb[0] == 1 else '>'
+    n = int(np.frombuffer(wkb[5:9], dtype=dtype + 'u4')[0])
+    return np.frombuffer(wkb[9:9+16*n], dtype=dtype + 'f8').reshape(n,2)
+
+###################################################################################################
+# WRITE
+###################################################################################################
+
+def get_store_path(filepath, sitename):
+    "path of the GeoPackage of a site"
+    return os.path.join(filepath, sitename, sitename + '_output.gpkg')
+
+def save_output(output, filepath, sitename, epsg):
+    """
+    Saves the output of NOC_shoreline.extract_shorelines (merged with NOC_tools.merge_output)
+    in the GeoPackage of the site, one layer per satellite mission. The layers are
+    overwritten, so that the GeoPackage always contains the last run for each mission.
+    Shorelines with less than 2 points are not stored.
+
+    Arguments:
+    -----------
+    output: dict
+        contains the shorelines and the keys 'start', 'end', 'satname', 'median_no'
+    filepath: str
+        directory in which all the sites are stored
+    sitename: str
+        name of the site
+    epsg: int
+        spatial reference system of the shorelines
+
+    Returns:
+    -----------
+    fn: str
+        path of the GeoPackage
+
+    """
+
+    fn = get_store_path(filepath, sitename)
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(fn):
+        ds = driver.Open(fn, 1)
+    else:
+        ds = driver.CreateDataSource(fn)
+    if ds is None:
+        raise Exception('Could not open %s' % fn)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg))
+    filenames = output.get('filename', output.get('filenamse', ['']*len(output['shorelines'])))
+
+    satnames = np.array(output['satname'])
+    for satname in np.unique(satnames):
+        # overwrite the layer of this satellite
+        for k in range(ds.GetLayerCount()):
+            if ds.GetLayerByIndex(k).GetName() == satname:
+                ds.DeleteLayer(k)
+                break
+        layer = ds.CreateLayer(str(satname), srs, ogr.wkbLineString,
+                               options=['GEOMETRY_NAME=geom', 'SPATIAL_INDEX=YES'])
+        for name, field_type in FIELDS:
+            layer.CreateField(ogr.FieldDefn(name, field_type))
+        defn = layer.GetLayerDefn()
+        # all the shorelines of the layer in one transaction
+        layer.StartTransaction()
+        for i in np.where(satnames == satname)[0]:
+            sl = np.asarray(output['shorelines'][i])
+            if len(sl) < 2:
+                continue
+            feature = ogr.Feature(defn)
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(_linestring_wkb(sl)))
+            feature.SetField('start_date', str(output['start'][i]))
+            feature.SetField('end_date', str(output['end'][i]))
+            feature.SetField('satname', str(satname))
+            feature.SetField('median_no', int(output['median_no'][i]))
+            feature.SetField('filename', str(filenames[i]))
+            layer.CreateFeature(feature)
+        layer.CommitTransaction()
+    ds = None
+
+    return fn
+
+###################################################################################################
+# QUERY
+###################################################################################################
+
+def load_output(filepath, sitename, satnames=None, bbox=None, dates=None):
+    """
+    Reads the shorelines of a site from its GeoPackage, optionally only the ones that
+    intersect a bounding box and/or overlap a period. Only the matching shorelines are read.
+
+    Arguments:
+    -----------
+    filepath: str
+        directory in which all the sites are stored
+    sitename: str
+        name of the site
+    satnames: list of str
+        satellite missions (layers) to read, all of them if None
+    bbox: list
+        [xmin, ymin, xmax, ymax] in the spatial reference system of the shorelines
+    dates: list of str
+        ['yyyy-mm-dd', 'yyyy-mm-dd'], only the shorelines whose period (start to end)
+        overlaps these dates are read
+
+    Returns:
+    -----------
+    store: dict
+        'coords': np.array with 2 columns (X,Y) with the points of all the shorelines
+        'offsets': np.array with the start/end of each shoreline in coords
+        'start', 'end', 'satname', 'median_no', 'filename', 'sitename': np.array with
+        one element per shoreline
+
+    """
+
+    store = {'coords': np.zeros((0,2)), 'offsets': np.zeros(1, dtype=int)}
+    for name, _ in FIELDS + [('sitename', None)]:
+        store[name] = []
+    fn = get_store_path(filepath, sitename)
+    if not os.path.exists(fn):
+        return _to_arrays(store)
+
+    ds = ogr.Open(fn, 0)
+    shorelines = []
+    for k in range(ds.GetLayerCount()):
+        layer = ds.GetLayerByIndex(k)
+        if satnames is not None and not layer.GetName() in satnames:
+            continue
+        if bbox is not None:
+            layer.SetSpatialFilterRect(bbox[0], bbox[1], bbox[2], bbox[3])
+        if dates is not None:
+            layer.SetAttributeFilter("end_date >= '%s' AND start_date <= '%s'" % (dates[0], dates[1]))
+        for feature in layer:
+            shorelines.append(_linestring_coords(feature.GetGeometryRef().ExportToWkb()))
+            for name, _ in FIELDS:
+                store[name].append(feature.GetField(name))
+            store['sitename'].append(sitename)
+    ds = None
+
+    store['coords'], store['offsets'] = NOC_georef.ragged_from_list(shorelines)
+
+    return _to_arrays(store)
+
+def query_sites(filepath, sitenames, satnames=None, bbox=None, dates=None):
+    """
+    Same as load_output but for several sites, the shorelines of all the sites are
+    returned in the same arrays (with the name of the site in store['sitename']).
+
+    Arguments:
+    -----------
+    filepath: str
+        directory in which all the sites are stored
+    sitenames: list of str
+        names of the sites
+    satnames, bbox, dates:
+        see load_output
+
+    Returns:
+    -----------
+    store: dict
+        see load_output
+
+    """
+
+    stores = [load_output(filepath, sitename, satnames, bbox, dates) for sitename in sitenames]
+    store = dict([])
+    for key in stores[0].keys() if len(stores) > 0 else []:
+        if key == 'offsets':
+            continue
+        store[key] = np.concatenate([_[key] for _ in stores])
+    lengths = np.concatenate([np.diff(_['offsets']) for _ in stores]) if len(stores) > 0 else []
+    store['offsets'] = np.append(0, np.cumsum(lengths)).astype(int)
+
+    return store
+
+def store_to_output(store):
+    """
+    Converts the shorelines read from the GeoPackage into the output dict of
+    NOC_shoreline.extract_shorelines (one array per shoreline, sorted by date), which
+    can be passed to SDS_transects.compute_intersection.
+
+    Arguments:
+    -----------
+    store: dict
+        shorelines returned by load_output or query_sites
+
+    Returns:
+    -----------
+    output: dict
+        contains the shorelines and the keys 'start', 'end', 'satname', 'median_no', 'filename'
+
+    """
+
+    idx_sorted = np.argsort(store['start'], kind='mergesort')
+    shorelines = NOC_georef.ragged_to_list(store['coords'], store['offsets'])
+    output = {'shorelines': [np.array(shorelines[i]) for i in idx_sorted]}
+    for key in ['start', 'end', 'satname', 'median_no', 'filename']:
+        output[key] = [store[key][i] for i in idx_sorted]
+
+    return output
+
+def _to_arrays(store):
+    "converts the attribute lists into arrays"
+    for name in [_[0] for _ in FIELDS] + ['sitename']:
+        store[name] = np.array(store[name], dtype=int if name == 'median_no' else object)
+    return store
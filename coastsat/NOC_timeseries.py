@@ -0,0 +1,175 @@
+"""
+This module contains the functions to extract the values of long time-series (e.g. 15-minutes
+tide records or hourly wave data) at the dates of the satellite images. The dates are
+converted to int64 epochs (nanoseconds) and looked up with np.searchsorted, and large .csv
+files are read by chunks keeping only the records around the dates of the images.
+"""
+
+# load modules
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+###################################################################################################
+# DATES
+###################################################################################################
+
+def to_epoch(dates):
+    """
+    Converts dates to int64 epochs in nanoseconds. Timezone-aware dates are converted to
+    UTC, naive dates are taken as they are (so both series should be in the same timezone).
+
+    Arguments:
+    -----------
+    dates: list of datetimes, pd.Series or np.array of datetime64
+        dates to convert
+
+    Returns:
+    -----------
+    epochs: np.array
+        int64 nanoseconds since 1970-01-01
+
+    """
+
+    return pd.DatetimeIndex(dates).values.astype('datetime64[ns]').astype(np.int64)
+
+def parse_dates(values):
+    """
+    Parses ISO-8601 dates (e.g. the column of dates of a .csv file) in UTC, naive dates
+    are taken as UTC. The format is explicit because pandas >= 2 otherwise infers it from
+    the first value, and the tide records mix dates with and without fractional seconds
+    (e.g. 00:15:00.000003+00:00 and 00:30:00+00:00 in examples/NARRA_tides.csv).
+
+    Arguments:
+    -----------
+    values: list of str or pd.Series
+        dates to parse
+
+    Returns:
+    -----------
+    dates: pd.DatetimeIndex or pd.Series
+        timezone-aware dates in UTC
+
+    """
+
+    try:
+        return pd.to_datetime(values, format='ISO8601', utc=True)
+    except ValueError:
+        # pandas < 2 does not know format='ISO8601' but parses the mixed dates without it
+        return pd.to_datetime(values, utc=True)
+
+###################################################################################################
+# LOOKUP
+###################################################################################################
+
+def get_values(dates, dates_ts, values_ts, method='next'):
+    """
+    Extracts the values of a long time-series at a set of dates, for all the dates at once.
+
+    Make sure that dates and dates_ts are in the same timezone (also aware or naive)
+
+    Arguments:
+    -----------
+    dates: list of datetimes
+        dates at which the values of the time-series should be extracted
+    dates_ts: list of datetimes or np.array of int64 epochs (from to_epoch)
+        dates of the long time-series, in chronological order
+    values_ts: np.array
+        array with the values of the long time-series (tides, waves, etc...)
+    method: str
+        'next': value of the first record after each date (same as the original
+                SDS_tools.get_closest_datapoint)
+        'nearest': value of the closest record in time
+        'linear': linear interpolation between the two records around each date
+
+    Returns:
+    -----------
+    values: np.array
+        values corresponding to the input dates
+
+    """
+
+    t = to_epoch(dates)
+    t_ts = np.asarray(dates_ts) if np.asarray(dates_ts).dtype == np.int64 else to_epoch(dates_ts)
+    values_ts = np.asarray(values_ts)
+    if len(t) == 0:
+        return np.array([])
+
+    # check if the time-series cover the dates
+    if np.min(t) < t_ts[0] or np.max(t) > t_ts[-1]:
+        raise Exception('Time-series do not cover the range of your input dates')
+
+    if method == 'next':
+        # first record strictly after each date
+        idx = np.searchsorted(t_ts, t, side='right')
+        if np.any(idx == len(t_ts)):
+            raise Exception('Time-series do not cover the range of your input dates')
+        values = values_ts[idx]
+    elif method == 'nearest':
+        idx = np.clip(np.searchsorted(t_ts, t, side='left'), 1, len(t_ts) - 1)
+        idx_before = (t - t_ts[idx-1]) <= (t_ts[idx] - t)
+        values = values_ts[np.where(idx_before, idx - 1, idx)]
+    elif method == 'linear':
+        # interpolate on the time relative to the first record to keep the precision
+        values = np.interp((t - t_ts[0]).astype(float), (t_ts - t_ts[0]).astype(float),
+                           values_ts.astype(float))
+    else:
+        raise Exception('method should be next, nearest or linear')
+
+    return values
+
+###################################################################################################
+# READ LARGE FILES
+###################################################################################################
+
+def read_timeseries(fn, dates, date_col='dates', value_col='tide', window=timedelta(days=1),
+                    chunksize=1000000):
+    """
+    Reads a long time-series from a .csv file by chunks of rows, only keeping the records that
+    are within window of one of the dates, so that files with decades of 15-minutes records
+    do not have to be loaded in memory.
+
+    Arguments:
+    -----------
+    fn: str
+        path to the .csv file
+    dates: list of datetimes
+        dates at which the time-series will be used (e.g. output['dates'])
+    date_col: str
+        name of the column with the dates
+    value_col: str
+        name of the column with the values
+    window: timedelta
+        records further than window from all the dates are discarded
+    chunksize: int
+        number of rows read at once
+
+    Returns:
+    -----------
+    dates_ts: np.array
+        int64 epochs of the records that were kept (can be passed to get_values)
+    values_ts: np.array
+        values of the records that were kept
+
+    """
+
+    t = np.sort(to_epoch(dates))
+    if len(t) == 0:
+        return np.array([], dtype=np.int64), np.array([])
+    window = np.int64(window.total_seconds()*1e9)
+    dates_kept = []
+    values_kept = []
+    for chunk in pd.read_csv(fn, usecols=[date_col, value_col], chunksize=chunksize):
+        t_chunk = to_epoch(parse_dates(chunk[date_col]))
+        # distance to the closest date of the images
+        idx = np.clip(np.searchsorted(t, t_chunk), 1, max(len(t) - 1, 1))
+        dist = np.minimum(np.abs(t_chunk - t[idx-1]), np.abs(t[np.minimum(idx, len(t)-1)] - t_chunk))
+        idx_keep = dist <= window
+        dates_kept.append(t_chunk[idx_keep])
+        values_kept.append(np.array(chunk[value_col])[idx_keep])
+    dates_ts = np.concatenate(dates_kept) if len(dates_kept) > 0 else np.array([], dtype=np.int64)
+    values_ts = np.concatenate(values_kept) if len(values_kept) > 0 else np.array([])
+    # make sure that the records are in chronological order
+    idx_sorted = np.argsort(dates_ts, kind='mergesort')
+
+    return dates_ts[idx_sorted], values_ts[idx_sorted]
@@ -11,12 +11,13 @@ import matplotlib.pyplot as plt
 import pdb
 
 # other modules
-from osgeo import gdal, osr
+from osgeo import gdal
 import geopandas as gpd
-from shapely import geometry
-import skimage.transform as transform
 from astropy.convolution import convolve
 
+# CoastSat modules
+from coastsat import SDS_tools, NOC_georef
+
 ###################################################################################################
 # COORDINATES CONVERSION FUNCTIONS
 ###################################################################################################
@@ -42,29 +43,9 @@ def convert_pix2world(points, georef):
         
     """
     
-    # make affine transformation matrix
-    aff_mat = np.array([[georef[1], georef[2], georef[0]],
-                       [georef[4], georef[5], georef[3]],
-                       [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
-
-    # if list of arrays
-    if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            tmp = arr[:,[1,0]]
-            points_converted.append(tform(tmp))
-          
-    # if single array
-    elif type(points) is np.ndarray:
-        tmp = points[:,[1,0]]
-        points_converted = tform(tmp)
-        
-    else:
-        raise Exception('invalid input type')
-        
+    # affine transformation from the georef vector, a list of arrays is converted in one call
+    points_converted = NOC_georef.convert_pix2world(points, georef)
+
     return points_converted
 
 def convert_world2pix(points, georef):
@@ -88,28 +69,9 @@ def convert_world2pix(points, georef):
     
     """
     
-    # make affine transformation matrix
-    aff_mat = np.array([[georef[1], georef[2], georef[0]],
-                       [georef[4], georef[5], georef[3]],
-                       [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
-    
-    # if list of arrays
-    if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            points_converted.append(tform.inverse(points))
-            
-    # if single array    
-    elif type(points) is np.ndarray:
-        points_converted = tform.inverse(points)
-        
-    else:
-        print('invalid input type')
-        raise
-        
+    # affine transformation from the georef vector, a list of arrays is converted in one call
+    points_converted = NOC_georef.convert_world2pix(points, georef)
+
     return points_converted
 
 
@@ -135,24 +97,8 @@ def convert_epsg(points, epsg_in, epsg_out):
         
     """
     
-    # define input and output spatial references
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromEPSG(epsg_in)
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromEPSG(epsg_out)
-    # create a coordinates transform
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
-    # if list of arrays
-    if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            points_converted.append(np.array(coordTransform.TransformPoints(arr)))
-    # if single array
-    elif type(points) is np.ndarray:
-        points_converted = np.array(coordTransform.TransformPoints(points))  
-    else:
-        raise Exception('invalid input type')
+    # same as SDS_tools.convert_epsg (cached transformations, one call for a list of arrays)
+    points_converted = SDS_tools.convert_epsg(points, epsg_in, epsg_out)
 
     return points_converted
 
@@ -477,7 +423,9 @@ def transects_from_geojson(filename):
 
 def output_to_gdf(output):
     """
-    Saves the mapped shorelines as a gpd.GeoDataFrame    
+    Saves the mapped shorelines as a gpd.GeoDataFrame, all the geometries and attributes
+    are created at once. Shorelines with less than 2 points are skipped, the index of the
+    GeoDataFrame is the index of the shoreline in output.
     
     KV WRL 2018
 
@@ -493,28 +441,18 @@ def output_to_gdf(output):
   
     """    
      
-    # loop through the mapped shorelines
-    counter = 0
-    for i in range(len(output['shorelines'])):
-        # skip if there shoreline is empty 
-        if len(output['shorelines'][i]) == 0:
-            continue
-        else:
-            # save the geometry + attributes
-            geom = geometry.LineString(output['shorelines'][i])
-            gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-            gdf.index = [i]
-            gdf.loc[i,'start_date'] = output['start'][i]
-            gdf.loc[i,'end_date'] = output['end'][i]
-            gdf.loc[i,'satname'] = output['satname'][i]
-            gdf.loc[i,'Median_no'] = output['median_no'][i]
-
-            # store into geodataframe
-            if counter == 0:
-                gdf_all = gdf
-            else:
-                gdf_all = gdf_all.append(gdf)
-            counter = counter + 1       
+    # skip the empty shorelines
+    idx = np.array([i for i in range(len(output['shorelines']))
+                    if len(output['shorelines'][i]) >= 2], dtype=int)
+    coords, offsets = NOC_georef.ragged_from_list([output['shorelines'][i] for i in idx])
+    geoms = SDS_tools.geometries_from_coords(coords, offsets, 'lines')
+    # attributes
+    attributes = dict([])
+    attributes['start_date'] = [output['start'][i] for i in idx]
+    attributes['end_date'] = [output['end'][i] for i in idx]
+    attributes['satname'] = [output['satname'][i] for i in idx]
+    attributes['Median_no'] = [output['median_no'][i] for i in idx]
+    gdf_all = gpd.GeoDataFrame(attributes, index=idx, geometry=list(geoms))
 
     return gdf_all
 
@@ -536,17 +474,4 @@ def transects_to_gdf(transects):
         
     """  
        
-    # loop through the mapped shorelines
-    for i,key in enumerate(list(transects.keys())):
-        # save the geometry + attributes
-        geom = geometry.LineString(transects[key])
-        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-        gdf.index = [i]
-        gdf.loc[i,'name'] = key
-        # store into geodataframe
-        if i == 0:
-            gdf_all = gdf
-        else:
-            gdf_all = gdf_all.append(gdf)
-            
-    return gdf_all
+    return SDS_tools.transects_to_gdf(transects)
@@ -0,0 +1,611 @@
+"""
+This module contains the vectorized functions to intersect the 2D shorelines with
+shore-normal transects, for long stretches of coast with thousands of transects.
+
+The shoreline points are hashed into a regular grid once per shoreline and each
+transect only looks at the points of the grid cells that it crosses, instead of
+computing the distance from every transect to every shoreline point.
+"""
+
+# load modules
+import os
+import numpy as np
+import pandas as pd
+
+# other modules
+import geopandas as gpd
+
+np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
+
+# distance from the origin of the transects beyond which the shoreline points are ignored
+# (hard-coded to 1 km as in SDS_transects.compute_intersection)
+MAX_DIST_ORIGIN = 1000
+
+###################################################################################################
+# TRANSECT GEOMETRY
+###################################################################################################
+
+def transects_to_arrays(transects):
+    """
+    Converts the transects dict into arrays with the origin (first point) and the end
+    (last point) of each transect.
+
+    Arguments:
+    -----------
+    transects: dict
+        contains the X and Y coordinates of each transect
+
+    Returns:
+    -----------
+    keys: list of str
+        names of the transects (same order as the arrays)
+    origins: np.array
+        array with 2 columns (X,Y) with the origin of each transect
+    ends: np.array
+        array with 2 columns (X,Y) with the last point of each transect
+
+    """
+
+    keys = list(transects.keys())
+    origins = np.array([np.array(transects[key])[0,:2] for key in keys], dtype=float).reshape(-1,2)
+    ends = np.array([np.array(transects[key])[-1,:2] for key in keys], dtype=float).reshape(-1,2)
+
+    return keys, origins, ends
+
+###################################################################################################
+# GRID INDEX OF THE SHORELINE POINTS
+###################################################################################################
+
+def _grid_index(sl, cell_size):
+    "sorts the shoreline points by grid cell, returns the sorted cell ids and the order"
+    x0 = np.min(sl[:,0])
+    y0 = np.min(sl[:,1])
+    ix = np.floor((sl[:,0] - x0)/cell_size).astype(np.int64)
+    iy = np.floor((sl[:,1] - y0)/cell_size).astype(np.int64)
+    ny = int(np.max(iy)) + 1
+    nx = int(np.max(ix)) + 1
+    cells = ix*ny + iy
+    order = np.argsort(cells, kind='mergesort')
+    return {'x0':x0, 'y0':y0, 'nx':nx, 'ny':ny, 'size':cell_size,
+            'cells':cells[order], 'order':order}
+
+def _transect_cells(grid, origins, vectors):
+    """
+    returns the (transect, cell) pairs of the grid cells that can contain points that are
+    within half a cell of the first MAX_DIST_ORIGIN metres of each transect
+    """
+
+    c = grid['size']
+    # sample the transects every cell size, each sample covers the 3x3 block of cells
+    # around it, which contains all the points within c/2 along and dist across
+    # the transect as long as sqrt((c/2)**2 + dist**2) <= c (cell size of 2*along_dist)
+    n_samples = int(np.ceil(MAX_DIST_ORIGIN/c)) + 1
+    t = np.arange(n_samples)*c
+    xs = origins[:,0,None] + vectors[:,0,None]*t[None,:]
+    ys = origins[:,1,None] + vectors[:,1,None]*t[None,:]
+    ix = np.floor((xs - grid['x0'])/c).astype(np.int64)
+    iy = np.floor((ys - grid['y0'])/c).astype(np.int64)
+    offsets = np.array([-1,0,1])
+    shape = ix.shape + (3,3)
+    ix = np.broadcast_to(ix[:,:,None,None] + offsets[None,None,:,None], shape).reshape(len(origins),-1)
+    iy = np.broadcast_to(iy[:,:,None,None] + offsets[None,None,None,:], shape).reshape(len(origins),-1)
+    tid = np.repeat(np.arange(len(origins)), ix.shape[1])
+    ix = ix.ravel()
+    iy = iy.ravel()
+    # only keep the cells inside the grid
+    inside = np.logical_and(np.logical_and(ix >= 0, ix < grid['nx']),
+                            np.logical_and(iy >= 0, iy < grid['ny']))
+    cells = ix[inside]*grid['ny'] + iy[inside]
+    tid = tid[inside]
+    # remove duplicated (transect, cell) pairs
+    pairs = np.unique(tid*(grid['nx']*grid['ny']) + cells)
+
+    return pairs//(grid['nx']*grid['ny']), pairs%(grid['nx']*grid['ny'])
+
+def _expand_ranges(tid, start, end):
+    "expands the ranges [start,end) of each transect into (transect, index) pairs"
+    counts = np.maximum(end - start, 0)
+    tid = np.repeat(tid, counts)
+    first = np.repeat(start - np.cumsum(counts) + counts, counts)
+    return tid, first + np.arange(np.sum(counts))
+
+def _candidate_pairs(grid, tid, cells):
+    "expands the (transect, cell) pairs into (transect, shoreline point) pairs"
+    start = np.searchsorted(grid['cells'], cells, side='left')
+    end = np.searchsorted(grid['cells'], cells, side='right')
+    # index of each point inside the sorted array of points
+    tid, idx = _expand_ranges(tid, start, end)
+    return tid, grid['order'][idx]
+
+def _group_median(tid, values, n):
+    "median of the values of each group (transect), NaN for the empty groups"
+    medians = np.ones(n)*np.nan
+    if len(values) == 0:
+        return medians
+    order = np.lexsort((values, tid))
+    values = values[order]
+    counts = np.bincount(tid, minlength=n)
+    starts = np.cumsum(counts) - counts
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1)//2
+    hi = starts[has] + counts[has]//2
+    medians[has] = 0.5*(values[lo] + values[hi])
+    return medians
+
+###################################################################################################
+# CASTING OF THE TRANSECTS
+###################################################################################################
+
+def _resample_line(line, step):
+    "resamples a polyline every step metres along its length, returns the points and chainages"
+    line = np.asarray(line, dtype=float)[:,:2]
+    line = line[~np.any(np.isnan(line), axis=1)]
+    if len(line) < 2:
+        return np.zeros((0,2)), np.zeros(0)
+    # remove the duplicated consecutive points
+    seg = np.hypot(np.diff(line[:,0]), np.diff(line[:,1]))
+    line = line[np.append(True, seg > 0)]
+    chainage = np.append(0, np.cumsum(seg[seg > 0]))
+    s = np.arange(0, chainage[-1] + step/2, step)
+    s[-1] = min(s[-1], chainage[-1])
+    pts = np.array([np.interp(s, chainage, line[:,0]), np.interp(s, chainage, line[:,1])]).T
+    return pts, s
+
+def _moving_average(x, n):
+    "moving average over n points (window shrinking near the ends of the line)"
+    if n <= 1:
+        return x
+    csum = np.cumsum(np.insert(x, 0, 0, axis=0), axis=0)
+    k = np.arange(len(x))
+    lo = np.maximum(k - n//2, 0)
+    hi = np.minimum(k + n//2 + 1, len(x))
+    return (csum[hi] - csum[lo])/(hi - lo)[:,None]
+
+def cast_transect_arrays(baseline, spacing=50, length=500, landward=200, smoothing=500,
+                         land_side='left'):
+    """
+    Casts shore-normal transects along a baseline (e.g. a reference shoreline) at a fixed
+    spacing. The orientation of the transects is computed on the baseline smoothed over
+    smoothing metres, and the origins are all on the same side of the baseline (land side),
+    so that the transects point seawards.
+
+    Arguments:
+    -----------
+    baseline: np.array or list of np.array
+        array with 2 (or 3) columns (X,Y) with the ordered points of the baseline, or list
+        of polylines
+    spacing: float
+        alongshore distance between the transects [m]
+    length: float
+        length of the transects [m]
+    landward: float
+        distance of the origin of the transects landward of the baseline [m]
+    smoothing: float
+        length of the moving average applied to the baseline to compute the shore-normal
+        directions [m]
+    land_side: str
+        'left' or 'right', side of the land when walking along the baseline from its
+        first to its last point
+
+    Returns:
+    -----------
+    origins: np.array
+        array with 2 columns (X,Y) with the origin (landward end) of each transect
+    ends: np.array
+        array with 2 columns (X,Y) with the seaward end of each transect
+
+    """
+
+    if land_side not in ['left', 'right']:
+        raise Exception('land_side should be left or right')
+    polylines = baseline if type(baseline) is list else [baseline]
+    # baseline resampled every step metres (at least 10 points between two transects)
+    step = min(spacing/10, 10)
+    n_smooth = int(round(smoothing/step))
+    origins = []
+    ends = []
+    for line in polylines:
+        pts, s = _resample_line(line, step)
+        if len(pts) < 2:
+            continue
+        # direction of the smoothed baseline (window shorter than the line, otherwise the
+        # smoothed points in the middle of a short line are all the same)
+        pts_smooth = _moving_average(pts, min(n_smooth, len(pts) - 2))
+        tangent = np.gradient(pts_smooth, axis=0)
+        tangent = tangent/np.hypot(tangent[:,0], tangent[:,1])[:,None]
+        # transects every spacing metres along the baseline
+        s_tr = np.arange(0, s[-1] + 1e-9, spacing)
+        idx = np.clip(np.round(s_tr/step).astype(int), 0, len(pts) - 1)
+        pts_tr = pts[idx]
+        t_tr = tangent[idx]
+        # unit vector pointing towards the land (left or right of the baseline)
+        if land_side == 'left':
+            n_land = np.array([-t_tr[:,1], t_tr[:,0]]).T
+        else:
+            n_land = np.array([t_tr[:,1], -t_tr[:,0]]).T
+        origins.append(pts_tr + landward*n_land)
+        ends.append(pts_tr - (length - landward)*n_land)
+    if len(origins) == 0:
+        return np.zeros((0,2)), np.zeros((0,2))
+
+    return np.concatenate(origins), np.concatenate(ends)
+
+def cast_transects(baseline, spacing=50, length=500, landward=200, smoothing=500,
+                   land_side='left'):
+    """
+    Same as cast_transect_arrays but returns the transects dict used by
+    compute_intersection (each transect stored as its two end points, origin first).
+
+    Arguments:
+    -----------
+    see cast_transect_arrays
+
+    Returns:
+    -----------
+    transects: dict
+        contains the X and Y coordinates of each transect (named '1', '2', ...)
+
+    """
+
+    origins, ends = cast_transect_arrays(baseline, spacing, length, landward, smoothing,
+                                         land_side)
+    coords = np.stack((origins, ends), axis=1)
+
+    return dict(zip([str(_ + 1) for _ in range(len(coords))], coords))
+
+def baseline_from_geojson(filename):
+    """
+    Reads a baseline (or reference shoreline) from a .geojson file with LineString or
+    MultiLineString geometries, in the spatial reference system of the file.
+
+    Arguments:
+    -----------
+    filename: str
+        contains the path and filename of the geojson file to be loaded
+
+    Returns:
+    -----------
+    baseline: list of np.array
+        X and Y coordinates of each polyline
+
+    """
+
+    gdf = gpd.read_file(filename)
+    baseline = []
+    for geom in gdf.geometry:
+        if geom is None:
+            continue
+        lines = geom.geoms if geom.geom_type == 'MultiLineString' else [geom]
+        baseline = baseline + [np.array(_.coords)[:,:2] for _ in lines]
+
+    return baseline
+
+###################################################################################################
+# INTERSECTIONS
+###################################################################################################
+
+def intersect_points(sl, origins, ends, along_dist, chunk_size=5000):
+    """
+    Computes the cross-shore distance of one shoreline along all the transects, as the
+    median of the shoreline points that are within along_dist of the transect (same
+    criteria as SDS_transects.compute_intersection), using a grid index of the points.
+
+    Arguments:
+    -----------
+    sl: np.array
+        array with 2 columns (X,Y) with the shoreline points
+    origins: np.array
+        array with 2 columns (X,Y) with the origin of each transect
+    ends: np.array
+        array with 2 columns (X,Y) with the last point of each transect
+    along_dist: float
+        alongshore distance considered to calculate the intersection
+    chunk_size: int
+        number of transects processed at once (limits the memory used)
+
+    Returns:
+    -----------
+    intersections: np.array
+        cross-shore distance along each transect (NaN if no shoreline points nearby)
+
+    """
+
+    n = len(origins)
+    intersections = np.ones(n)*np.nan
+    sl = np.asarray(sl, dtype=float)
+    if len(sl) == 0 or n == 0:
+        return intersections
+    sl = sl[:,:2]
+    sl = sl[~np.any(np.isnan(sl), axis=1)]
+    if len(sl) == 0:
+        return intersections
+
+    # transect directions (same computations as SDS_transects.compute_intersection)
+    temp = ends - origins
+    norm = np.hypot(temp[:,0], temp[:,1])
+    phi = np.arctan2(temp[:,1], temp[:,0])
+    vectors = temp/norm[:,None]
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+
+    # grid index of the shoreline points
+    grid = _grid_index(sl, max(2*along_dist, 10))
+
+    for i0 in range(0, n, chunk_size):
+        i1 = min(n, i0 + chunk_size)
+        # candidate (transect, point) pairs from the grid cells crossed by the transects
+        tid, cells = _transect_cells(grid, origins[i0:i1], vectors[i0:i1])
+        tid, pid = _candidate_pairs(grid, tid, cells)
+        tid_all = tid + i0
+        dx = sl[pid,0] - origins[tid_all,0]
+        dy = sl[pid,1] - origins[tid_all,1]
+        # point to line distance, distance to the origin and angle with the transect
+        d_line = np.abs(temp[tid_all,0]*dy - temp[tid_all,1]*dx)/norm[tid_all]
+        d_origin = np.hypot(dx, dy)
+        idx_dist = np.logical_and(d_line <= along_dist, d_origin <= MAX_DIST_ORIGIN)
+        idx_angle = np.abs(phi[tid_all] - np.arctan2(dy, dx)) < np.pi/2
+        idx_close = np.logical_and(idx_dist, idx_angle)
+        # change of base to shore-normal coordinate system
+        x_rot = cos_phi[tid_all[idx_close]]*dx[idx_close] + sin_phi[tid_all[idx_close]]*dy[idx_close]
+        intersections[i0:i1] = _group_median(tid[idx_close], x_rot, i1 - i0)
+
+    return intersections
+
+###################################################################################################
+# EXACT SEGMENT INTERSECTIONS
+###################################################################################################
+
+def shoreline_segments(sl, max_segment_length=100):
+    """
+    Converts a shoreline into the segments joining its consecutive points. The shoreline
+    is split into separate polylines where there is a row of NaNs, where two consecutive
+    points are further apart than max_segment_length (e.g. between two contours that were
+    concatenated by process_shoreline) and between the arrays of a list.
+
+    Arguments:
+    -----------
+    sl: np.array or list of np.array
+        array with 2 columns (X,Y) with the ordered shoreline points, or list of polylines
+    max_segment_length: float
+        segments longer than this distance (in metres) are not considered
+
+    Returns:
+    -----------
+    p1: np.array
+        array with 2 columns (X,Y) with the first point of each segment
+    p2: np.array
+        array with 2 columns (X,Y) with the second point of each segment
+
+    """
+
+    if type(sl) is list:
+        polylines = [np.asarray(_, dtype=float)[:,:2] for _ in sl if len(_) > 1]
+    else:
+        polylines = [np.asarray(sl, dtype=float)[:,:2]] if len(sl) > 1 else []
+    if len(polylines) == 0:
+        return np.zeros((0,2)), np.zeros((0,2))
+    p1 = np.concatenate([_[:-1] for _ in polylines])
+    p2 = np.concatenate([_[1:] for _ in polylines])
+    length = np.hypot(p2[:,0] - p1[:,0], p2[:,1] - p1[:,1])
+    # NaN points give NaN lengths, which are removed by the comparison
+    idx_keep = length <= max_segment_length
+
+    return p1[idx_keep], p2[idx_keep]
+
+def _select_crossing(tid, chainage, n, rule, previous):
+    "selects one crossing per transect according to rule, NaN if no crossing"
+    result = np.ones(n)*np.nan
+    if len(chainage) == 0:
+        return result
+    if rule == 'closest':
+        if previous is None:
+            previous = np.ones(n)*np.nan
+        prev = previous[tid]
+        # the seaward-most crossing is used where there is no previous value
+        key = np.where(np.isnan(prev), -chainage, np.abs(chainage - prev))
+    elif rule == 'seaward':
+        key = -chainage
+    elif rule == 'landward':
+        key = chainage
+    else:
+        raise Exception('multiple_crossings should be seaward, landward or closest')
+    # sort by transect and key, keep the first crossing of each transect
+    order = np.lexsort((key, tid))
+    tid = tid[order]
+    first = np.ones(len(tid), dtype=bool)
+    first[1:] = tid[1:] != tid[:-1]
+    result[tid[first]] = chainage[order][first]
+
+    return result
+
+def intersect_segments(sl, origins, ends, rule='seaward', previous=None,
+                       max_segment_length=100, chunk_size=5000):
+    """
+    Computes the exact intersections between one shoreline, treated as ordered polylines,
+    and all the transects at once. The segments are sorted along the main axis of the
+    coastline so that each transect only tests the segments whose bounding box overlaps
+    its own bounding box, then the intersections are computed with a vectorized
+    segment-segment kernel. When a transect crosses the shoreline several times, one
+    crossing is selected with rule.
+
+    Arguments:
+    -----------
+    sl: np.array or list of np.array
+        array with 2 columns (X,Y) with the ordered shoreline points, or list of polylines
+    origins: np.array
+        array with 2 columns (X,Y) with the origin of each transect
+    ends: np.array
+        array with 2 columns (X,Y) with the last point of each transect
+    rule: str
+        crossing kept when there are several: 'seaward' (furthest from the origin),
+        'landward' (closest to the origin) or 'closest' (closest to previous)
+    previous: np.array
+        cross-shore distance of the previous shoreline along each transect, used with
+        rule='closest' (NaN where not known, the seaward crossing is kept there)
+    max_segment_length: float
+        segments longer than this distance (in metres) are not considered
+    chunk_size: int
+        number of transects processed at once (limits the memory used)
+
+    Returns:
+    -----------
+    intersections: np.array
+        distance from the origin of each transect to the intersection with the shoreline
+        (NaN if the transect does not cross the shoreline)
+
+    """
+
+    n = len(origins)
+    intersections = np.ones(n)*np.nan
+    p1, p2 = shoreline_segments(sl, max_segment_length)
+    if len(p1) == 0 or n == 0:
+        return intersections
+
+    # sort the segments along the axis with the largest extent
+    seg_min = np.minimum(p1, p2)
+    seg_max = np.maximum(p1, p2)
+    axis = int(np.argmax(np.max(seg_max, axis=0) - np.min(seg_min, axis=0)))
+    order = np.argsort(seg_min[:,axis], kind='mergesort')
+    p1 = p1[order]
+    p2 = p2[order]
+    seg_min = seg_min[order]
+    seg_max = seg_max[order]
+    # longest extent of a segment along the axis, to bound the search
+    seg_extent = np.max(seg_max[:,axis] - seg_min[:,axis])
+
+    tr_min = np.minimum(origins, ends)
+    tr_max = np.maximum(origins, ends)
+    r = ends - origins
+    norm = np.hypot(r[:,0], r[:,1])
+
+    for i0 in range(0, n, chunk_size):
+        i1 = min(n, i0 + chunk_size)
+        # segments whose bounding box can overlap the bounding box of the transect
+        start = np.searchsorted(seg_min[:,axis], tr_min[i0:i1,axis] - seg_extent, side='left')
+        end = np.searchsorted(seg_min[:,axis], tr_max[i0:i1,axis], side='right')
+        tid, sid = _expand_ranges(np.arange(i0, i1), start, end)
+        idx_box = np.logical_and(np.all(seg_max[sid] >= tr_min[tid], axis=1),
+                                 np.all(seg_min[sid] <= tr_max[tid], axis=1))
+        tid = tid[idx_box]
+        sid = sid[idx_box]
+        # segment-segment intersection: origin + t*r = p1 + u*s with t and u in [0,1]
+        s_vec = p2[sid] - p1[sid]
+        q = p1[sid] - origins[tid]
+        denom = r[tid,0]*s_vec[:,1] - r[tid,1]*s_vec[:,0]
+        t = (q[:,0]*s_vec[:,1] - q[:,1]*s_vec[:,0])/denom
+        u = (q[:,0]*r[tid,1] - q[:,1]*r[tid,0])/denom
+        # parallel segments (denom = 0) give inf/NaN and are removed by the comparisons
+        idx_cross = np.logical_and(np.logical_and(t >= 0, t <= 1),
+                                   np.logical_and(u >= 0, u <= 1))
+        chainage = t[idx_cross]*norm[tid[idx_cross]]
+        prev = None if previous is None else previous[i0:i1]
+        intersections[i0:i1] = _select_crossing(tid[idx_cross] - i0, chainage, i1 - i0, rule, prev)
+
+    return intersections
+
+def compute_intersection(output, transects, settings):
+    """
+    Computes the intersection between the 2D shorelines and the shore-normal
+    transects. It returns time-series of cross-shore distance along each transect.
+    Same output as SDS_transects.compute_intersection (including the .csv file) but
+    vectorized over all the transects with a grid index of the shoreline points.
+
+    With settings['intersection_mode'] = 'segments', the shorelines are treated as
+    ordered polylines and the exact intersections with the transects are computed
+    instead of the median of the nearby points (works with sparse or simplified
+    shorelines). The cross-shore distance is then limited to the length of the transects.
+
+    Arguments:
+    -----------
+    output: dict
+        contains the extracted shorelines and corresponding metadata
+    transects: dict
+        contains the X and Y coordinates of each transect
+    settings: dict with the following keys
+        'along_dist': int
+            alongshore distance considered caluclate the intersection
+        'inputs': dict
+            input parameters (sitename, filepath)
+        'intersection_mode': str (optional)
+            'points' (default, median of the points within along_dist of the transect)
+            or 'segments' (exact intersections with the shoreline polylines)
+        'multiple_crossings': str (optional)
+            with 'segments', crossing kept when a transect crosses a shoreline several
+            times: 'seaward' (default), 'landward' or 'closest' (to the last valid
+            intersection of the previous dates)
+        'max_segment_length': float (optional)
+            with 'segments', points further apart than this distance (default 100 m)
+            are not joined
+
+    Returns:
+    -----------
+    cross_dist: dict
+        time-series of cross-shore distance along each of the transects.
+        Not tidally corrected.
+
+    """
+
+    keys, origins, ends = transects_to_arrays(transects)
+
+    mode = settings.get('intersection_mode', 'points')
+    if mode not in ['points', 'segments']:
+        raise Exception('intersection_mode should be points or segments')
+
+    # loop through shorelines and compute the intersection along all the transects
+    intersections = np.zeros((len(output['shorelines']),len(keys)))
+    previous = np.ones(len(keys))*np.nan
+    for i in range(len(output['shorelines'])):
+        if mode == 'points':
+            # median of the shoreline points close to the transects
+            intersections[i,:] = intersect_points(output['shorelines'][i], origins, ends,
+                                                  settings['along_dist'])
+        else:
+            # exact intersections with the shoreline polylines
+            intersections[i,:] = intersect_segments(output['shorelines'][i], origins, ends,
+                                                    settings.get('multiple_crossings', 'seaward'),
+                                                    previous,
+                                                    settings.get('max_segment_length', 100))
+            # last valid intersection along each transect (for multiple_crossings='closest')
+            idx_valid = ~np.isnan(intersections[i,:])
+            previous[idx_valid] = intersections[i,idx_valid]
+
+    # fill the a dictionnary
+    cross_dist = dict([])
+    for j,key in enumerate(keys):
+        cross_dist[key] = intersections[:,j]
+
+    save_intersections(output, cross_dist, settings)
+
+    return cross_dist
+
+def save_intersections(output, cross_dist, settings):
+    """
+    Saves the time-series of cross-shore distance as a .csv file (for Excel users),
+    in the same format as SDS_transects.compute_intersection.
+
+    Arguments:
+    -----------
+    output: dict
+        contains the extracted shorelines and corresponding metadata (the dates are
+        taken from output['dates'], or output['start'] for the composites)
+    cross_dist: dict
+        time-series of cross-shore distance along each of the transects
+    settings: dict with the following keys
+        'inputs': dict
+            input parameters (sitename, filepath)
+
+    Returns:
+    -----------
+    Saves transect_time_series.csv in the folder of the site
+
+    """
+
+    out_dict = dict([])
+    out_dict['dates'] = output['dates'] if 'dates' in output.keys() else output['start']
+    for key in cross_dist.keys():
+        out_dict['Transect '+ key] = cross_dist[key]
+    df = pd.DataFrame(out_dict)
+    fn = os.path.join(settings['inputs']['filepath'],settings['inputs']['sitename'],
+                      'transect_time_series.csv')
+    df.to_csv(fn, sep=',')
+    print('Time-series of the shoreline change along the transects saved as:\n%s'%fn)
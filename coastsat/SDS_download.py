@@ -15,11 +15,7 @@ import pdb
 import ee
 
 # modules to download, unzip and stack the images
-from urllib.request import urlretrieve
-import zipfile
 import copy
-import shutil
-import gdal
 
 # additional modules
 from datetime import datetime, timedelta
@@ -29,7 +25,7 @@ from skimage import morphology, transform
 from scipy import ndimage
 
 # CoastSat modules
-from coastsat import SDS_preprocess, SDS_tools, gdal_merge
+from coastsat import SDS_preprocess, SDS_tools, gdal_merge, NOC_io
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
@@ -456,9 +452,9 @@ def check_images_available(inputs):
 
 def download_tif(image, polygon, bandsId, filepath):
     """
-    Downloads a .TIF image from the ee server. The image is downloaded as a
-    zip file then moved to the working directory, unzipped and stacked into a
-    single .TIF file.
+    Downloads a .TIF image from the ee server. The zip file is streamed into
+    memory and the bands are stacked and written directly into a single
+    compressed .TIF file (see NOC_io).
 
     Two different codes based on which version of the earth-engine-api is being
     used.
@@ -491,9 +487,6 @@ def download_tif(image, polygon, bandsId, filepath):
             'filePerBand': 'false',
             'name': 'data',
             }))
-        local_zip, headers = urlretrieve(url)
-        with zipfile.ZipFile(local_zip) as local_zipfile:
-            return local_zipfile.extract('data.tif', filepath)
     # for the newer versions of ee
     else:
         # crop image on the server and create url to download
@@ -504,31 +497,9 @@ def download_tif(image, polygon, bandsId, filepath):
             'filePerBand': 'false',
             'name': 'data',
             }))
-        # download zipfile with the cropped bands
-        local_zip, headers = urlretrieve(url)
-        # move zipfile from temp folder to data folder
-        dest_file = os.path.join(filepath, 'imagezip')
-        shutil.move(local_zip,dest_file)
-        # unzip file
-        with zipfile.ZipFile(dest_file) as local_zipfile:
-            for fn in local_zipfile.namelist():
-                local_zipfile.extract(fn, filepath)
-            # filepath + filename to single bands
-            fn_tifs = [os.path.join(filepath,_) for _ in local_zipfile.namelist()]
-        # stack bands into single .tif
-        outds = gdal.BuildVRT(os.path.join(filepath,'stacked.vrt'), fn_tifs, separate=True)
-        outds = gdal.Translate(os.path.join(filepath,'data.tif'), outds)
-        # delete single-band files
-        for fn in fn_tifs: os.remove(fn)
-        # delete .vrt file
-        os.remove(os.path.join(filepath,'stacked.vrt'))
-        # delete zipfile
-        os.remove(dest_file)
-        # delete data.tif.aux (not sure why this is created)
-        if os.path.exists(os.path.join(filepath,'data.tif.aux')):
-            os.remove(os.path.join(filepath,'data.tif.aux'))
-        # return filepath to stacked file called data.tif
-        return os.path.join(filepath,'data.tif')
+    # stream the zipfile into memory and write the bands (stacked if there is one file
+    # per band) into a single compressed .tif called data.tif
+    return NOC_io.download_geotiff(url, os.path.join(filepath,'data.tif'))
 
 
 def create_folder_structure(im_folder, satname):
@@ -26,7 +26,7 @@ import geopandas as gpd
 from shapely import geometry
 
 # CoastSat modules
-from coastsat import SDS_tools
+from coastsat import SDS_tools, NOC_render, NOC_io
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
@@ -38,6 +38,8 @@ def preprocess_single(fn, satname, cloud_mask_issue):
     the cloud mask, the QA band and a no_data image. 
     For Landsat 7-8 it also outputs the panchromatic band and for Sentinel-2 it
     also outputs the 20m SWIR band.
+    The bands stored as scaled integers (compact composites) are converted to
+    reflectances with the scale factor of the GeoTiff.
 
     KV WRL 2018
 
@@ -79,7 +81,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # read all bands
         data = gdal.Open(fn, gdal.GA_ReadOnly)
         georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im_ms = np.stack(bands, 2)
 
         # down-sample to 15 m (half of the original pixel size)
@@ -133,7 +135,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         fn_pan = fn[0]
         data = gdal.Open(fn_pan, gdal.GA_ReadOnly)
         georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im_pan = np.stack(bands, 2)[:,:,0]
 
         # size of pan image
@@ -143,7 +145,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # read ms image
         fn_ms = fn[1]
         data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im_ms = np.stack(bands, 2)
 
         # create cloud mask
@@ -195,7 +197,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         fn_pan = fn[0]
         data = gdal.Open(fn_pan, gdal.GA_ReadOnly)
         georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im_pan = np.stack(bands, 2)[:,:,0]
 
         # size of pan image
@@ -205,7 +207,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # read ms image
         fn_ms = fn[1]
         data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im_ms = np.stack(bands, 2)
 
         # create cloud mask
@@ -256,7 +258,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         fn10 = fn[0]
         data = gdal.Open(fn10, gdal.GA_ReadOnly)
         georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im10 = np.stack(bands, 2)
         im10 = im10/10000 # TOA scaled to 10000
 
@@ -275,7 +277,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # read 20m band (SWIR1)
         fn20 = fn[1]
         data = gdal.Open(fn20, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im20 = np.stack(bands, 2)
         im20 = im20[:,:,0]
         im20 = im20/10000 # TOA scaled to 10000
@@ -291,7 +293,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # create cloud mask using 60m QA band (not as good as Landsat cloud cover)
         fn60 = fn[2]
         data = gdal.Open(fn60, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
+        bands = NOC_io.read_bands(data)
         im60 = np.stack(bands, 2)
         im_QA = im60[:,:,0]
         cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue)
@@ -613,6 +615,8 @@ def save_jpg(metadata, settings, **kwargs):
         'cloud_mask_issue': boolean
             True if there is an issue with the cloud mask and sand pixels
             are erroneously being masked on the images
+        'jpg_workers': int (optional)
+            number of background threads writing the .jpg files (default 2)
             
     Returns:
     -----------
@@ -629,37 +633,41 @@ def save_jpg(metadata, settings, **kwargs):
     if not os.path.exists(filepath_jpg):
             os.makedirs(filepath_jpg)
 
-    # loop through satellite list
-    for satname in metadata.keys():
+    # the .jpg files are rendered from the arrays and written in background threads,
+    # while the next image is being preprocessed
+    with NOC_render.JpgWriter(n_workers=settings.get('jpg_workers', 2)) as writer:
 
-        filepath = SDS_tools.get_filepath(settings['inputs'],satname)
-        filenames = metadata[satname]['filenames']
+        # loop through satellite list
+        for satname in metadata.keys():
 
-        # loop through images
-        for i in range(len(filenames)):
-            # image filename
-            fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-            # read and preprocess image
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'])
-
-            # compute cloud_cover percentage (with no data pixels)
-            cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
-                continue
+            filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+            filenames = metadata[satname]['filenames']
 
-            # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
-            cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
-            # compute updated cloud cover percentage (without no data pixels)
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (sum(sum((~im_nodata).astype(int)))))
-            # skip image if cloud cover is above threshold
-            if cloud_cover > cloud_thresh or cloud_cover == 1:
-                continue
-            # save .jpg with date and satellite in the title
-            date = filenames[i][:19]
-            plt.ioff()  # turning interactive plotting off
-            create_jpg(im_ms, cloud_mask, date, satname, filepath_jpg)
+            # loop through images
+            for i in range(len(filenames)):
+                # image filename
+                fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
+                # read and preprocess image
+                im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'])
+
+                # compute cloud_cover percentage (with no data pixels)
+                cloud_cover_combined = np.divide(sum(sum(cloud_mask.astype(int))),
+                                        (cloud_mask.shape[0]*cloud_mask.shape[1]))
+                if cloud_cover_combined > 0.99: # if 99% of cloudy pixels in image skip
+                    continue
+
+                # remove no data pixels from the cloud mask (for example L7 bands of no data should not be accounted for)
+                cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
+                # compute updated cloud cover percentage (without no data pixels)
+                cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                                        (sum(sum((~im_nodata).astype(int)))))
+                # skip image if cloud cover is above threshold
+                if cloud_cover > cloud_thresh or cloud_cover == 1:
+                    continue
+                # save .jpg with date and satellite in the title
+                date = filenames[i][:19]
+                writer.submit(NOC_render.render_preprocessed, im_ms, cloud_mask, date, satname,
+                              os.path.join(filepath_jpg, date + '_' + satname + '.jpg'))
 
     # print the location where the images have been saved
     print('Satellite images saved as .jpg in ' + os.path.join(filepath_data, sitename,
@@ -22,7 +22,6 @@ if sklearn.__version__[:4] == '0.20':
     from sklearn.externals import joblib
 else:
     import joblib
-from shapely.geometry import LineString
 
 # other modules
 import matplotlib.patches as mpatches
@@ -34,7 +33,7 @@ from datetime import datetime
 from pylab import ginput
 
 # CoastSat modules
-from coastsat import SDS_tools, SDS_preprocess
+from coastsat import SDS_tools, SDS_preprocess, NOC_georef, NOC_indices
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
@@ -166,16 +165,20 @@ def extract_shorelines(metadata, settings):
             im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
                                                     pixel_size, settings)
 
+            # spectral indices of the image, computed once and shared by the steps below
+            indices = NOC_indices.SpectralIndices(im_ms, cloud_mask)
+
             # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
             im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
-                                    min_beach_area_pixels, clf)
+                                    min_beach_area_pixels, clf, indices)
             
             # if adjust_detection is True, let the user adjust the detected shoreline
             if settings['adjust_detection']:
                 date = filenames[i][:19]
                 skip_image, shoreline, t_mndwi = adjust_detection(im_ms, cloud_mask, im_labels,
                                                                   im_ref_buffer, image_epsg, georef,
-                                                                  settings, date, satname, buffer_size_pixels)
+                                                                  settings, date, satname, buffer_size_pixels,
+                                                                  indices)
                 # if the user decides to skip the image, continue and do not save the mapped shoreline
                 if skip_image:
                     continue
@@ -186,14 +189,15 @@ def extract_shorelines(metadata, settings):
             else:
                 try: # use try/except structure for long runs
                     if sum(sum(im_labels[:,:,0])) < 10 : # minimum number of sand pixels
-                        # compute MNDWI image (SWIR-G)
-                        im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+                        # get MNDWI image (SWIR-G)
+                        im_mndwi = indices['SWIR-G']
                         # find water contours on MNDWI grayscale image
                         contours_mwi, t_mndwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
                     else:
                         # use classification to refine threshold and extract the sand/water interface
                         contours_mwi, t_mndwi = find_wl_contours2(im_ms, im_labels, cloud_mask,
-                                                                  buffer_size_pixels, im_ref_buffer)
+                                                                  buffer_size_pixels, im_ref_buffer,
+                                                                  indices)
                 except:
                     print('Could not map shoreline for this image: ' + filenames[i])
                     continue
@@ -209,7 +213,8 @@ def extract_shorelines(metadata, settings):
                     if not settings['check_detection']:
                         plt.ioff() # turning interactive plotting off
                     skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
-                                                image_epsg, georef, settings, date, satname)
+                                                image_epsg, georef, settings, date, satname,
+                                                indices)
                     # if the user decides to skip the image, continue and do not save the mapped shoreline
                     if skip_image:
                         continue
@@ -253,7 +258,7 @@ def extract_shorelines(metadata, settings):
 # IMAGE CLASSIFICATION FUNCTIONS
 ###################################################################################################
 
-def calculate_features(im_ms, cloud_mask, im_bool):
+def calculate_features(im_ms, cloud_mask, im_bool, indices=None):
     """
     Calculates features on the image that are used for the supervised classification. 
     The features include spectral normalized-difference indices and standard 
@@ -269,6 +274,8 @@ def calculate_features(im_ms, cloud_mask, im_bool):
         2D cloud mask with True where cloud pixels are
     im_bool: np.array
         2D array of boolean indicating where on the image to calculate the features
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -279,44 +286,29 @@ def calculate_features(im_ms, cloud_mask, im_bool):
     """
 
     # add all the multispectral bands
-    features = np.expand_dims(im_ms[im_bool,0],axis=1)
-    for k in range(1,im_ms.shape[2]):
-        feature = np.expand_dims(im_ms[im_bool,k],axis=1)
-        features = np.append(features, feature, axis=-1)
-    # NIR-G
-    im_NIRG = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRG[im_bool],axis=1), axis=-1)
-    # SWIR-G
-    im_SWIRG = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRG[im_bool],axis=1), axis=-1)
-    # NIR-R
-    im_NIRR = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRR[im_bool],axis=1), axis=-1)
-    # SWIR-NIR
-    im_SWIRNIR = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,3], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRNIR[im_bool],axis=1), axis=-1)
-    # B-R
-    im_BR = SDS_tools.nd_index(im_ms[:,:,0], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_BR[im_bool],axis=1), axis=-1)
+    n_bands = im_ms.shape[2]
+    n_indices = len(NOC_indices.FEATURE_INDICES)
+    features = np.empty((int(np.sum(im_bool)), 2*(n_bands + n_indices)))
+    for k in range(n_bands):
+        features[:,k] = im_ms[im_bool,k]
+    # spectral indices (NIR-G, SWIR-G, NIR-R, SWIR-NIR, B-R), computed in one pass and
+    # kept in the index engine for the contouring and the figures
+    indices = NOC_indices.get_indices(im_ms, cloud_mask, indices)
+    im_indices = indices.compute(NOC_indices.FEATURE_INDICES)
+    for k, im_ind in enumerate(im_indices):
+        features[:,n_bands+k] = im_ind[im_bool]
     # calculate standard deviation of individual bands
-    for k in range(im_ms.shape[2]):
+    for k in range(n_bands):
         im_std =  SDS_tools.image_std(im_ms[:,:,k], 1)
-        features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+        features[:,n_bands+n_indices+k] = im_std[im_bool]
     # calculate standard deviation of the spectral indices
-    im_std = SDS_tools.image_std(im_NIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_NIRR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRNIR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_BR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+    for k, im_ind in enumerate(im_indices):
+        im_std = SDS_tools.image_std(im_ind, 1)
+        features[:,2*n_bands+n_indices+k] = im_std[im_bool]
 
     return features
 
-def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
+def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf, indices=None):
     """
     Classifies every pixel in the image in one of 4 classes:
         - sand                                          --> label = 1
@@ -340,6 +332,8 @@ def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
         minimum number of pixels that have to be connected to belong to the SAND class
     clf: joblib object
         pre-trained classifier
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -351,7 +345,8 @@ def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
     """
 
     # calculate features
-    vec_features = calculate_features(im_ms, cloud_mask, np.ones(cloud_mask.shape).astype(bool))
+    vec_features = calculate_features(im_ms, cloud_mask, np.ones(cloud_mask.shape).astype(bool),
+                                      indices)
     vec_features[np.isnan(vec_features)] = 1e-9 # NaN values are create when std is too close to 0
 
     # remove NaNs and cloudy pixels
@@ -428,7 +423,7 @@ def find_wl_contours1(im_ndwi, cloud_mask, im_ref_buffer):
 
     return contours, t_otsu
 
-def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
+def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer, indices=None):
     """
     New robust method for extracting shorelines. Incorporates the classification
     component to refine the treshold and make it specific to the sand/water interface.
@@ -448,6 +443,8 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
         thresholding algorithm.
     im_ref_buffer: np.array
         binary image containing a buffer around the reference shoreline
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:    
     -----------
@@ -462,10 +459,10 @@ def find_wl_contours2(im_ms, im_labels, cloud_mask, buffer_size, im_ref_buffer):
     nrows = cloud_mask.shape[0]
     ncols = cloud_mask.shape[1]
 
-    # calculate Normalized Difference Modified Water Index (SWIR - G)
-    im_mwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    # calculate Normalized Difference Modified Water Index (NIR - G)
-    im_wi = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
+    # get Normalized Difference Modified Water Index (SWIR - G) and
+    # Normalized Difference Water Index (NIR - G), already computed for the features
+    indices = NOC_indices.get_indices(im_ms, cloud_mask, indices)
+    im_mwi, im_wi = indices.compute(['SWIR-G', 'NIR-G'])
     # stack indices together
     im_ind = np.stack((im_wi, im_mwi), axis=-1)
     vec_ind = im_ind.reshape(nrows*ncols,2)
@@ -551,7 +548,7 @@ def create_shoreline_buffer(im_shape, georef, image_epsg, pixel_size, settings):
 
         # convert reference shoreline to pixel coordinates
         ref_sl = settings['reference_shoreline']
-        ref_sl_conv = SDS_tools.convert_epsg(ref_sl, settings['output_epsg'],image_epsg)[:,:-1]
+        ref_sl_conv = SDS_tools.convert_epsg_xy(ref_sl, settings['output_epsg'],image_epsg)
         ref_sl_pix = SDS_tools.convert_world2pix(ref_sl_conv, georef)
         ref_sl_pix_rounded = np.round(ref_sl_pix).astype(int)
 
@@ -638,25 +635,17 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
 
     """
 
+    # flatten the contours into one array of coordinates + offsets (ragged array)
+    coords, offsets = NOC_georef.ragged_from_list(list(contours))
     # convert pixel coordinates to world coordinates
-    contours_world = SDS_tools.convert_pix2world(contours, georef)
+    coords_world = NOC_georef.Affine(georef).pix2world(coords)
     # convert world coordinates to desired spatial reference system
-    contours_epsg = SDS_tools.convert_epsg(contours_world, image_epsg, settings['output_epsg'])
+    coords_epsg = SDS_tools.convert_epsg_xy(coords_world, image_epsg, settings['output_epsg'])
     # remove contours that have a perimeter < min_length_sl (provided in settings dict)
     # this enables to remove the very small contours that do not correspond to the shoreline
-    contours_long = []
-    for l, wl in enumerate(contours_epsg):
-        coords = [(wl[k,0], wl[k,1]) for k in range(len(wl))]
-        a = LineString(coords) # shapely LineString structure
-        if a.length >= settings['min_length_sl']:
-            contours_long.append(wl)
+    idx_long = NOC_georef.ragged_lengths(coords_epsg, offsets) >= settings['min_length_sl']
     # format points into np.array
-    x_points = np.array([])
-    y_points = np.array([])
-    for k in range(len(contours_long)):
-        x_points = np.append(x_points,contours_long[k][:,0])
-        y_points = np.append(y_points,contours_long[k][:,1])
-    contours_array = np.transpose(np.array([x_points,y_points]))
+    contours_array = coords_epsg[idx_long[NOC_georef.ragged_ids(offsets)]]
 
     shoreline = contours_array
 
@@ -666,8 +655,8 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
         idx_cloud = np.where(cloud_mask)
         idx_cloud = np.array([(idx_cloud[0][k], idx_cloud[1][k]) for k in range(len(idx_cloud[0]))])
         # convert to world coordinates and same epsg as the shoreline points
-        coords_cloud = SDS_tools.convert_epsg(SDS_tools.convert_pix2world(idx_cloud, georef),
-                                               image_epsg, settings['output_epsg'])[:,:-1]
+        coords_cloud = SDS_tools.convert_epsg_xy(SDS_tools.convert_pix2world(idx_cloud, georef),
+                                                  image_epsg, settings['output_epsg'])
         # only keep the shoreline points that are at least 30m from any cloud pixel
         idx_keep = np.ones(len(shoreline)).astype(bool)
         for k in range(len(shoreline)):
@@ -682,7 +671,7 @@ def process_shoreline(contours, cloud_mask, georef, image_epsg, settings):
 ###################################################################################################
 
 def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
-                   settings, date, satname):
+                   settings, date, satname, indices=None):
     """
     Shows the detected shoreline to the user for visual quality control. 
     The user can accept/reject the detected shorelines  by using keep/skip
@@ -717,6 +706,8 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
             if True, lets user manually accept/reject the mapped shorelines
         'save_figure': bool
             if True, saves a -jpg file for each mapped shoreline
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
 
     Returns:
     -----------
@@ -745,8 +736,8 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
         im_class[im_labels[:,:,k],1] = colours[k,1]
         im_class[im_labels[:,:,k],2] = colours[k,2]
 
-    # compute MNDWI grayscale image
-    im_mwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+    # get MNDWI grayscale image
+    im_mwi = NOC_indices.get_indices(im_ms, cloud_mask, indices)['SWIR-G']
 
     # transform world coordinates of shoreline into pixel coordinates
     # use try/except in case there are no coordinates to be transformed (shoreline = [])
@@ -879,7 +870,7 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
     return skip_image
 
 def adjust_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, image_epsg, georef,
-                       settings, date, satname, buffer_size_pixels):
+                       settings, date, satname, buffer_size_pixels, indices=None):
     """
     Advanced version of show detection where the user can adjust the detected 
     shorelines with a slide bar.
@@ -906,6 +897,8 @@ def adjust_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, image_epsg, ge
         indicates the satname (L5,L7,L8 or S2)
     buffer_size_pixels: int
         buffer_size converted to number of pixels
+    indices: NOC_indices.SpectralIndices (optional)
+        spectral indices of the image, computed here if not provided
     settings: dict with the following keys
         'inputs': dict
             input parameters (sitename, filepath, polygon, dates, sat_list)
@@ -946,8 +939,9 @@ def adjust_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, image_epsg, ge
         im_class[im_labels[:,:,k],1] = colours[k,1]
         im_class[im_labels[:,:,k],2] = colours[k,2]
 
-    # compute MNDWI grayscale image
-    im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+    # get MNDWI grayscale image
+    indices = NOC_indices.get_indices(im_ms, cloud_mask, indices)
+    im_mndwi = indices['SWIR-G']
     # buffer MNDWI using reference shoreline
     im_mndwi_buffer = np.copy(im_mndwi)
     im_mndwi_buffer[~im_ref_buffer] = np.nan
@@ -1032,7 +1026,7 @@ def adjust_detection(im_ms, cloud_mask, im_labels, im_ref_buffer, image_epsg, ge
         if sum(sum(im_labels[:,:,0])) > 10:
             # use classification to refine threshold and extract the sand/water interface
             contours_mndwi, t_mndwi = find_wl_contours2(im_ms, im_labels, cloud_mask,
-                                                        buffer_size_pixels, im_ref_buffer)
+                                                        buffer_size_pixels, im_ref_buffer, indices)
         else:       
             # find water contours on MNDWI grayscale image
             contours_mndwi, t_mndwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)    
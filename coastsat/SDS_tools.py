@@ -6,6 +6,7 @@ Author: Kilian Vos, Water Research Laboratory, University of New South Wales
 
 # load modules
 import os
+import threading
 import numpy as np
 import matplotlib.pyplot as plt
 import pdb
@@ -13,10 +14,13 @@ import pdb
 # other modules
 from osgeo import gdal, osr
 import geopandas as gpd
+import shapely
 from shapely import geometry
-import skimage.transform as transform
 from astropy.convolution import convolve
 
+# CoastSat modules
+from coastsat import NOC_georef, NOC_timeseries
+
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
 ###################################################################################################
@@ -44,29 +48,9 @@ def convert_pix2world(points, georef):
         
     """
     
-    # make affine transformation matrix
-    aff_mat = np.array([[georef[1], georef[2], georef[0]],
-                       [georef[4], georef[5], georef[3]],
-                       [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
+    # affine transformation from the georef vector, a list of arrays is converted in one call
+    points_converted = NOC_georef.convert_pix2world(points, georef)
 
-    # if list of arrays
-    if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            tmp = arr[:,[1,0]]
-            points_converted.append(tform(tmp))
-          
-    # if single array
-    elif type(points) is np.ndarray:
-        tmp = points[:,[1,0]]
-        points_converted = tform(tmp)
-        
-    else:
-        raise Exception('invalid input type')
-        
     return points_converted
 
 def convert_world2pix(points, georef):
@@ -90,31 +74,56 @@ def convert_world2pix(points, georef):
     
     """
     
-    # make affine transformation matrix
-    aff_mat = np.array([[georef[1], georef[2], georef[0]],
-                       [georef[4], georef[5], georef[3]],
-                       [0, 0, 1]])
-    # create affine transformation
-    tform = transform.AffineTransform(aff_mat)
-    
-    # if list of arrays
-    if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            points_converted.append(tform.inverse(points))
-            
-    # if single array    
-    elif type(points) is np.ndarray:
-        points_converted = tform.inverse(points)
-        
-    else:
-        print('invalid input type')
-        raise
-        
+    # affine transformation from the georef vector, a list of arrays is converted in one call
+    points_converted = NOC_georef.convert_world2pix(points, georef)
+
     return points_converted
 
 
+# cache of the coordinate transformations, one dict per thread as the osr objects
+# are not thread-safe
+_coord_transforms = threading.local()
+
+def get_coord_transform(epsg_in, epsg_out):
+    """
+    Returns the osr.CoordinateTransformation from epsg_in to epsg_out. The
+    transformations are created once and cached (per thread), instead of building
+    two osr.SpatialReference and a new transformation at every conversion.
+    With GDAL >= 3 the axis order is fixed to the traditional GIS order
+    (longitude/X first, latitude/Y second), as with GDAL 2.
+
+    Arguments:
+    -----------
+    epsg_in: int
+        epsg code of the spatial reference in which the input is
+    epsg_out: int
+        epsg code of the spatial reference in which the output will be
+
+    Returns:
+    -----------
+    coordTransform: osr.CoordinateTransformation
+        transformation between the two spatial references
+
+    """
+
+    cache = getattr(_coord_transforms, 'cache', None)
+    if cache is None:
+        cache = _coord_transforms.cache = dict([])
+    key = (int(epsg_in), int(epsg_out))
+    if key not in cache:
+        # define input and output spatial references
+        spatial_refs = []
+        for epsg in key:
+            spatial_ref = osr.SpatialReference()
+            spatial_ref.ImportFromEPSG(epsg)
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                spatial_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            spatial_refs.append(spatial_ref)
+        # create a coordinates transform
+        cache[key] = osr.CoordinateTransformation(spatial_refs[0], spatial_refs[1])
+
+    return cache[key]
+
 def convert_epsg(points, epsg_in, epsg_out):
     """
     Converts from one spatial reference to another using the epsg codes
@@ -137,19 +146,15 @@ def convert_epsg(points, epsg_in, epsg_out):
         
     """
     
-    # define input and output spatial references
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromEPSG(epsg_in)
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromEPSG(epsg_out)
-    # create a coordinates transform
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
-    # if list of arrays
+    # get the cached coordinates transform
+    coordTransform = get_coord_transform(epsg_in, epsg_out)
+    # if list of arrays, transform all the arrays in one call and split the result
     if type(points) is list:
-        points_converted = []
-        # iterate over the list
-        for i, arr in enumerate(points): 
-            points_converted.append(np.array(coordTransform.TransformPoints(arr)))
+        if len(points) == 0:
+            return []
+        offsets = np.cumsum([len(arr) for arr in points])[:-1]
+        points_all = np.concatenate([np.asarray(arr, dtype=float) for arr in points])
+        points_converted = np.split(np.array(coordTransform.TransformPoints(points_all)), offsets)
     # if single array
     elif type(points) is np.ndarray:
         points_converted = np.array(coordTransform.TransformPoints(points))  
@@ -158,6 +163,47 @@ def convert_epsg(points, epsg_in, epsg_out):
 
     return points_converted
 
+def convert_epsg_xy(points, epsg_in, epsg_out):
+    """
+    Same as convert_epsg but only returns the X and Y columns. A list of arrays 
+    (e.g. the contours of an image) is concatenated into one buffer, transformed in a 
+    single call and split back into a list with the offsets of each array.
+    No transformation is done if epsg_in and epsg_out are the same.
+
+    Arguments:
+    -----------
+    points: np.array or list of np.ndarray
+        array with 2 (or 3) columns (X,Y)
+    epsg_in: int
+        epsg code of the spatial reference in which the input is
+    epsg_out: int
+        epsg code of the spatial reference in which the output will be            
+                
+    Returns:    
+    -----------
+    points_converted: np.array or list of np.array 
+        converted X,Y coordinates from epsg_in to epsg_out
+        
+    """
+
+    # if list of arrays, flatten into a single buffer
+    if type(points) is list:
+        if len(points) == 0:
+            return []
+        offsets = np.cumsum([len(arr) for arr in points])[:-1]
+        points_all = np.concatenate([np.asarray(arr, dtype=float)[:,:2] for arr in points])
+        return np.split(convert_epsg_xy(points_all, epsg_in, epsg_out), offsets)
+    elif not type(points) is np.ndarray:
+        raise Exception('invalid input type')
+
+    points = np.asarray(points[:,:2], dtype=float)
+    if int(epsg_in) == int(epsg_out) or len(points) == 0:
+        return points.copy()
+    coordTransform = get_coord_transform(epsg_in, epsg_out)
+    points_converted = np.array(coordTransform.TransformPoints(points))[:,:2]
+
+    return points_converted
+
 ###################################################################################################
 # IMAGE ANALYSIS FUNCTIONS
 ###################################################################################################
@@ -519,20 +565,9 @@ def get_closest_datapoint(dates, dates_ts, values_ts):
         
     """
     
-    # check if the time-series cover the dates
-    if dates[0] < dates_ts[0] or dates[-1] > dates_ts[-1]: 
-        raise Exception('Time-series do not cover the range of your input dates')
-    
-    # get closest point to each date (no interpolation)
-    temp = []
-    def find(item, lst):
-        start = 0
-        start = lst.index(item, start)
-        return start
-    for i,date in enumerate(dates):
-        print('\rExtracting closest points: %d%%' % int((i+1)*100/len(dates)), end='')
-        temp.append(values_ts[find(min(item for item in dates_ts if item > date), dates_ts)])
-    values = np.array(temp)
+    # get the first point after each date (no interpolation), all the dates are looked up
+    # at once with np.searchsorted (see NOC_timeseries for 'nearest' and 'linear')
+    values = NOC_timeseries.get_values(dates, dates_ts, values_ts, method='next')
     
     return values
 
@@ -598,9 +633,68 @@ def transects_from_geojson(filename):
 
     return transects
 
+def geometries_from_coords(coords, offsets, geomtype='lines'):
+    """
+    Creates the shapely geometries of a ragged array of coordinates (flat array + offsets,
+    see NOC_georef.ragged_from_list) in one step with the vectorized constructors of
+    shapely 2, or one by one with older versions of shapely.
+    
+    Arguments:
+    -----------
+    coords: np.array
+        array with 2 columns (X,Y) containing the coordinates of all the geometries
+    offsets: np.array
+        vector with the start/end of each geometry in coords
+    geomtype: str
+        'lines' for LineString and 'points' for MultiPoint geometry
+                
+    Returns:    
+    -----------
+    geoms: np.array
+        array of shapely geometries, one per geometry in offsets (None for the
+        geometries with less than 2 points for 'lines' or no points for 'points')
+  
+    """
+    
+    if not geomtype in ['lines', 'points']:
+        raise Exception('geomtype %s is not an option, choose between lines or points'%geomtype)
+    coords = np.asarray(coords, dtype=float)[:,:2]
+    offsets = np.asarray(offsets, dtype=int)
+    # geometries with too few points are None
+    lengths = np.diff(offsets)
+    valid = lengths >= (2 if geomtype == 'lines' else 1)
+    geoms = np.full(len(lengths), None, dtype=object)
+    if not np.any(valid):
+        return geoms
+    if hasattr(shapely, 'linestrings'):
+        # shapely 2: all the geometries from the flat array at once
+        ids = NOC_georef.ragged_ids(offsets)
+        idx_points = valid[ids]
+        # consecutive indices of the valid geometries
+        ids_valid = (np.cumsum(valid) - 1)[ids[idx_points]]
+        if geomtype == 'lines':
+            geoms[valid] = shapely.linestrings(coords[idx_points], indices=ids_valid)
+        else:
+            geoms[valid] = shapely.multipoints(coords[idx_points], indices=ids_valid)
+        return geoms
+    for i in np.where(valid)[0]:
+        if geomtype == 'lines':
+            geoms[i] = geometry.LineString(coords[offsets[i]:offsets[i+1]])
+        else:
+            geoms[i] = geometry.MultiPoint(coords[offsets[i]:offsets[i+1]])
+    return geoms
+
+def _geometries_from_list(arrays, geomtype, min_points):
+    "geometries of the arrays with at least min_points coordinates, and their index"
+    idx = np.array([i for i in range(len(arrays)) if len(arrays[i]) >= min_points], dtype=int)
+    coords, offsets = NOC_georef.ragged_from_list([arrays[i] for i in idx])
+    return geometries_from_coords(coords, offsets, geomtype), idx
+
 def output_to_gdf(output, geomtype):
     """
-    Saves the mapped shorelines as a gpd.GeoDataFrame    
+    Saves the mapped shorelines as a gpd.GeoDataFrame, all the geometries and attributes
+    are created at once. Empty shorelines (and shorelines of a single point for 'lines')
+    are skipped, the index of the GeoDataFrame is the index of the shoreline in output.
     
     KV WRL 2018
 
@@ -617,41 +711,21 @@ def output_to_gdf(output, geomtype):
         contains the shorelines + attirbutes
   
     """    
-     
-    # loop through the mapped shorelines
-    counter = 0
-    for i in range(len(output['shorelines'])):
-        # skip if there shoreline is empty 
-        if len(output['shorelines'][i]) == 0:
-            continue
-        else:
-            # save the geometry depending on the linestyle
-            if geomtype == 'lines':
-                geom = geometry.LineString(output['shorelines'][i])
-            elif geomtype == 'points':
-                coords = output['shorelines'][i]
-                geom = geometry.MultiPoint([(coords[_,0], coords[_,1]) for _ in range(coords.shape[0])])
-            else:
-                raise Exception('geomtype %s is not an option, choose between lines or points'%geomtype)
-            # save into geodataframe with attributes
-            gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-            gdf.index = [i]
-            gdf.loc[i,'date'] = output['dates'][i].strftime('%Y-%m-%d %H:%M:%S')
-            gdf.loc[i,'satname'] = output['satname'][i]
-            gdf.loc[i,'geoaccuracy'] = output['geoaccuracy'][i]
-            gdf.loc[i,'cloud_cover'] = output['cloud_cover'][i]
-            # store into geodataframe
-            if counter == 0:
-                gdf_all = gdf
-            else:
-                gdf_all = gdf_all.append(gdf)
-            counter = counter + 1
+    
+    geoms, idx = _geometries_from_list(output['shorelines'], geomtype,
+                                       2 if geomtype == 'lines' else 1)
+    attributes = dict([])
+    attributes['date'] = [output['dates'][i].strftime('%Y-%m-%d %H:%M:%S') for i in idx]
+    for key in ['satname', 'geoaccuracy', 'cloud_cover']:
+        attributes[key] = [output[key][i] for i in idx]
+    gdf_all = gpd.GeoDataFrame(attributes, index=idx, geometry=list(geoms))
             
     return gdf_all
 
 def transects_to_gdf(transects):
     """
-    Saves the shore-normal transects as a gpd.GeoDataFrame    
+    Saves the shore-normal transects as a gpd.GeoDataFrame, all the geometries are
+    created at once.
     
     KV WRL 2018
 
@@ -666,19 +740,11 @@ def transects_to_gdf(transects):
 
         
     """  
-       
-    # loop through the mapped shorelines
-    for i,key in enumerate(list(transects.keys())):
-        # save the geometry + attributes
-        geom = geometry.LineString(transects[key])
-        gdf = gpd.GeoDataFrame(geometry=gpd.GeoSeries(geom))
-        gdf.index = [i]
-        gdf.loc[i,'name'] = key
-        # store into geodataframe
-        if i == 0:
-            gdf_all = gdf
-        else:
-            gdf_all = gdf_all.append(gdf)
+    
+    keys = list(transects.keys())
+    coords, offsets = NOC_georef.ragged_from_list([transects[key] for key in keys])
+    geoms = geometries_from_coords(coords, offsets, 'lines')
+    gdf_all = gpd.GeoDataFrame({'name': keys}, index=np.arange(len(keys)), geometry=list(geoms))
             
     return gdf_all
 
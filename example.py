@@ -17,7 +17,8 @@ from matplotlib import gridspec
 plt.ion()
 import pandas as pd
 from datetime import datetime
-from coastsat import SDS_download, SDS_preprocess, SDS_shoreline, SDS_tools, SDS_transects
+from coastsat import SDS_download, SDS_preprocess, SDS_shoreline, SDS_tools, SDS_transects, \
+                     NOC_rates
 
 # region of interest (longitude, latitude in WGS84)
 polygon = [[[151.301454, -33.700754],
@@ -134,10 +135,11 @@ with open(os.path.join(filepath, sitename + '_output' + '.pkl'), 'rb') as f:
 # now we have to define cross-shore transects over which to quantify the shoreline changes
 # each transect is defined by two points, its origin and a second point that defines its orientation
 
-# there are 3 options to create the transects:
+# there are 4 options to create the transects:
 # - option 1: draw the shore-normal transects along the beach
 # - option 2: load the transect coordinates from a .kml file
 # - option 3: create the transects manually by providing the coordinates
+# - option 4: cast the transects automatically along the reference shoreline
 
 # option 1: draw origin of transect first and then a second point to define the orientation
 # transects = SDS_transects.draw_transects(output, settings)
@@ -153,6 +155,13 @@ transects = SDS_tools.transects_from_geojson(geojson_file)
 # transects['NA3'] = np.array([[16842602, -3990878], [16842955, -3990949]])
 # transects['NA4'] = np.array([[16842596, -3991929], [16842955, -3991895]])
 # transects['NA5'] = np.array([[16842838, -3992900], [16843155, -3992727]])
+
+# option 4: cast shore-normal transects every 50 m along the reference shoreline (or a baseline
+# loaded with NOC_transects.baseline_from_geojson), with the origins 200 m landward. land_side
+# is the side of the land when walking along the shoreline from its first to its last point
+# from coastsat import NOC_transects
+# transects = NOC_transects.cast_transects(settings['reference_shoreline'], spacing=50, length=500,
+#                                          landward=200, smoothing=500, land_side='left')
    
 # plot the transects to make sure they are correct (origin landwards!)
 fig = plt.figure(figsize=[15,8], tight_layout=True)
@@ -201,6 +210,9 @@ filepath = os.path.join(os.getcwd(),'examples','NARRA_tides.csv')
 tide_data = pd.read_csv(filepath, parse_dates=['dates'])
 dates_ts = [_.to_pydatetime() for _ in tide_data['dates']]
 tides_ts = np.array(tide_data['tide'])
+# for very long records, only the records around the image dates can be read with:
+# from coastsat import NOC_timeseries
+# dates_ts, tides_ts = NOC_timeseries.read_timeseries(filepath, output['dates'])
 
 # get tide levels corresponding to the time of image acquisition
 dates_sat = output['dates']
@@ -217,10 +229,11 @@ ax.legend()
 # tidal correction along each transect
 reference_elevation = 0 # elevation at which you would like the shoreline time-series to be
 beach_slope = 0.1
-cross_distance_tidally_corrected = {}
-for key in cross_distance.keys():
-    correction = (tides_sat-reference_elevation)/beach_slope
-    cross_distance_tidally_corrected[key] = cross_distance[key] + correction
+correction = (tides_sat-reference_elevation)/beach_slope
+# apply the correction to all the transects at once (one row per transect)
+keys = list(cross_distance.keys())
+cross_distance_array = np.array([cross_distance[key] for key in keys]) + correction
+cross_distance_tidally_corrected = dict(zip(keys, cross_distance_array))
     
 # store the tidally-corrected time-series in a .csv file
 out_dict = dict([])
@@ -248,4 +261,16 @@ for i,key in enumerate(cross_distance.keys()):
     ax.set_ylabel('distance [m]', fontsize=12)
     ax.text(0.5,0.95, key, bbox=dict(boxstyle="square", ec='k',fc='w'), ha='center',
             va='top', transform=ax.transAxes, fontsize=14)
-ax.legend()
\ No newline at end of file
+ax.legend()
+
+#%% 5. Shoreline change statistics (DSAS)
+
+# Net Shoreline Movement, End Point Rate, Linear Regression Rate and Weighted Linear Regression
+# along each transect, computed from the tidally-corrected time-series (the weights of the WLR
+# can be the number of images in each composite, output['median_no'] with NOC_shoreline)
+years = NOC_rates.output_years(output)
+rates = NOC_rates.compute_rates(cross_distance_tidally_corrected, years, weights=None,
+                                min_shorelines=6, confidence=0.95)
+print(rates)
+# save as a .csv table and as a .geojson with the statistics as attributes of the transects
+gdf_rates = NOC_rates.save_rates(rates, transects, settings)
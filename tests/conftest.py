@@ -0,0 +1,35 @@
+"""
+Shared fixtures of the offline tests: the Earth Engine client of NOC_download is replaced
+by the fake client of tests/fake_ee.py. NOC_io and NOC_coreg import osgeo only in the
+functions that read or write GeoTiffs, so the other tests run without GDAL and the tests
+marked requires_gdal are skipped.
+Run from the root of the repository: python -m pytest tests
+"""
+
+import pytest
+
+from coastsat import NOC_download
+from tests.fake_ee import EarthEngine
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+requires_gdal = pytest.mark.skipif(gdal is None, reason='GDAL (osgeo) is not available')
+
+# settings of the composites (as in example.py)
+SETTINGS = {'LCloudScore': 20, 'LCloudThreshold': 35, 'add_L7_to_L5': True,
+            'add_L5_to_L7': True, 'add_L7_to_L8': True, 'CLOUD_FILTER': 60,
+            'CLD_PRB_THRESH': 40, 'NIR_DRK_THRESH': 0.15, 'CLD_PRJ_DIST': 2, 'BUFFER': 100}
+POLYGON = [[[151.3, -33.7], [151.4, -33.7], [151.4, -33.8], [151.3, -33.8], [151.3, -33.7]]]
+DATES = ['2019-01-01', '2019-12-31']
+
+@pytest.fixture
+def fake_ee(monkeypatch):
+    "fake ee client in NOC_download, without the graphs memoized by the previous tests"
+    client = EarthEngine(n_images=12)
+    monkeypatch.setattr(NOC_download, 'ee', client)
+    NOC_download._COMPOSITES.clear()
+    yield client
+    NOC_download._COMPOSITES.clear()
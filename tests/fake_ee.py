@@ -0,0 +1,323 @@
+"""
+This module contains offline stand-ins for the Google Earth Engine services, used to check
+and benchmark the download functions without an Earth Engine account or network access:
+    - a local HTTP server that serves the zip files of the download URLs, with a quota of
+      concurrent requests like the Earth Engine server (HTTP 429 when it is exceeded)
+    - a fake ee.Image whose getDownloadURL points to the local server
+    - a fake ee client that builds the computation graphs without evaluating them and
+      counts the round-trips to the server (getInfo) and the calls of the algorithms in
+      the graphs
+
+The stand-ins only implement what is used by NOC_download.
+"""
+
+# load modules
+import io
+import time
+import zipfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+###################################################################################################
+# LOCAL HTTP SERVER
+###################################################################################################
+
+class DownloadServer(object):
+    """
+    Local HTTP server serving files from memory, in a background thread. Each request
+    waits for delay seconds (to mimic the time Earth Engine takes to prepare a download)
+    and is counted. The requests received while max_concurrent requests are already
+    being answered are rejected with HTTP 429 (Too Many Requests).
+
+    Arguments:
+    -----------
+    files: dict
+        content (bytes) of the files, by path (e.g. '/data_30.zip')
+    delay: float
+        time waited before answering each request, in seconds
+    max_concurrent: int
+        quota of concurrent requests, no quota if None
+
+    """
+
+    def __init__(self, files=None, delay=0, max_concurrent=None):
+        self.files = dict([]) if files is None else dict(files)
+        self.delay = delay
+        self.max_concurrent = max_concurrent
+        self.requests = []
+        self.n_rejected = 0
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.max_in_flight = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not server._count(self.path, +1):
+                    self.send_error(429, 'Too Many Requests')
+                    return
+                try:
+                    time.sleep(server.delay)
+                    if not self.path in server.files:
+                        self.send_error(404)
+                        return
+                    content = server.files[self.path]
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/zip')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                finally:
+                    server._count(None, -1)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _count(self, path, step):
+        "counts the requests in flight, returns False if the quota is exceeded"
+        with self._lock:
+            if path is not None:
+                self.requests.append(path)
+                if self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                    self.n_rejected += 1
+                    return False
+            self._in_flight += step
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            return True
+
+    def url(self, path):
+        "URL of a file of the server"
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_address[1], path)
+
+    def close(self):
+        "stops the server"
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def make_zip(files):
+    """
+    Creates a zip file in memory, like the downloads of Earth Engine.
+
+    Arguments:
+    -----------
+    files: dict
+        content (bytes) of the files in the zip, by name (e.g. 'data.tif')
+
+    Returns:
+    -----------
+    content: bytes
+        the zip file
+
+    """
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as f:
+        for name in files.keys():
+            f.writestr(name, files[name])
+    return buffer.getvalue()
+
+###################################################################################################
+# FAKE EARTH ENGINE OBJECTS
+###################################################################################################
+
+class Image(object):
+    """
+    Stand-in for ee.Image, getDownloadURL returns the URL of the zip file served for the
+    scale of the request (e.g. server.files['/data_30.zip'] for a scale of 30 m), or for
+    the name of the request for the tiles (e.g. server.files['/data_30m_r0_c1.zip']).
+
+    Arguments:
+    -----------
+    server: DownloadServer
+        local server with the zip files
+
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.download_params = []
+
+    def getDownloadURL(self, params):
+        self.download_params.append(params)
+        if not 'scale' in params.keys():
+            # tile on a pixel grid (crs_transform and dimensions), the name identifies it
+            return self.server.url('/%s.zip' % params['name'])
+        return self.server.url('/%s_%s.zip' % (params['name'], params['scale']))
+
+class EarthEngine(object):
+    """
+    Stand-in for the ee module: all the ee objects and methods (ee.ImageCollection,
+    .filterDate, .map, ee.Algorithms.Landsat.simpleCloudScore, ...) return graph nodes that
+    are not evaluated, except with getInfo which counts a round-trip to the server and
+    returns placeholder values: the number of images for size(), the CRS for crs() and
+    the values of properties for get().
+    Replace the module used by NOC_download with: NOC_download.ee = fake_ee.EarthEngine()
+
+    Arguments:
+    -----------
+    n_images: int
+        number of images returned by size()
+    crs: str
+        coordinate reference system returned by crs()
+    properties: dict
+        values of the image properties returned by get()
+
+    """
+
+    def __init__(self, n_images=10, crs='EPSG:4326', properties=None):
+        self.n_images = n_images
+        self.crs = crs
+        self.properties = {'CLOUD_COVER': 5, 'CLOUDY_PIXEL_PERCENTAGE': 10,
+                           'system:index': 'LC08_089083_20190105',
+                           'system:time_start': 1546646400000}
+        if properties is not None:
+            self.properties.update(properties)
+        self.round_trips = 0
+        self.__version__ = '0.1.300'
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Node(self, name)
+
+    def _get_info(self, node):
+        self.round_trips += 1
+        return self._evaluate(node)
+
+    def _evaluate(self, value):
+        if isinstance(value, dict):
+            return dict([(key, self._evaluate(value[key])) for key in value.keys()])
+        elif isinstance(value, (list, tuple)):
+            return [self._evaluate(_) for _ in value]
+        elif not isinstance(value, _Node):
+            return value
+        if value._name in ['Dictionary', 'Number', 'String'] and len(value._args) > 0:
+            return self._evaluate(value._args[0])
+        elif value._name == 'size':
+            return self.n_images
+        elif value._name == 'crs':
+            return self.crs
+        elif value._name == 'get':
+            return self.properties.get(value._args[0])
+        elif value._name == 'toList':
+            return [None]*self.n_images
+        elif value._name == 'getInfo':
+            return None
+        return {'type': value._name, 'bands': [{'crs': self.crs}]}
+
+class _Node(object):
+    "node of a computation graph of the fake ee client"
+
+    def __init__(self, client, name, args=(), kwargs=None, parent=None):
+        self._client = client
+        self._name = name
+        self._args = args
+        self._kwargs = dict([]) if kwargs is None else kwargs
+        self._parent = parent
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Node(self._client, name, parent=self)
+
+    def __call__(self, *args, **kwargs):
+        # build the graphs of the functions mapped over collections (called once with a
+        # placeholder image, like the ee client does to serialize them)
+        args = tuple([_Node(self._client, 'Function', (arg(_Node(self._client, 'Image')),))
+                      if callable(arg) and not isinstance(arg, _Node) else arg for arg in args])
+        return _Node(self._client, self._name, args, kwargs, self._parent)
+
+    def getInfo(self):
+        return self._client._get_info(self)
+
+    def serialize(self):
+        "canonical text of the graph (the ee client returns its JSON)"
+        return expression(self)
+
+def serialize(node):
+    """
+    Nodes of the computation graph of a fake ee object (with the bodies of the mapped
+    functions), each node once even if it is used several times, like the serialized
+    graphs sent to the Earth Engine server.
+
+    Arguments:
+    -----------
+    node: _Node
+        result of the fake ee client (e.g. a median image)
+
+    Returns:
+    -----------
+    nodes: list of _Node
+        nodes of the graph
+
+    """
+
+    nodes = dict([])
+    stack = [node]
+    while len(stack) > 0:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif isinstance(value, _Node) and not id(value) in nodes.keys():
+            nodes[id(value)] = value
+            stack.extend([value._args, value._kwargs, value._parent])
+
+    return list(nodes.values())
+
+def count_calls(node, name):
+    "number of calls of an algorithm (e.g. 'simpleCloudScore') in the graph of a fake ee object"
+    return sum([1 for _ in serialize(node) if _._name == name and
+                (len(_._args) > 0 or len(_._kwargs) > 0)])
+
+def expression(node):
+    """
+    Canonical text of the computation graph of a fake ee object: the same text means the
+    same graph, with the same nodes shared (a node used several times is written once as
+    #k=... and then referred to as #k), e.g. to check that a refactoring builds the same
+    graphs.
+
+    Arguments:
+    -----------
+    node: _Node
+        result of the fake ee client (e.g. a median image)
+
+    Returns:
+    -----------
+    text: str
+
+    """
+
+    ids = dict([])
+
+    def write(value):
+        if isinstance(value, dict):
+            return '{%s}' % ', '.join(['%s: %s' % (key, write(value[key]))
+                                       for key in sorted(value.keys())])
+        elif isinstance(value, (list, tuple)):
+            return '[%s]' % ', '.join([write(_) for _ in value])
+        elif not isinstance(value, _Node):
+            return repr(value)
+        if id(value) in ids.keys():
+            return '#%d' % ids[id(value)]
+        ids[id(value)] = len(ids)
+        text = '#%d=%s%s(%s)' % (ids[id(value)],
+                                 '' if value._parent is None else write(value._parent) + '.',
+                                 value._name, ', '.join([write(_) for _ in value._args] +
+                                                        ['%s=%s' % (key, write(value._kwargs[key]))
+                                                         for key in sorted(value._kwargs.keys())]))
+        return text
+
+    return write(node)
@@ -0,0 +1,38 @@
+"""
+The graphs of the composites built from the recipes (NOC_download.RECIPES) are identical
+to the graphs of the previous obtain_image_median, frozen in data/composite_graphs.json as
+canonical expressions of the fake ee client (tests/fake_ee.py).
+"""
+
+import os
+import json
+import pytest
+
+from coastsat import NOC_download
+from tests.fake_ee import expression
+from tests.conftest import SETTINGS, POLYGON, DATES
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'composite_graphs.json')) as f:
+    GRAPHS = json.load(f)
+
+@pytest.mark.parametrize('satname', ['L5', 'L7', 'L8', 'S2'])
+@pytest.mark.parametrize('merge', [True, False])
+def test_graphs_unchanged(fake_ee, satname, merge):
+    settings = dict(SETTINGS, add_L7_to_L5=merge, add_L5_to_L7=merge, add_L7_to_L8=merge)
+    image, counts = NOC_download.obtain_image_median(NOC_download.COLLECTIONS[satname], DATES,
+                                                     fake_ee.Geometry.Polygon(POLYGON),
+                                                     [satname], settings)
+    assert expression(image) == GRAPHS['%s_merge_%s' % (satname, merge)]
+    # the mission of the collection first
+    assert list(counts.keys())[0] == satname
+
+def test_memoized_by_geometry(fake_ee):
+    # retrieve_images creates a new ee.Geometry for each composite
+    images = [NOC_download.obtain_image_median(NOC_download.COLLECTIONS['L8'], DATES,
+                                               fake_ee.Geometry.Polygon(POLYGON), ['L8'],
+                                               SETTINGS)[0] for _ in range(2)]
+    assert images[0] is images[1]
+    other = NOC_download.obtain_image_median(NOC_download.COLLECTIONS['L8'], DATES,
+                                             fake_ee.Geometry.Polygon([POLYGON[0][::-1]]),
+                                             ['L8'], SETTINGS)[0]
+    assert other is not images[0]
@@ -0,0 +1,97 @@
+"""
+Recovery of known sub-pixel shifts with the local co-registration (NOC_coreg) on a smooth
+synthetic scene, where the window of the phase correlation biases a single estimate
+towards 0 (see benchmarks/benchmark_coregistration.py for the timings).
+"""
+
+import os
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from coastsat import NOC_coreg, NOC_georef
+from tests.conftest import gdal, requires_gdal
+
+GEOREF = (151.0, 0.0003, 0, -33.0, 0, -0.0003)
+
+def smooth_scene(shape=(256, 256), sigma=8, seed=0):
+    "smooth texture (the bias of a single phase correlation is the largest on such scenes)"
+    rng = np.random.RandomState(seed)
+    return ndimage.gaussian_filter(rng.rand(*shape), sigma)
+
+def shifted(ref, shift, seed=1):
+    "im(p) = ref(p - shift) with another gain and some noise"
+    rng = np.random.RandomState(seed)
+    im = ndimage.shift(ref, shift, order=3, mode='nearest')
+    return 2*im + 0.1 + rng.normal(0, 0.02*np.std(ref), ref.shape)
+
+@pytest.mark.parametrize('shift', [(0.5, 0.5), (1.0, 1.0), (2.0, 2.0), (1.3, -0.7)])
+def test_subpixel_shift_recovered(shift):
+    ref = smooth_scene()
+    tiles = NOC_coreg.estimate_shifts(ref, shifted(ref, shift))
+    # the tiles at the edges see the border of ndimage.shift
+    assert len(tiles) >= 25
+    fit = NOC_coreg.fit_model(tiles)
+    assert np.all(np.abs(fit['coefs'][:,0] - shift) < 0.05)
+    # each tile to 1/upsample pixel
+    inner = tiles[np.all((tiles[:,:2] > 64) & (tiles[:,:2] < 192), axis=1)]
+    assert np.all(np.abs(inner[:,2:4] - shift) <= 0.05 + 1e-9)
+
+def test_window_bias_removed():
+    # a single phase correlation of a 64 pixel tile underestimates the shift
+    ref = smooth_scene()
+    im = shifted(ref, (1.0, 1.0))
+    win = (slice(96, 160), slice(96, 160))
+    single, _ = NOC_coreg.phase_correlation(ref[win], im[win], eps=0)
+    assert np.max(np.abs(np.array(single) - 1.0)) > 0.05
+    tiles = NOC_coreg.estimate_shifts(ref, im, max_iter=10)
+    assert np.all(np.abs(NOC_coreg.fit_model(tiles)['coefs'][:,0] - 1.0) < 0.05)
+
+def test_corrected_geotransform():
+    shift = (1.3, -0.7)
+    ref = smooth_scene()
+    fit = NOC_coreg.fit_model(NOC_coreg.estimate_shifts(ref, shifted(ref, shift)))
+    new_georef = NOC_coreg.corrected_geotransform(GEOREF, fit['coefs'])
+    # pixel (row, col) of im shows the ground at (row, col) - shift of the reference
+    for row, col in [(32, 32), (128, 200), (250, 10)]:
+        xy_true = NOC_georef.Affine(GEOREF).matrix.dot([col - shift[1], row - shift[0], 1])
+        xy_new = NOC_georef.Affine(new_georef).matrix.dot([col, row, 1])
+        assert np.hypot(*(xy_new - xy_true)[:2]) < 0.05*GEOREF[1]
+
+def write_geotiff(fn, im, georef):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    ds = gdal.GetDriverByName('GTiff').Create(fn, im.shape[1], im.shape[0], im.shape[2],
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform(georef)
+    ds.SetProjection('EPSG:4326')
+    for k in range(im.shape[2]):
+        ds.GetRasterBand(k+1).WriteArray(im[:,:,k])
+    ds = None
+
+@requires_gdal
+def test_coregister_l8_composite(tmpdir):
+    # the paths in the order of NOC_download.composite_paths (pan first for L8)
+    shift = (0.6, -1.2)
+    ground = smooth_scene((768, 768), sigma=24)
+    reference = ground.reshape(256, 3, 256, 3).mean(axis=(1, 3))
+    filepath = str(tmpdir)
+    fn_s2 = os.path.join('site', 'S2', '10m', 'S2_site.tif')
+    write_geotiff(os.path.join(filepath, fn_s2), np.repeat(ground[:,:,None], 4, axis=2),
+                  (151.0, 0.0001, 0, -33.0, 0, -0.0001))
+    fns = [os.path.join('site', 'L8', 'pan', 'L8_site.tif'),
+           os.path.join('site', 'L8', 'ms', 'L8_site.tif')]
+    write_geotiff(os.path.join(filepath, fns[0]), np.zeros((512, 512, 1)),
+                  (151.0, 0.00015, 0, -33.0, 0, -0.00015))
+    write_geotiff(os.path.join(filepath, fns[1]),
+                  np.repeat(shifted(reference, shift)[:,:,None], 6, axis=2), GEOREF)
+    composite = {'sitename': 'site', 'satname': 'L8', 'filename': 'L8_site.tif', 'paths': fns}
+    s2 = {'sitename': 'site', 'satname': 'S2', 'filename': 'S2_site.tif', 'paths': [fn_s2]}
+    result = NOC_coreg.coregister_composite(filepath, composite, s2)
+    assert result['updated']
+    assert np.all(np.abs(np.array(result['coefs'])[:,0] - shift) < 0.05)
+    # the pan GeoTiff is corrected with the same offset in world coordinates
+    for fn, res in zip(fns, [0.00015, 0.0003]):
+        georef = gdal.Open(os.path.join(filepath, fn)).GetGeoTransform()
+        assert georef[1] == res
+        assert np.isclose(georef[0], 151.0 - shift[1]*0.0003)
+        assert np.isclose(georef[3], -33.0 + shift[0]*0.0003)
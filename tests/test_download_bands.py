@@ -0,0 +1,68 @@
+"""
+Concurrent downloads of the band groups of a Sentinel-2 composite from the local HTTP
+stand-in for the Earth Engine download URLs (tests/fake_ee.py) with
+NOC_download.download_bands (see benchmarks/benchmark_download.py for the timings).
+"""
+
+import os
+import numpy as np
+
+from coastsat import NOC_download
+from tests import fake_ee
+from tests.conftest import gdal, requires_gdal
+
+BAND_GROUPS = [(10, '10m', ['B2', 'B3', 'B4', 'B8']),
+               (20, '20m', ['B12']),
+               (60, '60m', ['QA60'])]
+FN = 'S2_site_median_S20200101_E20201231.tif'
+
+def geotiff_bytes(im):
+    "content of an uncompressed GeoTiff with the bands of im (like the Earth Engine downloads)"
+    fn = '/vsimem/%d.tif' % np.random.randint(1e9)
+    ds = gdal.GetDriverByName('GTiff').Create(fn, im.shape[1], im.shape[0], im.shape[2],
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform([151.3, 0.0001, 0, -33.7, 0, -0.0001])
+    for k in range(im.shape[2]):
+        ds.GetRasterBand(k+1).WriteArray(im[:,:,k])
+    ds = None
+    f = gdal.VSIFOpenL(fn, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    content = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(fn)
+    return content
+
+@requires_gdal
+def test_download_bands(tmpdir):
+    # one zip file per scale, with a single data.tif or (10 m) one file per band
+    content = dict([])
+    files = dict([])
+    for scale, folder, bands in BAND_GROUPS:
+        size = 1200//scale
+        content[scale] = np.random.uniform(0, 1, (size, size, len(bands))).astype(np.float32)
+        if scale == 10:
+            members = dict([('data.%s.tif' % band, geotiff_bytes(content[scale][:,:,[k]]))
+                            for k, band in enumerate(bands)])
+        else:
+            members = {'data.tif': geotiff_bytes(content[scale])}
+        files['/data_%d.zip' % scale] = fake_ee.make_zip(members)
+
+    groups = []
+    for scale, folder, bands in BAND_GROUPS:
+        os.makedirs(os.path.join(str(tmpdir), folder))
+        groups.append((scale, os.path.join(str(tmpdir), folder), bands))
+    with fake_ee.DownloadServer(files, delay=0.2) as server:
+        paths = NOC_download.download_bands(fake_ee.Image(server), [], groups, FN, 3)
+    # the three groups at the same time
+    assert server.max_in_flight == 3
+    for (scale, folder, _), path in zip(BAND_GROUPS, paths):
+        assert path == os.path.join(str(tmpdir), folder, FN)
+        # no temporary files left
+        assert os.listdir(os.path.dirname(path)) == [FN]
+        ds = gdal.Open(path)
+        im = np.stack([ds.GetRasterBand(k+1).ReadAsArray() for k in range(ds.RasterCount)], 2)
+        ds = None
+        assert np.array_equal(im, content[scale])
+    assert sorted(os.listdir(str(tmpdir))) == ['10m', '20m', '60m']
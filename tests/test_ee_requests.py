@@ -0,0 +1,49 @@
+"""
+Requests to the Earth Engine server for each composite, counted with the fake ee client
+of tests/fake_ee.py (see benchmarks/benchmark_download.py).
+"""
+
+import pytest
+
+from coastsat import NOC_download, NOC_cache
+from tests.fake_ee import count_calls
+from tests.conftest import SETTINGS, POLYGON, DATES
+
+@pytest.mark.parametrize('satname', ['L5', 'L7', 'L8', 'S2'])
+def test_one_round_trip_per_composite(fake_ee, satname):
+    image, counts = NOC_download.obtain_image_median(NOC_download.COLLECTIONS[satname], DATES,
+                                                     fake_ee.Geometry.Polygon(POLYGON),
+                                                     [satname], SETTINGS)
+    references = None
+    if not satname == 'S2':
+        displacement, references = NOC_download.Landsat_Coregistration({'polygon': POLYGON})
+    assert fake_ee.round_trips == 0
+    info = NOC_download.get_composite_info(image, counts, references)
+    # the counts, the CRS and the co-registration images in a single request
+    assert fake_ee.round_trips == 1
+    assert info['median_no'] == fake_ee.n_images*len(counts)
+
+def test_no_round_trip_with_warm_cache(fake_ee, tmpdir):
+    inputs = {'polygon': POLYGON, 'dates': DATES, 'sat_list': ['L8'], 'sitename': 'site',
+              'filepath': str(tmpdir)}
+    settings = dict(SETTINGS, coregistration=True)
+    cache = NOC_cache.get_cache(inputs, settings)
+    round_trips = []
+    for run in range(2):
+        fake_ee.round_trips = 0
+        image, counts = NOC_download.obtain_image_median(NOC_download.COLLECTIONS['L8'], DATES,
+                                                         fake_ee.Geometry.Polygon(POLYGON),
+                                                         ['L8'], settings)
+        info, displacement = NOC_download.get_composite_metadata(image, counts, inputs,
+                                                                 settings, cache, True)
+        round_trips.append(fake_ee.round_trips)
+    assert round_trips == [1, 0]
+
+@pytest.mark.parametrize('satname', ['L5', 'L7', 'L8'])
+def test_landsat_images_scored_once(fake_ee, satname):
+    image, counts = NOC_download.obtain_image_median(NOC_download.COLLECTIONS[satname], DATES,
+                                                     fake_ee.Geometry.Polygon(POLYGON),
+                                                     [satname], SETTINGS)
+    # one simpleCloudScore per collection, used for the filter and the mask
+    assert len(counts) == 2
+    assert count_calls(image, 'simpleCloudScore') == len(counts)
@@ -0,0 +1,84 @@
+"""
+Shoreline change statistics of NOC_rates.compute_rates (all the transects at once) compared
+with the statistics computed one transect at a time with numpy and scipy.
+"""
+
+import numpy as np
+import pytest
+from datetime import datetime
+from scipy import stats
+
+from coastsat import NOC_rates
+
+def rates_loop(cross_dist, years, weights, min_shorelines, confidence):
+    "statistics of each transect, computed separately"
+    order = np.argsort(years, kind='mergesort')
+    t = stats.t.ppf(0.5 + confidence/2, np.arange(100) - 2)
+    rates = dict([])
+    for key in cross_dist.keys():
+        y = np.asarray(cross_dist[key], dtype=float)[order]
+        valid = ~np.isnan(y)
+        x, y, w = years[order][valid], y[valid], weights[order][valid]
+        n = len(y)
+        row = {'n_shorelines': n}
+        if n < max(min_shorelines, 2):
+            rates[key] = row
+            continue
+        row['SCE'] = np.max(y) - np.min(y)
+        row['NSM'] = y[-1] - y[0]
+        row['EPR'] = (y[-1] - y[0])/(x[-1] - x[0])
+        fit = stats.linregress(x, y)
+        row['LRR'], row['LR2'] = fit.slope, fit.rvalue**2
+        row['LCI'] = t[n]*fit.stderr if n >= 3 else np.nan
+        # weighted least squares
+        slope, intercept = np.polyfit(x, y, 1, w=np.sqrt(w))
+        res = y - (slope*x + intercept)
+        xm, ym = np.sum(w*x)/np.sum(w), np.sum(w*y)/np.sum(w)
+        row['WLR'] = slope
+        row['WR2'] = 1 - np.sum(w*res**2)/np.sum(w*(y - ym)**2)
+        row['WCI'] = (t[n]*np.sqrt(np.sum(w*res**2)/(n - 2)/np.sum(w*(x - xm)**2))
+                      if n >= 3 else np.nan)
+        rates[key] = row
+    return rates
+
+def time_series(seed=0, n_transects=40, n_shorelines=25):
+    "cross-shore distances with trends, noise and missing shorelines, dates not sorted"
+    rng = np.random.RandomState(seed)
+    years = rng.uniform(1990, 2020, n_shorelines)
+    trends = rng.normal(0, 2, n_transects)
+    cross_dist = dict([])
+    for k in range(n_transects):
+        y = 100 + trends[k]*(years - 2000) + rng.normal(0, 5, n_shorelines)
+        # missing shorelines, up to all but two on the last transects
+        y[rng.rand(n_shorelines) < k/n_transects] = np.nan
+        cross_dist[str(k + 1)] = y
+    cross_dist['no shoreline'] = np.ones(n_shorelines)*np.nan
+    return cross_dist, years, rng.randint(1, 30, n_shorelines).astype(float)
+
+@pytest.mark.parametrize('min_shorelines', [2, 6])
+@pytest.mark.parametrize('confidence', [0.95, 0.9])
+def test_same_as_loop(min_shorelines, confidence):
+    cross_dist, years, weights = time_series()
+    rates = NOC_rates.compute_rates(cross_dist, years, weights, min_shorelines, confidence)
+    expected = rates_loop(cross_dist, years, weights, min_shorelines, confidence)
+    assert list(rates.index) == list(cross_dist.keys())
+    # some transects are below the intersection threshold
+    assert np.sum(rates['n_shorelines'] < min_shorelines) > 0
+    for key in cross_dist.keys():
+        assert rates.loc[key, 'n_shorelines'] == expected[key]['n_shorelines']
+        for col in ['SCE', 'NSM', 'EPR', 'LRR', 'LCI', 'LR2', 'WLR', 'WCI', 'WR2']:
+            np.testing.assert_allclose(rates.loc[key, col], expected[key].get(col, np.nan),
+                                       rtol=1e-9, atol=1e-9, err_msg='%s %s' % (key, col))
+
+def test_unweighted():
+    # without weights the WLR is the LRR
+    cross_dist, years, _ = time_series(seed=1)
+    rates = NOC_rates.compute_rates(cross_dist, years)
+    for a, b in [('WLR', 'LRR'), ('WCI', 'LCI'), ('WR2', 'LR2')]:
+        np.testing.assert_allclose(rates[a].values, rates[b].values, rtol=1e-9)
+
+def test_decimal_years():
+    years = NOC_rates.decimal_years([datetime(2018, 7, 2, 12), '2020-01-01', '2019-12-31'])
+    np.testing.assert_allclose(years, [2018.5, 2020, 2019 + 364/365])
+    output = {'start': ['2018-01-01'], 'end': ['2019-01-01']}
+    np.testing.assert_allclose(NOC_rates.output_years(output), [2018.5])
@@ -0,0 +1,43 @@
+"""
+Downloads of a matrix of 5 sites x 4 periods x 2 satellite missions from the local fake
+Earth Engine server (fake_ee.DownloadServer), which rejects the requests beyond 4 at
+the same time (HTTP 429), with NOC_scheduler (see benchmarks/benchmark_scheduler.py for
+the timings).
+"""
+
+import functools
+import numpy as np
+from urllib.request import urlopen
+
+from coastsat import NOC_scheduler
+from tests import fake_ee
+
+FILES = dict([('/site%d_%d_%s.zip' % (site, year, satname), np.random.bytes(1000))
+              for site in range(5) for year in range(2016, 2020) for satname in ['L8', 'S2']])
+
+def download(server, path):
+    with urlopen(server.url(path), timeout=60) as response:
+        return response.read()
+
+def run(max_in_flight):
+    with fake_ee.DownloadServer(FILES, delay=0.05, max_concurrent=4) as server:
+        tasks = [functools.partial(download, server, path) for path in FILES.keys()]
+        metrics = NOC_scheduler.Metrics()
+        results = NOC_scheduler.run_tasks(tasks, max_in_flight=max_in_flight, rate=100,
+                                          base_delay=0.05, max_retries=10, metrics=metrics,
+                                          verbose=False)
+    return server, metrics, results
+
+def test_within_quota():
+    server, metrics, results = run(max_in_flight=4)
+    assert len(FILES) == 40
+    assert results == list(FILES.values())
+    assert server.n_rejected == 0
+    assert metrics.n_done == 40 and metrics.n_failed == 0 and metrics.max_in_flight <= 4
+
+def test_rejected_requests_are_retried():
+    # more requests in flight than the quota: the rejected requests are retried with backoff
+    server, metrics, results = run(max_in_flight=8)
+    assert results == list(FILES.values())
+    assert metrics.n_done == 40 and metrics.n_failed == 0
+    assert metrics.n_retries == server.n_rejected
@@ -0,0 +1,48 @@
+"""
+Reading of the tide records bundled with the repository (examples/NARRA_tides.csv, 15-minutes
+records whose dates mix fractional and whole seconds) with NOC_timeseries.read_timeseries.
+"""
+
+import os
+import csv
+import numpy as np
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from coastsat import NOC_timeseries
+
+FN = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'examples', 'NARRA_tides.csv')
+DATES = [datetime(2017, 12, 3, 10, 7, tzinfo=timezone.utc),
+         datetime(2017, 12, 17, 23, 52, tzinfo=timezone.utc),
+         datetime(2017, 12, 31, 0, 0, tzinfo=timezone.utc)]
+
+def read_all():
+    "all the records of the file, parsed one by one with the standard library"
+    with open(FN) as f:
+        rows = list(csv.DictReader(f))
+    dates = [datetime.strptime(_['dates'].replace('+00:00', ''), '%Y-%m-%d %H:%M:%S.%f'
+                               if '.' in _['dates'] else '%Y-%m-%d %H:%M:%S')
+             .replace(tzinfo=timezone.utc) for _ in rows]
+    return dates, np.array([float(_['tide']) for _ in rows])
+
+def test_parse_mixed_dates():
+    dates = NOC_timeseries.parse_dates(['2017-11-30 00:15:00.000003+00:00',
+                                        '2017-11-30 00:30:00+00:00', '2017-11-30 00:45:00'])
+    epochs = NOC_timeseries.to_epoch(dates)
+    assert list(np.diff(epochs)) == [14*60*10**9 + 59999997*10**3, 15*60*10**9]
+
+@pytest.mark.parametrize('chunksize', [100000, 97])
+def test_read_bundled_tides(chunksize):
+    # chunks of 97 rows start with dates with and without fractional seconds
+    dates_all, tides_all = read_all()
+    t_all = NOC_timeseries.to_epoch(dates_all)
+    dates_ts, tides_ts = NOC_timeseries.read_timeseries(FN, DATES, window=timedelta(hours=6),
+                                                        chunksize=chunksize)
+    t = NOC_timeseries.to_epoch(DATES)
+    keep = np.min(np.abs(t_all[:,None] - t[None,:]), axis=1) <= 6*3600*10**9
+    assert np.sum(keep) > 0
+    assert np.array_equal(dates_ts, t_all[keep])
+    assert np.array_equal(tides_ts, tides_all[keep])
+    # same tides at the dates of the images as with all the records
+    assert np.array_equal(NOC_timeseries.get_values(DATES, dates_ts, tides_ts),
+                          NOC_timeseries.get_values(DATES, t_all, tides_all))
@@ -0,0 +1,233 @@
+"""
+Intersections of the shorelines with the transects (NOC_transects) compared with the loops
+over the transects that they replace (see benchmarks/benchmark_intersection.py for the
+timings).
+"""
+
+import os
+import numpy as np
+import pytest
+from shapely import geometry
+
+from coastsat import NOC_transects
+
+def intersect_loop(sl, origins, ends, along_dist):
+    "loop of the original SDS_transects.compute_intersection for one shoreline"
+    intersections = np.zeros(len(origins))
+    for j in range(len(origins)):
+        X0, Y0 = origins[j]
+        temp = ends[j] - origins[j]
+        phi = np.arctan2(temp[1], temp[0])
+        Mrot = np.array([[np.cos(phi), np.sin(phi)],[-np.sin(phi), np.cos(phi)]])
+        p1 = origins[j]
+        p2 = ends[j]
+        d_line = np.abs(np.cross(p2-p1,sl-p1)/np.linalg.norm(p2-p1))
+        d_origin = np.array([np.linalg.norm(sl[k,:] - p1) for k in range(len(sl))])
+        idx_dist = np.logical_and(d_line <= along_dist, d_origin <= 1000)
+        temp_sl = sl - p1
+        phi_sl = np.array([np.arctan2(temp_sl[k,1], temp_sl[k,0]) for k in range(len(temp_sl))])
+        idx_angle = np.abs(phi - phi_sl) < np.pi/2
+        idx_close = np.where(np.logical_and(idx_dist,idx_angle))[0]
+        if len(idx_close) == 0:
+            intersections[j] = np.nan
+        else:
+            xy_close = np.array([sl[idx_close,0],sl[idx_close,1]]) - np.tile(np.array([[X0],
+                               [Y0]]), (1,len(sl[idx_close])))
+            xy_rot = np.matmul(Mrot, xy_close)
+            intersections[j] = np.nanmedian(xy_rot[0,:])
+    return intersections
+
+def wavy_coast(n_transects=80, spacing=50, landward=200, length=500, seed=0):
+    "noisy shoreline along the X axis and shore-normal transects pointing north"
+    rng = np.random.RandomState(seed)
+    def coast(x):
+        return 100*np.sin(x/800) + 20*np.sin(x/150)
+    x_tr = np.arange(n_transects)*spacing
+    slope = np.gradient(coast(x_tr), x_tr)
+    normals = np.array([-slope, np.ones(len(slope))]).T
+    normals = normals/np.linalg.norm(normals, axis=1)[:,None]
+    origins = np.array([x_tr, coast(x_tr) - landward]).T
+    ends = origins + length*normals
+    x_sl = np.arange(-200, x_tr[-1] + 200, 7, dtype=float)
+    sl = np.array([x_sl, coast(x_sl) + rng.normal(0, 3, len(x_sl))]).T
+    return sl, origins, ends
+
+def test_intersect_points_same_as_loop():
+    sl, origins, ends = wavy_coast()
+    # gaps in the shoreline (NaN transects) and NaN points
+    sl = sl[(sl[:,0] < 1200) | (sl[:,0] > 1600)]
+    sl[::13] = np.nan
+    for along_dist in [5, 25, 60]:
+        expected = intersect_loop(sl, origins, ends, along_dist)
+        result = NOC_transects.intersect_points(sl, origins, ends, along_dist)
+        assert np.any(np.isnan(expected)) and not np.all(np.isnan(expected))
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+        # same result whatever the number of transects processed at once
+        np.testing.assert_allclose(NOC_transects.intersect_points(sl, origins, ends, along_dist,
+                                                                  chunk_size=7),
+                                   expected, rtol=0, atol=1e-9)
+
+def test_intersect_points_origin_cutoff():
+    # origins from 800 to 1200 m landward: the points further than 1 km are ignored
+    landward = np.linspace(800, 1200, 80)
+    sl, origins, ends = wavy_coast(landward=landward, length=1500)
+    expected = intersect_loop(sl, origins, ends, 25)
+    result = NOC_transects.intersect_points(sl, origins, ends, 25)
+    assert np.all(np.isnan(expected[landward > 1100]))
+    assert not np.any(np.isnan(expected[landward < 950]))
+    assert np.nanmax(expected) <= 1000
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+
+def test_intersect_points_angle_filter():
+    # transects pointing west (angle of +-180 degrees, not wrapped by the original loop)
+    # with shoreline points in front of and behind the origins
+    y = np.arange(0, 1000, 50, dtype=float)
+    origins = np.array([np.zeros(len(y)), y]).T
+    ends = np.array([-500*np.ones(len(y)), y + np.linspace(-20, 20, len(y))]).T
+    y_sl = np.arange(-100, 1100, 3, dtype=float)
+    sl = np.concatenate([np.array([-300 + 10*np.sin(y_sl/40), y_sl]).T,
+                         np.array([150 + 0*y_sl, y_sl]).T])
+    for along_dist in [10, 25]:
+        expected = intersect_loop(sl, origins, ends, along_dist)
+        result = NOC_transects.intersect_points(sl, origins, ends, along_dist)
+        # the points behind the origins are never used
+        assert np.all(expected > 0)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+
+def test_intersect_points_empty():
+    sl, origins, ends = wavy_coast(n_transects=5)
+    assert np.all(np.isnan(NOC_transects.intersect_points(np.zeros((0,2)), origins, ends, 25)))
+    assert np.all(np.isnan(NOC_transects.intersect_points(sl*np.nan, origins, ends, 25)))
+    assert len(NOC_transects.intersect_points(sl, np.zeros((0,2)), np.zeros((0,2)), 25)) == 0
+
+def intersect_segments_loop(polylines, origins, ends, rule, previous=None,
+                            max_segment_length=100):
+    "exact intersections with shapely, one transect and one segment at a time"
+    intersections = np.ones(len(origins))*np.nan
+    segments = [(line[k], line[k+1]) for line in polylines for k in range(len(line) - 1)]
+    segments = [_ for _ in segments if np.hypot(*(_[1] - _[0])) <= max_segment_length]
+    for j in range(len(origins)):
+        transect = geometry.LineString([origins[j], ends[j]])
+        chainages = []
+        for p1, p2 in segments:
+            # only the segments whose bounding box overlaps the transect (faster)
+            if (max(p1[0], p2[0]) < min(origins[j,0], ends[j,0]) or
+                    min(p1[0], p2[0]) > max(origins[j,0], ends[j,0])):
+                continue
+            point = transect.intersection(geometry.LineString([p1, p2]))
+            if point.geom_type == 'Point':
+                chainages.append(np.hypot(point.x - origins[j,0], point.y - origins[j,1]))
+        if len(chainages) == 0:
+            continue
+        if rule == 'landward':
+            intersections[j] = min(chainages)
+        elif rule == 'seaward' or previous is None or np.isnan(previous[j]):
+            intersections[j] = max(chainages)
+        else:
+            intersections[j] = min(chainages, key=lambda _: abs(_ - previous[j]))
+    return intersections
+
+def shore_and_bar():
+    "shoreline with a gap and a row of NaNs, and a sand bar crossed by some of the transects"
+    sl, origins, ends = wavy_coast()
+    sl = sl[(sl[:,0] < 1200) | (sl[:,0] > 1600)]
+    sl = np.insert(sl, 300, np.nan, axis=0)
+    x_bar = np.arange(2000, 3000, 11, dtype=float)
+    bar = np.array([x_bar, 100*np.sin(x_bar/800) + 20*np.sin(x_bar/150) + 150 +
+                    40*np.sin(x_bar/90)]).T
+    return [sl, bar], origins, ends
+
+def test_intersect_segments_same_as_loop():
+    polylines, origins, ends = shore_and_bar()
+    for rule in ['seaward', 'landward']:
+        expected = intersect_segments_loop(polylines, origins, ends, rule)
+        result = NOC_transects.intersect_segments(polylines, origins, ends, rule)
+        assert np.any(np.isnan(expected)) and not np.all(np.isnan(expected))
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(NOC_transects.intersect_segments(polylines, origins, ends, rule,
+                                                                    chunk_size=7),
+                                   expected, rtol=0, atol=1e-6)
+    # the transects crossing the bar have two crossings
+    seaward = NOC_transects.intersect_segments(polylines, origins, ends, 'seaward')
+    landward = NOC_transects.intersect_segments(polylines, origins, ends, 'landward')
+    assert np.sum(seaward - landward > 50) > 5
+    # without the segments longer than 5 m (the shoreline points are 7 m apart)
+    assert np.all(np.isnan(NOC_transects.intersect_segments(polylines[:1], origins, ends,
+                                                            max_segment_length=5)))
+
+def test_intersect_segments_closest():
+    polylines, origins, ends = shore_and_bar()
+    rng = np.random.RandomState(2)
+    previous = NOC_transects.intersect_segments(polylines, origins, ends, 'landward')
+    previous = previous + rng.normal(0, 5, len(previous))
+    previous[::3] = np.nan
+    expected = intersect_segments_loop(polylines, origins, ends, 'closest', previous)
+    result = NOC_transects.intersect_segments(polylines, origins, ends, 'closest', previous)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+def test_compute_intersection_segments(tmpdir):
+    # the previous shoreline is used with multiple_crossings='closest'
+    polylines, origins, ends = shore_and_bar()
+    transects = dict([(str(_ + 1), np.array([origins[_], ends[_]])) for _ in range(len(origins))])
+    output = {'dates': ['2019-01-01', '2019-02-01'], 'shorelines': [polylines[0], polylines]}
+    os.makedirs(os.path.join(str(tmpdir), 'site'))
+    settings = {'along_dist': 25, 'inputs': {'filepath': str(tmpdir), 'sitename': 'site'},
+                'intersection_mode': 'segments', 'multiple_crossings': 'closest'}
+    cross_dist = NOC_transects.compute_intersection(output, transects, settings)
+    first = intersect_segments_loop(polylines[:1], origins, ends, 'seaward')
+    second = intersect_segments_loop(polylines, origins, ends, 'closest', first)
+    keys = list(transects.keys())
+    np.testing.assert_allclose([cross_dist[_][0] for _ in keys], first, rtol=0, atol=1e-6)
+    np.testing.assert_allclose([cross_dist[_][1] for _ in keys], second, rtol=0, atol=1e-6)
+    assert os.path.exists(os.path.join(str(tmpdir), 'site', 'transect_time_series.csv'))
+
+def test_cast_transects_straight_baseline():
+    # baseline along the X axis with the land on the left (north)
+    baseline = np.array([[0, 0], [400, 0], [1000, 0]], dtype=float)
+    transects = NOC_transects.cast_transects(baseline, spacing=50, length=500, landward=200)
+    assert list(transects.keys()) == [str(_) for _ in range(1, 22)]
+    for k, key in enumerate(transects.keys()):
+        np.testing.assert_allclose(transects[key], [[50*k, 200], [50*k, -300]], atol=1e-9)
+    # land on the right (south)
+    origins, ends = NOC_transects.cast_transect_arrays(baseline, 50, 500, 200, land_side='right')
+    np.testing.assert_allclose(origins[:,1], -200, atol=1e-9)
+    np.testing.assert_allclose(ends[:,1], 300, atol=1e-9)
+    with pytest.raises(Exception):
+        NOC_transects.cast_transect_arrays(baseline, land_side='north')
+
+def test_cast_transects_circle():
+    # anticlockwise circle with the land inside: the transects are radial and point outwards
+    radius = 2000
+    theta = np.linspace(0, 1.5*np.pi, 3000)
+    baseline = radius*np.array([np.cos(theta), np.sin(theta)]).T
+    origins, ends = NOC_transects.cast_transect_arrays(baseline, spacing=100, length=500,
+                                                       landward=200, smoothing=500)
+    assert len(origins) == int(1.5*np.pi*radius/100) + 1
+    # away from the ends of the baseline (the moving average is shortened there)
+    inner = slice(5, -5)
+    np.testing.assert_allclose(np.hypot(*origins[inner].T), radius - 200, atol=0.5)
+    np.testing.assert_allclose(np.hypot(*ends[inner].T), radius + 300, atol=0.5)
+    angles = np.arctan2(*(ends - origins)[inner].T[::-1]) - np.arctan2(*origins[inner].T[::-1])
+    np.testing.assert_allclose(np.angle(np.exp(1j*angles)), 0, atol=1e-3)
+    # spacing along the baseline
+    spacing = np.diff(np.unwrap(np.arctan2(*origins[inner].T[::-1])))*radius
+    np.testing.assert_allclose(spacing, 100, rtol=1e-3)
+
+def test_cast_transects_polylines():
+    # one set of transects per polyline, the NaN points are ignored
+    line1 = np.array([[0, 0], [np.nan, np.nan], [300, 0]], dtype=float)
+    line2 = np.array([[0, 1000], [0, 1200]], dtype=float)
+    origins, ends = NOC_transects.cast_transect_arrays([line1, line2, line2[:1]], spacing=100)
+    np.testing.assert_allclose(origins, [[0, 200], [100, 200], [200, 200], [300, 200],
+                                         [-200, 1000], [-200, 1100], [-200, 1200]], atol=1e-9)
+    np.testing.assert_allclose(ends - origins, [[0, -500]]*4 + [[500, 0]]*3, atol=1e-9)
+
+def test_cast_transects_intersect_baseline():
+    # the baseline intersects the transects cast along it at the landward distance
+    sl, _, _ = wavy_coast()
+    baseline = sl[np.argsort(sl[:,0])]
+    baseline[:,1] = 100*np.sin(baseline[:,0]/800)
+    transects = NOC_transects.cast_transects(baseline, spacing=100, landward=150, smoothing=200)
+    keys, origins, ends = NOC_transects.transects_to_arrays(transects)
+    np.testing.assert_allclose(NOC_transects.intersect_segments(baseline, origins, ends), 150,
+                               atol=0.05)